@@ -0,0 +1,90 @@
+"""/ws/chat 流式输出的并发压测
+
+对比三种消费方式在同一个事件循环里的并发吞吐:
+- sync: 旧的实现,在事件循环里直接迭代同步的 llm.stream
+- executor: 同步 stream 通过线程池适配成异步迭代
+- astream: 模型原生的 astream
+
+用法: python -m benchmark.chat_stream_bench --sessions 100 --tokens 20 --latency 0.005
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from benchmark.fake_llm import FakeStreamingLLM, FakeSyncStreamingLLM
+from utils.async_utils import astream_llm
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.frames = 0
+
+    async def send_text(self, text: str):
+        self.frames += 1
+
+
+async def _consume_sync(llm, websocket, start_time):
+    first_token_time = None
+    for chunk in llm.stream("hello"):
+        if first_token_time is None:
+            first_token_time = time.perf_counter() - start_time
+        await websocket.send_text(chunk.content)
+        await asyncio.sleep(0)  # 让出控制权
+    return first_token_time
+
+
+async def _consume_async(llm, websocket, start_time):
+    first_token_time = None
+    async for chunk in astream_llm(llm, "hello"):
+        if first_token_time is None:
+            first_token_time = time.perf_counter() - start_time
+        await websocket.send_text(chunk.content)
+    return first_token_time
+
+
+async def run_sessions(mode: str, sessions: int, tokens: int, latency: float) -> dict:
+    if mode == "astream":
+        llm = FakeStreamingLLM(token_count=tokens, token_latency=latency)
+    else:
+        llm = FakeSyncStreamingLLM(token_count=tokens, token_latency=latency)
+    consume = _consume_sync if mode == "sync" else _consume_async
+
+    websockets = [FakeWebSocket() for _ in range(sessions)]
+    start_time = time.perf_counter()
+    first_token_times = await asyncio.gather(
+        *[consume(llm, websocket, start_time) for websocket in websockets]
+    )
+    elapsed = time.perf_counter() - start_time
+
+    total_tokens = sum(websocket.frames for websocket in websockets)
+    return {
+        "mode": mode,
+        "sessions": sessions,
+        "elapsed": round(elapsed, 3),
+        "tokens_per_sec": round(total_tokens / elapsed, 1),
+        "ttft_p50": round(statistics.median(first_token_times), 3),
+        "ttft_max": round(max(first_token_times), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chat 流式输出并发压测")
+    parser.add_argument("--sessions", type=int, default=100, help="并发会话数")
+    parser.add_argument("--tokens", type=int, default=20, help="每个回答的token数")
+    parser.add_argument("--latency", type=float, default=0.005, help="每个token的延迟(秒)")
+    parser.add_argument(
+        "--modes", nargs="+", default=["sync", "executor", "astream"], help="对比的模式"
+    )
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        result = asyncio.run(
+            run_sessions(mode, args.sessions, args.tokens, args.latency)
+        )
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
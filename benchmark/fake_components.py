@@ -0,0 +1,366 @@
+"""压测用的离线替身组件,行为确定,不访问网络
+
+- FakeChatModel: langchain 的聊天模型,聊天,解析问题,引导问题,摘要都用它
+- FakeLlamaLLM: llama-index 的模型,RAG 的生成和多路查询用它
+- FakeEmbedding: 按文本哈希生成固定的向量
+- FakeReranker: 按检索分数截取前 top_n 个
+- InMemoryVectorStore / FakeVectorStoreManager: 内存向量库,代替 Milvus
+- InMemoryChatManager: 内存聊天记录,代替 redis
+- InMemoryCollectionVersions: 内存里的知识库版本号,代替 redis
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.llms import (
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    CustomLLM,
+    LLMMetadata,
+)
+from llama_index.core.llms.callbacks import llm_completion_callback
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import BaseNode, NodeWithScore, QueryBundle, TextNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+
+from dao.redis_dao import ChatSummaryModel
+
+
+class FakeChatModel(BaseChatModel):
+    """固定延迟逐个输出token的聊天模型"""
+
+    token_count: int = 50
+    token_latency: float = 0.01
+    first_token_latency: float = 0.2
+    token_text: str = "测"
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _reply(self) -> str:
+        return self.token_text * self.token_count
+
+    def _generate(
+        self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs
+    ) -> ChatResult:
+        time.sleep(self.first_token_latency + self.token_latency * self.token_count)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply()))])
+
+    async def _agenerate(
+        self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs
+    ) -> ChatResult:
+        await asyncio.sleep(self.first_token_latency + self.token_latency * self.token_count)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply()))])
+
+    def _stream(
+        self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs
+    ) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.first_token_latency)
+        for _ in range(self.token_count):
+            time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=self.token_text))
+
+    async def _astream(
+        self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.first_token_latency)
+        for _ in range(self.token_count):
+            await asyncio.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=self.token_text))
+
+
+class FakeLlamaLLM(CustomLLM):
+    """llama-index 的补全模型,和 FakeChatModel 的输出节奏一样"""
+
+    token_count: int = 50
+    token_latency: float = 0.01
+    first_token_latency: float = 0.2
+    token_text: str = "测"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(model_name="fake-llama")
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        time.sleep(self.first_token_latency + self.token_latency * self.token_count)
+        return CompletionResponse(text=self.token_text * self.token_count)
+
+    @llm_completion_callback()
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        def gen() -> CompletionResponseGen:
+            time.sleep(self.first_token_latency)
+            text = ""
+            for _ in range(self.token_count):
+                time.sleep(self.token_latency)
+                text += self.token_text
+                yield CompletionResponse(text=text, delta=self.token_text)
+
+        return gen()
+
+    @llm_completion_callback()
+    async def acomplete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        await asyncio.sleep(self.first_token_latency + self.token_latency * self.token_count)
+        return CompletionResponse(text=self.token_text * self.token_count)
+
+    @llm_completion_callback()
+    async def astream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        async def gen() -> CompletionResponseAsyncGen:
+            await asyncio.sleep(self.first_token_latency)
+            text = ""
+            for _ in range(self.token_count):
+                await asyncio.sleep(self.token_latency)
+                text += self.token_text
+                yield CompletionResponse(text=text, delta=self.token_text)
+
+        return gen()
+
+
+class FakeEmbedding(BaseEmbedding):
+    """同样的文本总是得到同样的单位向量, latency模拟每次请求的耗时,批量请求只算一次"""
+
+    embed_dim: int = 256
+    latency: float = 0.0
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeEmbedding"
+
+    def _embed(self, text: str) -> List[float]:
+        seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+        vector = np.random.default_rng(seed).standard_normal(self.embed_dim)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        time.sleep(self.latency)
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        await asyncio.sleep(self.latency)
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed(text)
+
+    async def aget_query_embedding_batch(self, queries: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency)
+        return [self._embed(query) for query in queries]
+
+
+class FakeReranker(BaseNodePostprocessor):
+    """不调用重排序模型,按检索分数截取"""
+
+    top_n: int = 3
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeReranker"
+
+    def _postprocess_nodes(
+        self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None
+    ) -> List[NodeWithScore]:
+        return sorted(nodes, key=lambda node: node.score or 0, reverse=True)[: self.top_n]
+
+
+def _match_filters(node: BaseNode, filters: Optional[MetadataFilters]) -> bool:
+    if filters is None:
+        return True
+    return all(node.metadata.get(item.key) == item.value for item in filters.filters)
+
+
+class InMemoryVectorStore(BasePydanticVectorStore):
+    """暴力计算余弦相似度,只支持等值的元数据过滤"""
+
+    stores_text: bool = True
+    _nodes: dict = PrivateAttr(default_factory=dict)
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    def add(self, nodes: List[BaseNode], **kwargs: Any) -> List[str]:
+        for node in nodes:
+            self._nodes[node.node_id] = node
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        self._nodes = {
+            node_id: node
+            for node_id, node in self._nodes.items()
+            if node.ref_doc_id != ref_doc_id
+        }
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        candidates = [
+            node for node in self._nodes.values() if _match_filters(node, query.filters)
+        ]
+        if not candidates:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+
+        matrix = np.array([node.embedding for node in candidates], dtype=np.float32)
+        query_vector = np.array(query.query_embedding, dtype=np.float32)
+        scores = matrix @ query_vector / (
+            np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_vector) + 1e-12
+        )
+        top = np.argsort(-scores)[: query.similarity_top_k]
+        return VectorStoreQueryResult(
+            nodes=[candidates[i] for i in top],
+            similarities=[float(scores[i]) for i in top],
+            ids=[candidates[i].node_id for i in top],
+        )
+
+
+class FakeVectorStoreManager:
+    """和 VectorStoreManager 的接口一致,不连接 Milvus"""
+
+    def __init__(
+        self, collection_name: str, embedding_size: int, embed_model=None
+    ) -> None:
+        self.vector_store = InMemoryVectorStore()
+        self.embed_model = embed_model or Settings.embed_model
+
+    def load_nodes(self, nodes: List[BaseNode]) -> None:
+        embeddings = self.embed_model.get_text_embedding_batch(
+            [node.get_content() for node in nodes]
+        )
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+        self.vector_store.add(nodes)
+
+    def get_vector_store(self):
+        return self.vector_store
+
+    def close(self) -> None:
+        pass
+
+
+def generate_corpus_nodes(count: int, file_count: int = 10) -> List[TextNode]:
+    """生成压测用的知识库片段"""
+    return [
+        TextNode(
+            text=f"第{index}段压测文本,介绍产品的第{index % 37}个功能和使用方法。",
+            metadata={
+                "file_id": f"bench_file_{index % file_count}",
+                "file_name": f"bench_{index % file_count}.txt",
+            },
+        )
+        for index in range(count)
+    ]
+
+
+class InMemoryCollectionVersions:
+    """和 CollectionVersions 的接口一致,版本号保存在内存里"""
+
+    def __init__(self):
+        self._versions: dict[str, int] = {}
+
+    def bump(self, collection: str) -> int:
+        self._versions[collection] = self._versions.get(collection, 0) + 1
+        return self._versions[collection]
+
+    async def aget(self, collection: str) -> int:
+        return self._versions.get(collection, 0)
+
+    async def aclose(self):
+        pass
+
+
+class InMemoryChatManager:
+    """和 ChatRedisManager 的接口一致,聊天记录保存在内存里"""
+
+    def __init__(self):
+        self._records: dict[tuple[str, str], list[tuple[str, float]]] = {}
+        self._summaries: dict[tuple[str, str], str] = {}
+
+    async def close(self):
+        pass
+
+    async def add_chat_record(self, username, sessionid, msg_list):
+        timestamp = time.time()
+        records = self._records.setdefault((username, str(sessionid)), [])
+        records.extend(
+            (json.dumps(msg), timestamp + index * 1e-6)
+            for index, msg in enumerate(msg_list)
+        )
+
+    async def get_history_snapshots(self, username):
+        snapshots = []
+        for (user, session_id), records in self._records.items():
+            user_msgs = [json.loads(msg) for msg, _ in records]
+            user_msgs = [msg for msg in user_msgs if msg.get("role") == "user"]
+            if user == username and user_msgs:
+                snapshots.append(
+                    {
+                        "user_name": username,
+                        "session_id": int(session_id),
+                        "last_msg": str(user_msgs[-1]["content"]),
+                    }
+                )
+        return sorted(snapshots, key=lambda item: item["session_id"], reverse=True)
+
+    async def get_history_record(self, username, sessionid):
+        records = self._records.get((username, str(sessionid)))
+        if records:
+            return [json.loads(msg) for msg, _ in records]
+        return None
+
+    async def get_history_tail(self, username, sessionid, count: int):
+        records = self._records.get((username, str(sessionid)), [])[-count:]
+        return [(json.loads(msg), score) for msg, score in records]
+
+    async def get_history_entries(
+        self, username, sessionid, after: float = None, limit: int = None
+    ):
+        records = self._records.get((username, str(sessionid)), [])
+        entries = [
+            (json.loads(msg), score)
+            for msg, score in records
+            if after is None or score > after
+        ]
+        return entries if limit is None else entries[:limit]
+
+    async def count_history_entries(self, username, sessionid, after: float = None):
+        return len(await self.get_history_entries(username, sessionid, after))
+
+    async def get_chat_summary(self, username, sessionid) -> ChatSummaryModel:
+        summary = self._summaries.get((username, str(sessionid)))
+        if summary is None:
+            return ChatSummaryModel()
+        return ChatSummaryModel.model_validate_json(summary)
+
+    async def save_chat_summary(self, username, sessionid, summary: ChatSummaryModel):
+        self._summaries[(username, str(sessionid))] = summary.model_dump_json()
+
+    async def delete_chat_record(self, username, sessionid):
+        self._records.pop((username, str(sessionid)), None)
+        self._summaries.pop((username, str(sessionid)), None)
+
+
+class NoopCallbackHandler:
+    """代替 langfuse 的 llama-index 回调,flush 不等待网络"""
+
+    def flush(self):
+        pass
@@ -0,0 +1,43 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Iterator
+
+
+@dataclass
+class FakeChunk:
+    content: str
+
+
+class FakeSyncStreamingLLM:
+    """模拟流式输出的大模型,不依赖网络
+    只有同步的 stream,每个token都阻塞等待,相当于同步的 http 读
+    """
+
+    def __init__(
+            self,
+            token_count: int = 20,
+            token_latency: float = 0.005,
+            first_token_latency: float = 0.0,
+            token_text: str = "测",
+    ):
+        self.token_count = token_count
+        self.token_latency = token_latency
+        self.first_token_latency = first_token_latency
+        self.token_text = token_text
+
+    def stream(self, inputs: Any, **kwargs) -> Iterator[FakeChunk]:
+        time.sleep(self.first_token_latency)
+        for _ in range(self.token_count):
+            time.sleep(self.token_latency)
+            yield FakeChunk(content=self.token_text)
+
+
+class FakeStreamingLLM(FakeSyncStreamingLLM):
+    """同时提供原生 astream 的模拟模型"""
+
+    async def astream(self, inputs: Any, **kwargs) -> AsyncIterator[FakeChunk]:
+        await asyncio.sleep(self.first_token_latency)
+        for _ in range(self.token_count):
+            await asyncio.sleep(self.token_latency)
+            yield FakeChunk(content=self.token_text)
@@ -0,0 +1,136 @@
+"""组装离线的压测服务: 通过现有的工厂函数换上替身组件,只挂载 /ws/chat 和 /ws/rag/chat_query
+
+install_fakes 必须在导入 controller 之前调用,controller 在导入时就会创建模型和管理器
+"""
+
+import logging
+import os
+from dataclasses import dataclass
+
+
+@dataclass
+class FakeModelConfig:
+    token_count: int = 50
+    token_latency: float = 0.01
+    first_token_latency: float = 0.2
+    token_text: str = "测"
+    embed_dim: int = 256
+    embed_latency: float = 0.0
+    corpus_size: int = 2000
+
+
+def install_fakes(config: FakeModelConfig, quiet: bool = True):
+    # langfuse 需要这几个环境变量,指向本机不存在的地址,不会访问外网
+    os.environ.setdefault("LANGFUSE_SECRET_KEY", "sk-lf-benchmark")
+    os.environ.setdefault("LANGFUSE_PUBLIC_KEY", "pk-lf-benchmark")
+    os.environ.setdefault("LANGFUSE_HOST", "http://127.0.0.1:9")
+
+    from llama_index.core import Settings
+    from llama_index.core.callbacks import CallbackManager
+
+    from benchmark.fake_components import (
+        FakeChatModel,
+        FakeEmbedding,
+        FakeLlamaLLM,
+        FakeReranker,
+        FakeVectorStoreManager,
+        InMemoryChatManager,
+        InMemoryCollectionVersions,
+        NoopCallbackHandler,
+    )
+    from utils.log_utils import LogUtils
+
+    if quiet:
+        LogUtils.log_info = staticmethod(lambda *msg: None)
+        # langfuse 初始化时会重置日志级别,上报失败的日志直接丢掉
+        langfuse_logger = logging.getLogger("langfuse")
+        langfuse_logger.addHandler(logging.NullHandler())
+        langfuse_logger.propagate = False
+
+    model_kwargs = dict(
+        token_count=config.token_count,
+        token_latency=config.token_latency,
+        first_token_latency=config.first_token_latency,
+        token_text=config.token_text,
+    )
+
+    # 有些模块在导入时就会读取全局的 Settings.llm,没有配置会去找 OpenAI
+    Settings.llm = FakeLlamaLLM(**model_kwargs)
+
+    # 1. 聊天模型: LLMFactory 创建的所有 langchain 模型
+    from models.factory.llm_client_cache import llm_client_cache
+    from models.factory.llm_factory import LLMFactory
+
+    LLMFactory.create_llm = staticmethod(
+        lambda mode_type, mode_name=None: FakeChatModel(**model_kwargs)
+    )
+    llm_client_cache.clear()
+
+    # 2. RAG 的生成模型
+    from models.llm.llamaindex.groq_llm import GroqLlmaFactory
+
+    GroqLlmaFactory.get_llm = lambda self, mode_name=None: FakeLlamaLLM(**model_kwargs)
+
+    # 3. 向量模型
+    import rag.managers.embedding_manager as embedding_manager
+
+    embedding_manager.get_embedding_model = lambda embedding_type, embedding_name: (
+        FakeEmbedding(
+            model_name="fake-embedding",
+            embed_dim=config.embed_dim,
+            latency=config.embed_latency,
+        )
+    )
+    embedding_manager.get_simple_embedding_name = (
+        lambda embedding_type, embedding_name: "benchmark"
+    )
+
+    # 4. 重排序
+    from models.rerank.reranker import RagReranker
+
+    RagReranker.get_jina_rerank = staticmethod(lambda top_n=3: FakeReranker(top_n=top_n))
+
+    # 5. 向量库和回调
+    import rag.rag_base_manager as rag_base_module
+
+    rag_base_module.VectorStoreManager = FakeVectorStoreManager
+    rag_base_module.langfuse_callback_handler = NoopCallbackHandler()
+    Settings.callback_manager = CallbackManager([])
+
+    # 6. 聊天记录
+    import dao.redis_dao as redis_dao
+
+    chat_manager = InMemoryChatManager()
+    redis_dao.get_chat_redis_manager = lambda: chat_manager
+
+    # 7. 语义缓存的知识库版本号
+    import utils.semantic_cache as semantic_cache_module
+
+    semantic_cache_module.collection_versions = InMemoryCollectionVersions()
+
+    # 8. 调度器: 替身模型不受真实provider的限流,只保留默认的并发上限
+    from models.factory.llm_scheduler import llm_scheduler
+
+    llm_scheduler._provider_config = {}
+    llm_scheduler._model_config = {}
+
+
+def create_app(config: FakeModelConfig, quiet: bool = True):
+    install_fakes(config, quiet)
+
+    from fastapi import FastAPI
+
+    from benchmark.fake_components import generate_corpus_nodes
+    from controller.chat_controller import chat_router
+    from controller.rag.rag_controller import rag_router
+    from rag.rag_manager_registry import rag_manager_registry
+
+    # 压测前先加载默认租户,第一次请求的耗时不算进去
+    rag_manager_registry.get_manager().vector_store_manager.load_nodes(
+        generate_corpus_nodes(config.corpus_size)
+    )
+
+    app = FastAPI()
+    app.include_router(chat_router)
+    app.include_router(rag_router)
+    return app
@@ -0,0 +1,258 @@
+"""/ws/chat 和 /ws/rag/chat_query 的离线并发压测
+
+模型,向量模型,重排序,向量库和聊天记录都换成确定的替身组件,不需要网络
+服务端在后台线程里用 uvicorn 启动,客户端用 websockets 并发请求,统计:
+- 首字延迟(TTFT) p50/p95/p99
+- 每个会话和整体的 tokens/s
+- 错误率(异常,超时,服务端返回的错误)
+
+用法:
+    python -m benchmark.ws_load_bench --endpoint chat --clients 50 --requests 3
+    python -m benchmark.ws_load_bench --endpoint rag --clients 20 --token-latency 0.005
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import statistics
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import uvicorn
+import websockets
+
+from benchmark.offline_app import FakeModelConfig, create_app
+from utils.command_constants import (
+    CHAT_FOLLOW_QUESTIONS,
+    CHAT_STREAM_SERVE_DONE,
+    CHAT_STREAM_SERVE_START,
+)
+
+ENDPOINT_PATHS = {
+    "chat": "/ws/chat",
+    "rag": "/ws/rag/chat_query",
+}
+
+ERROR_PREFIX = "Error while receiving or processing data"
+
+
+@dataclass
+class RequestResult:
+    ttft: Optional[float] = None
+    duration: float = 0.0
+    chars: int = 0
+    frames: int = 0
+    error: Optional[str] = None
+
+
+@dataclass
+class BenchReport:
+    results: List[RequestResult] = field(default_factory=list)
+    elapsed: float = 0.0
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+class BenchServer:
+    """在后台线程里运行 uvicorn,和压测客户端不共用事件循环"""
+
+    def __init__(self, app, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port or self._get_free_port()
+        self.server = uvicorn.Server(
+            uvicorn.Config(app, host=self.host, port=self.port, log_level="warning")
+        )
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @staticmethod
+    def _get_free_port() -> int:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    def start(self, timeout: float = 30):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline or not self.thread.is_alive():
+                raise RuntimeError("benchmark server failed to start")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+def build_request(args, client_index: int, request_index: int) -> str:
+    return json.dumps(
+        {
+            "user_name": f"bench_user_{client_index}",
+            "session_id": 1_700_000_000 + client_index,
+            "data": f"压测问题{client_index}-{request_index},产品有哪些功能?",
+            "model_type": "deepseek",
+            "model_name": "deepseek-chat",
+            "multi_turn_chat_enabled": args.multi_turn,
+            "rag_multi_turn_chat_enabled": args.multi_turn,
+            "follow_questions_enabled": False,
+            "semantic_cache_enabled": args.semantic_cache,
+        }
+    )
+
+
+async def run_request(websocket, endpoint: str, request_msg: str, timeout: float) -> RequestResult:
+    result = RequestResult()
+    start_time = time.perf_counter()
+    # chat 接口没有开始标记,第一帧就是回答; rag 接口在开始标记之前是检索进度
+    streaming = endpoint == "chat"
+    try:
+        await websocket.send(request_msg)
+        while True:
+            text = await asyncio.wait_for(websocket.recv(), timeout=timeout)
+            if text == CHAT_STREAM_SERVE_DONE:
+                break
+            if text.startswith(ERROR_PREFIX):
+                result.error = text
+                if endpoint == "chat":
+                    break
+                continue
+            if text == CHAT_STREAM_SERVE_START:
+                streaming = True
+                continue
+            if not streaming or text.startswith('{"' + CHAT_FOLLOW_QUESTIONS):
+                continue
+
+            if result.ttft is None:
+                result.ttft = time.perf_counter() - start_time
+            result.chars += len(text)
+            result.frames += 1
+    except asyncio.TimeoutError:
+        result.error = "timeout"
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    result.duration = time.perf_counter() - start_time
+    return result
+
+
+async def run_client(url: str, args, client_index: int) -> List[RequestResult]:
+    results = []
+    try:
+        async with websockets.connect(url, max_size=None) as websocket:
+            for request_index in range(args.requests):
+                if request_index > 0:
+                    await asyncio.sleep(args.think_time)
+                request_msg = build_request(args, client_index, request_index)
+                result = await run_request(websocket, args.endpoint, request_msg, args.timeout)
+                results.append(result)
+                if result.error == "timeout":
+                    break
+    except Exception as e:
+        results.append(RequestResult(error=f"connect {type(e).__name__}: {e}"))
+    return results
+
+
+async def run_bench(url: str, args) -> BenchReport:
+    start_time = time.perf_counter()
+    client_results = await asyncio.gather(
+        *[run_client(url, args, index) for index in range(args.clients)]
+    )
+    report = BenchReport(elapsed=time.perf_counter() - start_time)
+    for results in client_results:
+        report.results.extend(results)
+    return report
+
+
+def summarize(report: BenchReport, args) -> dict:
+    token_size = len(args.token_text)
+    ok_results = [result for result in report.results if result.error is None]
+    ttfts = [result.ttft for result in ok_results if result.ttft is not None]
+    session_rates = [
+        result.chars / token_size / (result.duration - result.ttft)
+        for result in ok_results
+        if result.ttft is not None and result.duration > result.ttft
+    ]
+    total_tokens = sum(result.chars for result in ok_results) / token_size
+    total = len(report.results)
+
+    return {
+        "endpoint": args.endpoint,
+        "clients": args.clients,
+        "requests": total,
+        "errors": total - len(ok_results),
+        "error_rate": round((total - len(ok_results)) / total, 4) if total else 0.0,
+        "elapsed": round(report.elapsed, 3),
+        "think_time": args.think_time,
+        "ttft_p50": round(_percentile(ttfts, 50), 4),
+        "ttft_p95": round(_percentile(ttfts, 95), 4),
+        "ttft_p99": round(_percentile(ttfts, 99), 4),
+        "session_tokens_per_sec_p50": round(statistics.median(session_rates), 1)
+        if session_rates
+        else 0.0,
+        "total_tokens_per_sec": round(total_tokens / report.elapsed, 1)
+        if report.elapsed
+        else 0.0,
+        "avg_frames_per_request": round(
+            statistics.mean(result.frames for result in ok_results), 1
+        )
+        if ok_results
+        else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="websocket 离线并发压测")
+    parser.add_argument("--endpoint", choices=list(ENDPOINT_PATHS), default="chat")
+    parser.add_argument("--clients", type=int, default=50, help="并发的websocket连接数")
+    parser.add_argument("--requests", type=int, default=3, help="每个连接依次发送的请求数")
+    parser.add_argument("--tokens", type=int, default=50, help="每个回答的token数")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="每个token的延迟(秒)")
+    parser.add_argument("--first-token-latency", type=float, default=0.2, help="首个token的延迟(秒)")
+    parser.add_argument("--token-text", default="测", help="每个token的内容")
+    parser.add_argument("--corpus-size", type=int, default=2000, help="内存知识库的片段数")
+    parser.add_argument(
+        "--embed-latency", type=float, default=0.0, help="每次向量模型请求的延迟(秒)"
+    )
+    parser.add_argument(
+        "--think-time", type=float, default=0.0, help="同一个连接两次提问之间的间隔(秒)"
+    )
+    parser.add_argument("--timeout", type=float, default=60, help="单帧的接收超时(秒)")
+    parser.add_argument("--multi-turn", action="store_true", help="开启多轮对话")
+    parser.add_argument("--semantic-cache", action="store_true", help="开启语义缓存")
+    parser.add_argument("--verbose", action="store_true", help="打印服务端日志")
+    args = parser.parse_args()
+
+    app = create_app(
+        FakeModelConfig(
+            token_count=args.tokens,
+            token_latency=args.token_latency,
+            first_token_latency=args.first_token_latency,
+            token_text=args.token_text,
+            corpus_size=args.corpus_size,
+            embed_latency=args.embed_latency,
+        ),
+        quiet=not args.verbose,
+    )
+    server = BenchServer(app)
+    server.start()
+    try:
+        url = f"ws://{server.host}:{server.port}{ENDPOINT_PATHS[args.endpoint]}"
+        report = asyncio.run(run_bench(url, args))
+    finally:
+        server.stop()
+
+    print(json.dumps(summarize(report, args), ensure_ascii=False, indent=2))
+    errors = [result.error for result in report.results if result.error is not None]
+    for error in errors[:5]:
+        print("error:", error[:200])
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,24 @@ class BaseConfiguration:
     def get_redis_config(self):
         return self.config["redis"]
 
+    def get_chat_history_config(self):
+        return self.config["chat_history"]
+
+    def get_stream_writer_config(self):
+        return self.config["stream_writer"]
+
+    def get_llm_client_config(self):
+        return self.config["llm_client"]
+
+    def get_semantic_cache_config(self):
+        return self.config["semantic_cache"]
+
+    def get_llm_scheduler_config(self):
+        return self.config["llm_scheduler"]
+
+    def get_llm_hedge_config(self):
+        return self.config["llm_hedge"]
+
     def get_username_admin_test(self):
         return self.config["username"]["admin_test"]
 
@@ -1,6 +1,6 @@
-import asyncio
 import json
 import os
+from contextlib import aclosing
 from datetime import datetime
 
 from fastapi import APIRouter
@@ -9,10 +9,13 @@ from langgraph.graph import StateGraph
 from starlette.websockets import WebSocket
 
 from models.factory.llm_factory import LLMFactory
+from models.factory.llm_scheduler import LLMPriority, llm_scheduler
 from models.model_type import LLMType
 from schema.chat_schema import ChatRequestData
 
+from utils.async_utils import astream_llm_content
 from utils.command_constants import CHAT_STREAM_SERVE_DONE
+from utils.stream_writer import get_stream_writer
 
 os.environ["LANGCHAIN_TRACING_V2"] = "true"
 os.environ["LANGCHAIN_API_KEY"] = os.getenv("LANGSMITH_API_KEY")
@@ -34,9 +37,7 @@ def get_completion(
         ("system", system_message),
         ("user", prompt),
     ]
-    response = llm.stream(messages)
-    for chunk in response:
-        yield chunk.content
+    return astream_llm_content(llm, messages, "agent")
 
 
 class State(TypedDict):
@@ -67,11 +68,13 @@ async def generate_white_hat(state):
     print(print_msg)
     await web_socket.send_text(print_msg)
     text = ""
-    for chunk in completion:
-        print(chunk, end="", flush=True)
-        await asyncio.sleep(0)  # 让出控制权，允许事件循环处理其他任务
-        await web_socket.send_text(str(chunk))
-        text += chunk
+    stream_writer = get_stream_writer(web_socket, "agent")
+    async with aclosing(completion):
+        async for chunk in completion:
+            print(chunk, end="", flush=True)
+            await stream_writer.write(str(chunk))
+            text += chunk
+    await stream_writer.flush()
 
     return {"white_hat": text}
 
@@ -92,11 +95,13 @@ async def generate_red_hat(state):
     print(print_msg)
     await web_socket.send_text(print_msg)
     text = ""
-    for chunk in completion:
-        print(chunk, end="", flush=True)
-        await asyncio.sleep(0)  # 让出控制权，允许事件循环处理其他任务
-        await web_socket.send_text(str(chunk))
-        text += chunk
+    stream_writer = get_stream_writer(web_socket, "agent")
+    async with aclosing(completion):
+        async for chunk in completion:
+            print(chunk, end="", flush=True)
+            await stream_writer.write(str(chunk))
+            text += chunk
+    await stream_writer.flush()
 
     return {"red_hat": text}
 
@@ -121,11 +126,13 @@ async def generate_black_hat(state):
     print(print_msg)
     await web_socket.send_text(print_msg)
     text = ""
-    for chunk in completion:
-        print(chunk, end="", flush=True)
-        await asyncio.sleep(0)  # 让出控制权，允许事件循环处理其他任务
-        await web_socket.send_text(str(chunk))
-        text += chunk
+    stream_writer = get_stream_writer(web_socket, "agent")
+    async with aclosing(completion):
+        async for chunk in completion:
+            print(chunk, end="", flush=True)
+            await stream_writer.write(str(chunk))
+            text += chunk
+    await stream_writer.flush()
 
     return {"black_hat": text}
 
@@ -152,11 +159,13 @@ async def generate_yellow_hat(state):
     print(print_msg)
     await web_socket.send_text(print_msg)
     text = ""
-    for chunk in completion:
-        print(chunk, end="", flush=True)
-        await asyncio.sleep(0)  # 让出控制权，允许事件循环处理其他任务
-        await web_socket.send_text(str(chunk))
-        text += chunk
+    stream_writer = get_stream_writer(web_socket, "agent")
+    async with aclosing(completion):
+        async for chunk in completion:
+            print(chunk, end="", flush=True)
+            await stream_writer.write(str(chunk))
+            text += chunk
+    await stream_writer.flush()
 
     return {"yellow_hat": text}
 
@@ -187,11 +196,13 @@ async def generate_green_hat(state):
     print(print_msg)
     await web_socket.send_text(print_msg)
     text = ""
-    for chunk in completion:
-        print(chunk, end="", flush=True)
-        await asyncio.sleep(0)  # 让出控制权，允许事件循环处理其他任务
-        await web_socket.send_text(str(chunk))
-        text += chunk
+    stream_writer = get_stream_writer(web_socket, "agent")
+    async with aclosing(completion):
+        async for chunk in completion:
+            print(chunk, end="", flush=True)
+            await stream_writer.write(str(chunk))
+            text += chunk
+    await stream_writer.flush()
 
     return {"green_hat": text}
 
@@ -223,11 +234,13 @@ async def generate_blue_hat(state):
     print(print_msg)
     await web_socket.send_text(print_msg)
     text = ""
-    for chunk in completion:
-        print(chunk, end="", flush=True)
-        await asyncio.sleep(0)  # 让出控制权，允许事件循环处理其他任务
-        await web_socket.send_text(str(chunk))
-        text += chunk
+    stream_writer = get_stream_writer(web_socket, "agent")
+    async with aclosing(completion):
+        async for chunk in completion:
+            print(chunk, end="", flush=True)
+            await stream_writer.write(str(chunk))
+            text += chunk
+    await stream_writer.flush()
 
     await web_socket.send_text(CHAT_STREAM_SERVE_DONE)
     return {"blue_hat": text}
@@ -264,9 +277,15 @@ async def websocket_endpoint(websocket: WebSocket):
                 print(f"Received message: {request_msg}")
 
                 chat_request_data = ChatRequestData(**json.loads(request_msg))
-                llm = LLMFactory.get_llm(
-                    mode_type=LLMType.get_enum_from_value(chat_request_data.model_type),
-                    mode_name=chat_request_data.model_name,
+                # 经过调度器排队和限流,和聊天共用provider的并发和速率上限
+                llm = llm_scheduler.bind(
+                    LLMFactory.get_llm(
+                        mode_type=LLMType.get_enum_from_value(chat_request_data.model_type),
+                        mode_name=chat_request_data.model_name,
+                    ),
+                    provider=chat_request_data.model_type,
+                    model=chat_request_data.model_name,
+                    priority=LLMPriority.INTERACTIVE,
                 )
                 inputs = {
                     "llm": llm,
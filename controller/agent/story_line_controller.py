@@ -1,6 +1,6 @@
-import asyncio
 import json
 import os
+from contextlib import aclosing
 from datetime import datetime
 from typing import TypedDict
 
@@ -14,9 +14,12 @@ from pydantic import BaseModel, Field
 from starlette.websockets import WebSocket
 
 from models.factory.llm_factory import LLMFactory
+from models.factory.llm_scheduler import LLMPriority, llm_scheduler
 from models.model_type import LLMType
 from schema.agent_schema import StoryLineAgentSchema
+from utils.async_utils import astream_llm_content
 from utils.command_constants import CHAT_STREAM_SERVE_DONE
+from utils.stream_writer import get_stream_writer
 
 load_dotenv()
 
@@ -137,19 +140,21 @@ async def generate_background(state):
     {model_format_instructions}
     """
 
-    stream_response = llm.stream(background_prompt)
+    stream_response = astream_llm_content(llm, background_prompt, "agent")
 
     print_msg = "# " + idea + "\n" + "## 世界观背景故事\n"
     print(print_msg)
     await web_socket.send_text(print_msg)
 
     response = ""
-    for chunk in stream_response:
-        # print(chunk.content, end="", flush=True)
-        await asyncio.sleep(0)  # 让出控制权，允许事件循环处理其他任务
-        await web_socket.send_text(str(chunk.content))
+    stream_writer = get_stream_writer(web_socket, "agent")
+    async with aclosing(stream_response):
+        async for chunk in stream_response:
+            # print(chunk, end="", flush=True)
+            await stream_writer.write(str(chunk))
 
-        response += chunk.content
+            response += chunk
+    await stream_writer.flush()
 
     return {
         KEY_BACKGROUND: response,
@@ -190,19 +195,21 @@ async def modify_background(state):
             修改后的背景信息:
             """
 
-    stream_response = llm.stream(modify_prompt)
+    stream_response = astream_llm_content(llm, modify_prompt, "agent")
 
     print_msg = "# " + idea + "\n" + "## 世界观背景故事(修改后)\n"
     print(print_msg)
     await web_socket.send_text(print_msg)
 
     response = ""
-    for chunk in stream_response:
-        print(chunk.content, end="", flush=True)
-        await asyncio.sleep(0)  # 让出控制权，允许事件循环处理其他任务
-        await web_socket.send_text(str(chunk.content))
+    stream_writer = get_stream_writer(web_socket, "agent")
+    async with aclosing(stream_response):
+        async for chunk in stream_response:
+            print(chunk, end="", flush=True)
+            await stream_writer.write(str(chunk))
 
-        response += chunk.content
+            response += chunk
+    await stream_writer.flush()
 
     return {
         KEY_BACKGROUND: response,
@@ -273,13 +280,15 @@ async def generate_storyline(state: StoryState):
     # print(print_msg)
     await web_socket.send_text(print_msg)
 
-    stream_response = llm.stream(prompt)
+    stream_response = astream_llm_content(llm, prompt, "agent")
     response = ""
-    for chunk in stream_response:
-        print(chunk.content, end="", flush=True)
-        await asyncio.sleep(0)  # 让出控制权，允许事件循环处理其他任务
-        await web_socket.send_text(str(chunk.content))
-        response += chunk.content
+    stream_writer = get_stream_writer(web_socket, "agent")
+    async with aclosing(stream_response):
+        async for chunk in stream_response:
+            print(chunk, end="", flush=True)
+            await stream_writer.write(str(chunk))
+            response += chunk
+    await stream_writer.flush()
 
     # fix_parse = OutputFixingParser.from_llm(parser=pydantic_parse, llm=deep_seek_llm)
     storyline = pydantic_parse.parse(response)
@@ -315,18 +324,20 @@ async def modify_storyline(state):
       
        你最终的修改:
        """
-    stream_response = llm.stream(prompt)
+    stream_response = astream_llm_content(llm, prompt, "agent")
 
     print_msg = "## 故事情节大纲(修改后)\n"
     print(print_msg)
     await web_socket.send_text(print_msg)
 
     response = ""
-    for chunk in stream_response:
-        print(chunk.content, end="", flush=True)
-        await asyncio.sleep(0)  # 让出控制权，允许事件循环处理其他任务
-        await web_socket.send_text(str(chunk.content))
-        response += chunk.content
+    stream_writer = get_stream_writer(web_socket, "agent")
+    async with aclosing(stream_response):
+        async for chunk in stream_response:
+            print(chunk, end="", flush=True)
+            await stream_writer.write(str(chunk))
+            response += chunk
+    await stream_writer.flush()
 
     storyline = pydantic_parse.parse(response)
     return {
@@ -438,14 +449,16 @@ async def generate_detail(state):
     print_msg = "\n\n"
     # print(print_msg)
     await web_socket.send_text(print_msg)
-    stream_response = llm.stream(storyline_detail_prompt)
+    stream_response = astream_llm_content(llm, storyline_detail_prompt, "agent")
 
     response = ""
-    for chunk in stream_response:
-        print(chunk.content, end="", flush=True)
-        await asyncio.sleep(0)  # 让出控制权，允许事件循环处理其他任务
-        await web_socket.send_text(str(chunk.content))
-        response += chunk.content
+    stream_writer = get_stream_writer(web_socket, "agent")
+    async with aclosing(stream_response):
+        async for chunk in stream_response:
+            print(chunk, end="", flush=True)
+            await stream_writer.write(str(chunk))
+            response += chunk
+    await stream_writer.flush()
 
     response = "\n\n" + response
     stories.append(response)
@@ -483,14 +496,16 @@ async def modify_detail(state):
     print(print_msg)
     await web_socket.send_text(print_msg)
 
-    stream_response = llm.stream(storyline_detail_modify_prompt)
+    stream_response = astream_llm_content(llm, storyline_detail_modify_prompt, "agent")
 
     response = ""
-    for chunk in stream_response:
-        print(chunk.content, end="", flush=True)
-        await asyncio.sleep(0)  # 让出控制权，允许事件循环处理其他任务
-        await web_socket.send_text(str(chunk.content))
-        response += chunk.content
+    stream_writer = get_stream_writer(web_socket, "agent")
+    async with aclosing(stream_response):
+        async for chunk in stream_response:
+            print(chunk, end="", flush=True)
+            await stream_writer.write(str(chunk))
+            response += chunk
+    await stream_writer.flush()
 
     stories[-1] = "\n\n" + response
     return {KEY_STORIES: stories}
@@ -633,9 +648,15 @@ async def websocket_endpoint(websocket: WebSocket):
                 print(f"Received message: {request_msg}")
 
                 chat_request_data = StoryLineAgentSchema(**json.loads(request_msg))
-                llm = LLMFactory.get_llm(
-                    mode_type=LLMType.get_enum_from_value(chat_request_data.model_type),
-                    mode_name=chat_request_data.model_name,
+                # 经过调度器排队和限流,和聊天共用provider的并发和速率上限
+                llm = llm_scheduler.bind(
+                    LLMFactory.get_llm(
+                        mode_type=LLMType.get_enum_from_value(chat_request_data.model_type),
+                        mode_name=chat_request_data.model_name,
+                    ),
+                    provider=chat_request_data.model_type,
+                    model=chat_request_data.model_name,
+                    priority=LLMPriority.INTERACTIVE,
                 )
                 inputs = {
                     "llm": llm,
@@ -1,6 +1,6 @@
-import asyncio
 import json
 import os
+from contextlib import aclosing
 from datetime import datetime
 
 from fastapi import APIRouter
@@ -9,9 +9,12 @@ from langgraph.graph import StateGraph
 from starlette.websockets import WebSocket
 from langchain_core.language_models import BaseChatModel
 from models.factory.llm_factory import LLMFactory
+from models.factory.llm_scheduler import LLMPriority, llm_scheduler
 from models.model_type import LLMType
 from schema.agent_schema import TranslationAgentSchema
+from utils.async_utils import astream_llm_content
 from utils.command_constants import CHAT_STREAM_SERVE_DONE
+from utils.stream_writer import get_stream_writer
 
 translate_human_router = APIRouter()
 
@@ -31,9 +34,7 @@ def get_completion(
         ("system", system_message),
         ("user", prompt),
     ]
-    response = llm.stream(messages)
-    for chunk in response:
-        yield chunk.content
+    return astream_llm_content(llm, messages, "agent")
 
 
 # 定义传递的信息结构
@@ -84,11 +85,13 @@ Do not provide any explanations or text apart from the translation.
     print(print_msg)
     await web_socket.send_text(print_msg)
     translation = ""
-    for chunk in completion:
-        print(chunk, end="", flush=True)
-        await asyncio.sleep(0)  # 让出控制权，允许事件循环处理其他任务
-        await web_socket.send_text(str(chunk))
-        translation += chunk
+    stream_writer = get_stream_writer(web_socket, "agent")
+    async with aclosing(completion):
+        async for chunk in completion:
+            print(chunk, end="", flush=True)
+            await stream_writer.write(str(chunk))
+            translation += chunk
+    await stream_writer.flush()
 
     return {"translation_1": translation}
 
@@ -140,11 +143,13 @@ Output only the suggestions and nothing else."""
     await web_socket.send_text(print_msg)
 
     reflection = ""
-    for chunk in completion:
-        print(chunk, end="", flush=True)
-        await asyncio.sleep(0)  # 让出控制权，允许事件循环处理其他任务
-        await web_socket.send_text(str(chunk))
-        reflection += chunk
+    stream_writer = get_stream_writer(web_socket, "agent")
+    async with aclosing(completion):
+        async for chunk in completion:
+            print(chunk, end="", flush=True)
+            await stream_writer.write(str(chunk))
+            reflection += chunk
+    await stream_writer.flush()
 
     return {"reflection": reflection}
 
@@ -215,11 +220,13 @@ Output only the new translation and nothing else."""
     await web_socket.send_text(print_msg)
 
     translation_2 = ""
-    for chunk in completion:
-        print(chunk, end="", flush=True)
-        await asyncio.sleep(0)  # 让出控制权，允许事件循环处理其他任务
-        await web_socket.send_text(str(chunk))
-        translation_2 += chunk
+    stream_writer = get_stream_writer(web_socket, "agent")
+    async with aclosing(completion):
+        async for chunk in completion:
+            print(chunk, end="", flush=True)
+            await stream_writer.write(str(chunk))
+            translation_2 += chunk
+    await stream_writer.flush()
 
     await web_socket.send_text(CHAT_STREAM_SERVE_DONE)
     return {"translation_2": translation_2}
@@ -301,9 +308,15 @@ async def websocket_endpoint(websocket: WebSocket):
                 print(f"Received message: {request_msg}")
 
                 chat_request_data = TranslationAgentSchema(**json.loads(request_msg))
-                llm = LLMFactory.get_llm(
-                    mode_type=LLMType.get_enum_from_value(chat_request_data.model_type),
-                    mode_name=chat_request_data.model_name,
+                # 经过调度器排队和限流,和聊天共用provider的并发和速率上限
+                llm = llm_scheduler.bind(
+                    LLMFactory.get_llm(
+                        mode_type=LLMType.get_enum_from_value(chat_request_data.model_type),
+                        mode_name=chat_request_data.model_name,
+                    ),
+                    provider=chat_request_data.model_type,
+                    model=chat_request_data.model_name,
+                    priority=LLMPriority.INTERACTIVE,
                 )
                 inputs = {
                     "llm": llm,
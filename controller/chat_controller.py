@@ -2,24 +2,46 @@ import asyncio
 import json
 import time
 import traceback
-from typing import List
+from typing import List, Optional
 
 from fastapi import APIRouter
+from langchain_core.messages import AIMessageChunk
 from langfuse.decorators import observe, langfuse_context
 from pydantic import BaseModel
 from starlette.websockets import WebSocket, WebSocketState, WebSocketDisconnect
 
-from controller.question_prompt import generate_follow_questions
-from dao.redis_dao import ChatRedisManager
+from controller.chat_history_window import (
+    build_history_window,
+    schedule_history_summary,
+)
+from config.base_config import BaseConfiguration
+from controller.question_prompt import schedule_follow_questions
+from dao.redis_dao import get_chat_redis_manager
 from models.factory.llm_factory import LLMFactory
+from models.factory.llm_hedge import HedgedStream, llm_hedge
+from models.factory.llm_scheduler import LLMRateLimitError, llm_scheduler
 from models.model_type import LLMType
 from schema.chat_schema import ChatRequestData
-from utils.command_constants import CHAT_STREAM_CLIENT_STOP, CHAT_STREAM_SERVE_DONE
+from utils.command_constants import CHAT_STREAM_SERVE_DONE
 from utils.log_utils import LogUtils
+from utils.metrics import record_llm_cancelled, record_llm_stream
+from utils.semantic_cache import (
+    build_cache_key,
+    get_chat_embed_model,
+    is_semantic_cache_enabled,
+    semantic_cache,
+)
+from utils.stream_writer import StreamClosedError, get_stream_writer
+from utils.token_utils import estimate_tokens
+from utils.ws_connection import STREAM_STOPPED, WebsocketConnection
 
 chat_router = APIRouter()
 
-chat_manager = ChatRedisManager()
+chat_manager = get_chat_redis_manager()
+
+_history_config = BaseConfiguration().get_chat_history_config()
+
+RATE_LIMIT_MESSAGE = "当前模型请求过多,请稍后再试或者切换其他模型"
 
 
 def generate_image_content(data: str, image_urls: List[str]) -> list:
@@ -35,55 +57,133 @@ def generate_image_content(data: str, image_urls: List[str]) -> list:
     return data_list
 
 
+async def cached_response_stream(answer: str):
+    """命中语义缓存时,把缓存的回答当作模型的流式输出返回"""
+    yield AIMessageChunk(content=answer)
+
+
 @observe()
 async def send_streaming_data(
-    chat_request_data, websocket, response, llm, COMMAND_DONE_FROM_SERVE=None
+    chat_request_data,
+    websocket,
+    response,
+    llm,
+    save_inputs_task=None,
+    semantic_cache_key=None,
+    cache_hit=False,
+    COMMAND_DONE_FROM_SERVE=None,
+    connection: WebsocketConnection = None,
 ):
     final_result = ""
+    first_token_time = None
+    completed = False
+    # 提前关闭模型流的原因,正常结束时为None
+    cancel_reason = None
     start_time = time.time()
     LogUtils.log_info(f"start_time: {start_time}")
+    stream_writer = get_stream_writer(websocket, "chat")
 
     try:
-        for chunk in response:
+        # 异步迭代,等待 provider 的时候让出事件循环,其他会话不会被阻塞
+        async for chunk in response:
             delta = chunk.content
             if delta is not None:
-                if final_result == "":
-                    LogUtils.log_info(f"start_stream_time: {time.time() - start_time}")
+                if first_token_time is None:
+                    first_token_time = time.time()
+                    LogUtils.log_info(f"start_stream_time: {first_token_time - start_time}")
 
                 final_result += str(delta)
-                await websocket.send_text(str(delta))
-            await asyncio.sleep(0)  # 让出控制权
+                await stream_writer.write(str(delta))
+        completed = True
+
+        # 只缓存完整的回答,中途停止的不缓存
+        if semantic_cache_key is not None:
+            semantic_cache.add(semantic_cache_key, final_result)
+
+    except asyncio.CancelledError:
+        # 客户端停止或者断开,发送任务被取消
+        cancel_reason = "cancelled"
+        raise
+
+    except StreamClosedError as e:
+        cancel_reason = "client_closed"
+        LogUtils.log_info(f"stop streaming: {e}")
+
+    except LLMRateLimitError as e:
+        LogUtils.log_error(f"llm rate limited: {e}")
+        await stream_writer.write(RATE_LIMIT_MESSAGE)
 
     finally:
+        # 关闭模型的流,客户端断开或者停止之后不再继续读取provider
+        await response.aclose()
+        model_type = chat_request_data.model_type
+        model_name = chat_request_data.model_name
+        if isinstance(response, HedgedStream):
+            # 对冲请求以实际输出内容的模型为准
+            model_type, model_name = response.provider, response.model
+        if not cache_hit and first_token_time is not None:
+            record_llm_stream(
+                endpoint="chat",
+                provider=model_type,
+                model=model_name,
+                first_token_seconds=first_token_time - start_time,
+                tokens=estimate_tokens(final_result),
+                stream_seconds=time.time() - first_token_time,
+                completed=completed,
+            )
+        if not cache_hit and cancel_reason is not None:
+            partial_tokens = estimate_tokens(final_result)
+            saved_tokens = record_llm_cancelled(
+                "chat", model_type, model_name, partial_tokens, cancel_reason
+            )
+            LogUtils.log_info(
+                f"chat stream {cancel_reason}: keep {partial_tokens} tokens, "
+                f"about {saved_tokens} tokens saved"
+            )
+
+        # 中途停止的回答也保存,下一轮对话可以接着问
         outputs = [
             {
                 "role": "assistant",
                 "content": final_result,
-                "model_name": chat_request_data.model_name,
+                "model_name": model_name,
             }
         ]
-        chat_manager.add_chat_record(
+        if save_inputs_task is not None:
+            # 提问先落库,保证回复排在提问之后
+            await save_inputs_task
+        await chat_manager.add_chat_record(
             chat_request_data.user_name, chat_request_data.session_id, outputs
         )
-        follow_questions = generate_follow_questions(
-            chat_request_data.data, final_result
-        )
+        if chat_request_data.multi_turn_chat_enabled:
+            schedule_history_summary(
+                chat_request_data.user_name,
+                chat_request_data.session_id,
+                chat_request_data.model_name,
+            )
         LogUtils.log_info(f"end_stream_time: {time.time() - start_time}")
-        if websocket.client_state == WebSocketState.CONNECTED:
+        if (
+            websocket.client_state == WebSocketState.CONNECTED
+            and not stream_writer.closed
+        ):
+            await stream_writer.flush()
             await websocket.send_text(CHAT_STREAM_SERVE_DONE)
 
-            await websocket.send_text(follow_questions)
-
-
-def get_chat_history(user_name, session_id):
-    history = chat_manager.get_history_record(user_name, session_id)
-    LogUtils.log_info("history:")
-    LogUtils.log_info(history)
-    return history
+            if chat_request_data.follow_questions_enabled:
+                schedule_follow_questions(
+                    websocket,
+                    chat_request_data.data,
+                    final_result,
+                    chat_request_data.follow_questions_timeout,
+                    chat_request_data.follow_questions_json,
+                    connection,
+                )
 
 
 @observe()
-async def perform_chat(websocket, chat_request_data: ChatRequestData):
+async def perform_chat(
+    websocket, chat_request_data: ChatRequestData, connection: WebsocketConnection
+):
     langfuse_context.update_current_trace(
         name=chat_request_data.user_name,
         user_id=chat_request_data.session_id,
@@ -106,61 +206,95 @@ async def perform_chat(websocket, chat_request_data: ChatRequestData):
             {"role": "user", "content": images_content},
         ]
 
-    chat_manager.add_chat_record(
-        chat_request_data.user_name, chat_request_data.session_id, inputs
-    )
-
     if chat_request_data.multi_turn_chat_enabled:
-        history = get_chat_history(
-            chat_request_data.user_name, chat_request_data.session_id
+        # 按模型的token预算截取历史记录,更早的消息用摘要代替
+        history = await build_history_window(
+            chat_request_data.user_name,
+            chat_request_data.session_id,
+            inputs,
+            chat_request_data.model_name,
         )
     else:
         history = inputs
 
-    # response = llm.stream(history)
-    response = llm.stream(history, config={"callbacks": [langfuse_handler]})
+    semantic_cache_key = None
+    cached_entry = None
+    # 多轮对话和图片的回答依赖上下文,不使用语义缓存
+    if (
+        chat_request_data.semantic_cache_enabled
+        and is_semantic_cache_enabled()
+        and not chat_request_data.multi_turn_chat_enabled
+        and not chat_request_data.image_urls
+    ):
+        semantic_cache_key = await build_cache_key(
+            chat_request_data.data,
+            embed_model=await asyncio.to_thread(get_chat_embed_model),
+            endpoint="chat",
+            model_type=chat_request_data.model_type,
+            model_name=chat_request_data.model_name,
+        )
+        cached_entry = semantic_cache.lookup(semantic_cache_key)
+
+    # 保存提问和大模型的流式输出同时进行
+    save_inputs_task = asyncio.create_task(
+        chat_manager.add_chat_record(
+            chat_request_data.user_name, chat_request_data.session_id, inputs
+        )
+    )
+
+    if cached_entry is not None:
+        response = cached_response_stream(cached_entry.answer)
+        semantic_cache_key = None
+    else:
+        # response = llm.stream(history)
+        # 经过调度器排队和限流,provider的并发和速率不会超过配置
+        stream_llm = llm_hedge if chat_request_data.hedge_enabled else llm_scheduler
+        response = stream_llm.astream(
+            llm,
+            history,
+            provider=chat_request_data.model_type,
+            model=chat_request_data.model_name,
+            config={"callbacks": [langfuse_handler]},
+        )
     LogUtils.log_info("response :", response)
     send_task = asyncio.create_task(
-        send_streaming_data(chat_request_data, websocket, response, llm)
+        send_streaming_data(
+            chat_request_data,
+            websocket,
+            response,
+            llm,
+            save_inputs_task,
+            semantic_cache_key,
+            cached_entry is not None,
+            connection=connection,
+        )
     )
 
-    while not send_task.done():
-        try:
-            # LogUtils.log_info("waiting for message")
-            request_msg = await asyncio.wait_for(websocket.receive_text(), timeout=1.0)
-            LogUtils.log_info("receive new text: ", request_msg)
-            if CHAT_STREAM_CLIENT_STOP in request_msg:
-                LogUtils.log_info("receive stop command")
-                send_task.cancel()  # 取消发送任务
-                await asyncio.gather(
-                    send_task, return_exceptions=True
-                )  # 等待任务完成或被取消
-                LogUtils.log_info("send_stop_flag")
-                stop_flag = '<span style="color: #5989F7;"><br><br>[[客户端停止接收信息]]<br><br></span>'
-                await websocket.send_text(stop_flag)
-                break
-        except asyncio.TimeoutError:
-            # 没有接收到消息，继续循环
-            continue
-        except WebSocketDisconnect:
-            LogUtils.log_info("Client disconnected")
-            break
+    stream_result = await connection.wait_streaming(send_task)
+    if stream_result == STREAM_STOPPED:
+        LogUtils.log_info("send_stop_flag")
+        stop_flag = '<span style="color: #5989F7;"><br><br>[[客户端停止接收信息]]<br><br></span>'
+        await websocket.send_text(stop_flag)
 
 
 @observe()
 @chat_router.websocket("/ws/chat")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
+    connection = WebsocketConnection(websocket, "chat")
+    connection.start()
     try:
         LogUtils.log_info("connection open ", websocket.client)
         while True:
             try:
-                request_msg = await websocket.receive_text()
+                request_msg = await connection.receive_request()
+                if request_msg is None:
+                    break
                 LogUtils.log_info("request_msg: ", request_msg)
 
                 chat_request_data = ChatRequestData(**json.loads(request_msg))
 
-                await perform_chat(websocket, chat_request_data)
+                await perform_chat(websocket, chat_request_data, connection)
 
             except WebSocketDisconnect:
                 LogUtils.log_info("Client disconnected")
@@ -176,6 +310,7 @@ async def websocket_endpoint(websocket: WebSocket):
     except Exception as e:
         LogUtils.log_error(f"Error: {e}")
     finally:
+        await connection.close()
         if websocket.client_state != WebSocketState.DISCONNECTED:
             try:
                 await websocket.close()
@@ -184,15 +319,28 @@ async def websocket_endpoint(websocket: WebSocket):
         LogUtils.log_info("Connection closed")
 
 
+def _get_page_size(limit: int) -> int:
+    return min(max(1, limit), _history_config["max_page_size"])
+
+
 class HistorySnapshots(BaseModel):
     user_name: str
+    # 分页: 返回session_id小于cursor的最近limit个会话,没有limit时返回全部会话
+    cursor: Optional[int] = None
+    limit: Optional[int] = None
 
 
 @chat_router.post("/chat/history/snapshots")
 async def get_history_snapshots(request: HistorySnapshots):
     LogUtils.log_info("get_history_snapshots")
     LogUtils.log_info("user_name: ", request)
-    return chat_manager.get_history_snapshots(request.user_name)
+    if request.limit is None:
+        return await chat_manager.get_history_snapshots(request.user_name)
+
+    snapshots, next_cursor = await chat_manager.get_history_snapshots_page(
+        request.user_name, request.cursor, _get_page_size(request.limit)
+    )
+    return {"snapshots": snapshots, "next_cursor": next_cursor}
 
 
 class HistoryRecord(BaseModel):
@@ -200,11 +348,28 @@ class HistoryRecord(BaseModel):
     session_id: int
 
 
+class HistoryRecordPage(HistoryRecord):
+    # 分页: 返回时间戳小于cursor的最近limit条消息,不传cursor就是最后limit条,没有limit时返回全部
+    cursor: Optional[float] = None
+    limit: Optional[int] = None
+
+
 @chat_router.post("/chat/history/record")
-async def get_history_record(request: HistoryRecord):
-    return chat_manager.get_history_record(request.user_name, request.session_id)
+async def get_history_record(request: HistoryRecordPage):
+    if request.limit is None:
+        return await chat_manager.get_history_record(
+            request.user_name, request.session_id
+        )
+
+    messages, next_cursor = await chat_manager.get_history_page(
+        request.user_name,
+        request.session_id,
+        request.cursor,
+        _get_page_size(request.limit),
+    )
+    return {"messages": messages, "next_cursor": next_cursor}
 
 
 @chat_router.post("/chat/history/delete")
 async def delete_history_record(request: HistoryRecord):
-    return chat_manager.delete_chat_record(request.user_name, request.session_id)
+    return await chat_manager.delete_chat_record(request.user_name, request.session_id)
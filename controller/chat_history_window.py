@@ -0,0 +1,267 @@
+import asyncio
+from typing import List
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+from config.base_config import BaseConfiguration
+from dao.redis_dao import ChatSummaryModel, get_chat_redis_manager
+from models.factory.llm_factory import LLMFactory
+from models.factory.llm_scheduler import LLMPriority, llm_scheduler
+from models.model_type import LLMType
+from utils.log_utils import LogUtils
+from utils.token_utils import estimate_tokens
+
+HISTORY_SUMMARY_PROMPT = """
+    你是一个擅长总结对话的助手,请把之前的对话摘要和新的对话内容合并成一份新的摘要
+    保留用户的关键信息,偏好,已经确定的结论和还没有解决的问题,不要编造内容
+    摘要使用简体中文,不超过{max_words}个字,直接输出摘要,不要回复其他内容
+
+    之前的摘要:
+    {summary}
+
+    新的对话内容:
+    {messages}
+
+    新的摘要:
+"""
+
+SUMMARY_SYSTEM_TEMPLATE = "下面是之前对话的摘要,回答问题时可以参考:\n{summary}"
+
+# 图片按低分辨率的token数估算
+IMAGE_TOKENS = 85
+# 每条消息角色等格式的开销
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_history_config = BaseConfiguration().get_chat_history_config()
+
+summary_llm = LLMFactory.get_llm(LLMType.ZHIPU, "GLM-4-Flash")
+
+chat_manager = get_chat_redis_manager()
+
+# 每个会话正在执行的摘要任务,同时保持引用,否则可能在执行完之前被回收
+_summary_tasks: dict[tuple[str, int], asyncio.Task] = {}
+# 任务执行期间又请求了摘要的会话 -> 最新的模型
+_summary_reruns: dict[tuple[str, int], str] = {}
+
+
+def _get_message_text(msg: dict) -> str:
+    content = msg["content"]
+    if isinstance(content, list):
+        return " ".join(
+            item["text"] if item["type"] == "text" else "[图片]" for item in content
+        )
+    return str(content)
+
+
+def estimate_message_tokens(msg: dict) -> int:
+    content = msg["content"]
+    if isinstance(content, list):
+        tokens = sum(
+            estimate_tokens(item["text"]) if item["type"] == "text" else IMAGE_TOKENS
+            for item in content
+        )
+    else:
+        tokens = estimate_tokens(str(content))
+    return tokens + MESSAGE_OVERHEAD_TOKENS
+
+
+def get_model_token_budget(model_name: str) -> int:
+    model_budgets = _history_config.get("model_token_budget", {})
+    return model_budgets.get(model_name, _history_config["default_token_budget"])
+
+
+def _split_window(entries: List[tuple[dict, float]], budget: int) -> int:
+    """从最新的消息往前累加,返回放得进预算的第一条消息的下标
+    窗口必须以用户的提问开头,前面多出来的回复也算到窗口外
+    """
+    used = 0
+    start = len(entries)
+    for index in range(len(entries) - 1, -1, -1):
+        used += estimate_message_tokens(entries[index][0])
+        if used > budget:
+            break
+        start = index
+
+    while start < len(entries) and entries[start][0]["role"] != "user":
+        start += 1
+    return start
+
+
+def _get_summary_message(summary: ChatSummaryModel) -> List[dict]:
+    if not summary.summary:
+        return []
+    return [
+        {
+            "role": "system",
+            "content": SUMMARY_SYSTEM_TEMPLATE.format(summary=summary.summary),
+        }
+    ]
+
+
+async def build_history_window(
+    user_name: str, session_id: int, inputs: List[dict], model_name: str
+) -> List[dict]:
+    """生成发给模型的历史记录: 摘要 + 预算内最近的消息 + 本次提问
+    超出预算的消息在回复结束后由后台任务折叠进摘要,这里不会等待摘要
+    """
+    entries, summary = await asyncio.gather(
+        chat_manager.get_history_tail(
+            user_name, session_id, _history_config["window_max_messages"]
+        ),
+        chat_manager.get_chat_summary(user_name, session_id),
+    )
+    entries = [entry for entry in entries if entry[1] > summary.summarized_until]
+    summary_messages = _get_summary_message(summary)
+
+    budget = get_model_token_budget(model_name)
+    budget -= sum(estimate_message_tokens(msg) for msg in inputs + summary_messages)
+    start = _split_window(entries, budget)
+    if start > 0:
+        LogUtils.log_info(f"history window skip {start} messages, waiting for summary")
+
+    window = [msg for msg, _ in entries[start:]]
+    LogUtils.log_info(f"history window: {len(window)} messages, summary: {bool(summary_messages)}")
+    return summary_messages + window + inputs
+
+
+def _take_fold_batch(
+    entries: List[tuple[dict, float]], max_messages: int, max_tokens: int
+) -> List[tuple[dict, float]]:
+    """从最早的消息开始取一批,消息数和token数都不超过上限,至少取一条"""
+    batch = []
+    used = 0
+    for entry in entries[:max_messages]:
+        used += estimate_message_tokens(entry[0])
+        if batch and used > max_tokens:
+            break
+        batch.append(entry)
+    return batch
+
+
+async def _fold_batch(
+    summary: ChatSummaryModel,
+    batch: List[tuple[dict, float]],
+    model_name: str,
+) -> ChatSummaryModel:
+    # 单条消息超过一批的上限时截断,摘要的提示词不会超出模型的上下文
+    max_chars = _history_config["summary_batch_tokens"]
+    messages_text = "\n".join(
+        f"{msg['role']}: {_get_message_text(msg)[:max_chars]}" for msg, _ in batch
+    )
+    summary_prompt = ChatPromptTemplate.from_template(HISTORY_SUMMARY_PROMPT)
+    summary_chain = summary_prompt | summary_llm | StrOutputParser()
+    new_summary = await asyncio.wait_for(
+        llm_scheduler.ainvoke(
+            summary_chain,
+            {
+                "summary": summary.summary or "无",
+                "messages": messages_text,
+                "max_words": max(200, int(get_model_token_budget(model_name) * 0.2)),
+            },
+            provider=LLMType.ZHIPU,
+            model="GLM-4-Flash",
+            priority=LLMPriority.BACKGROUND,
+        ),
+        timeout=_history_config["summary_timeout"],
+    )
+    return ChatSummaryModel(summary=new_summary, summarized_until=batch[-1][1])
+
+
+async def update_history_summary(user_name: str, session_id: int, model_name: str):
+    """历史记录超出预算,或者有消息已经不在窗口的读取范围内时,把最早的消息折叠进滚动摘要
+    折叠到预算的summary_keep_ratio,留出余量,不需要每一轮都重新摘要
+    按批折叠,每批之后保存进度,失败或者超时的时候已经完成的批次不会重复
+    """
+    summary, tail = await asyncio.gather(
+        chat_manager.get_chat_summary(user_name, session_id),
+        chat_manager.get_history_tail(
+            user_name, session_id, _history_config["window_max_messages"]
+        ),
+    )
+    tail = [entry for entry in tail if entry[1] > summary.summarized_until]
+    unsummarized = await chat_manager.count_history_entries(
+        user_name, session_id, after=summary.summarized_until
+    )
+
+    budget = get_model_token_budget(model_name)
+    budget -= sum(estimate_message_tokens(msg) for msg in _get_summary_message(summary))
+    over_budget = sum(estimate_message_tokens(msg) for msg, _ in tail) > budget
+    # 窗口只读取最近的window_max_messages条,更早的消息不折叠就丢掉了
+    beyond_window = unsummarized > len(tail)
+    if not over_budget and not beyond_window:
+        return
+
+    if over_budget:
+        keep_start = _split_window(tail, int(budget * _history_config["summary_keep_ratio"]))
+    else:
+        keep_start = 0
+    # 折叠时间戳在keep_before之前的消息
+    keep_before = tail[keep_start][1] if keep_start < len(tail) else float("inf")
+
+    folded_count = 0
+    for _ in range(_history_config["summary_max_batches"]):
+        entries = await chat_manager.get_history_entries(
+            user_name,
+            session_id,
+            after=summary.summarized_until,
+            limit=_history_config["summary_batch_messages"],
+        )
+        entries = [entry for entry in entries if entry[1] < keep_before]
+        batch = _take_fold_batch(
+            entries,
+            _history_config["summary_batch_messages"],
+            _history_config["summary_batch_tokens"],
+        )
+        if not batch:
+            break
+        summary = await _fold_batch(summary, batch, model_name)
+        await chat_manager.save_chat_summary(user_name, session_id, summary)
+        folded_count += len(batch)
+
+    if folded_count:
+        LogUtils.log_info(f"history summary folded {folded_count} messages")
+
+
+async def _update_history_summary_safely(
+    user_name: str, session_id: int, model_name: str
+):
+    try:
+        await update_history_summary(user_name, session_id, model_name)
+    except asyncio.TimeoutError:
+        LogUtils.log_info("history summary timeout")
+    except Exception as e:
+        LogUtils.log_error(f"history summary error: {e}")
+
+
+async def _run_history_summary(user_name: str, session_id: int, model_name: str):
+    key = (user_name, session_id)
+    while True:
+        await _update_history_summary_safely(user_name, session_id, model_name)
+        # 执行期间又有新的一轮对话,用最新的模型再检查一次
+        model_name = _summary_reruns.pop(key, None)
+        if model_name is None:
+            return
+
+
+def schedule_history_summary(
+    user_name: str, session_id: int, model_name: str
+) -> asyncio.Task:
+    """在后台更新滚动摘要,不影响下一轮的首字延迟
+    同一个会话同时只有一个任务,避免并发折叠互相覆盖摘要
+    """
+    key = (user_name, session_id)
+    task = _summary_tasks.get(key)
+    if task is not None and not task.done():
+        _summary_reruns[key] = model_name
+        return task
+
+    task = asyncio.create_task(_run_history_summary(user_name, session_id, model_name))
+    _summary_tasks[key] = task
+
+    def _discard(done_task: asyncio.Task):
+        if _summary_tasks.get(key) is done_task:
+            del _summary_tasks[key]
+
+    task.add_done_callback(_discard)
+    return task
@@ -0,0 +1,10 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+metrics_router = APIRouter()
+
+
+@metrics_router.get("/metrics")
+def get_metrics():
+    """Prometheus 拉取指标"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
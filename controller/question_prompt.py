@@ -1,9 +1,17 @@
+import asyncio
+import json
+from typing import Optional
+
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
+from starlette.websockets import WebSocket, WebSocketDisconnect, WebSocketState
 
 from models.factory.llm_factory import LLMFactory
+from models.factory.llm_scheduler import LLMPriority, llm_scheduler
 from models.model_type import LLMType
+from utils.command_constants import CHAT_FOLLOW_QUESTIONS
 from utils.log_utils import LogUtils
+from utils.ws_connection import WebsocketConnection
 
 SUGGEST_QUESTION_PROMPT = """
     你是一个善于引导用户思维的专家,请根据用户的提问,和对应的回答,提出{number}个相关的引导问题
@@ -26,12 +34,72 @@ SUGGEST_QUESTION_PROMPT = """
 
 follow_question_llm = LLMFactory.get_llm(LLMType.ZHIPU, "GLM-4-Flash")
 
+# 后台任务需要保持引用,否则可能在执行完之前被回收
+_follow_question_tasks = set()
+
 
-def generate_follow_questions(ask: str, reply: str):
+async def agenerate_follow_questions(ask: str, reply: str):
     suggest_prompt = ChatPromptTemplate.from_template(SUGGEST_QUESTION_PROMPT)
     suggest_chain = suggest_prompt | follow_question_llm | StrOutputParser()
-    follow_questions = suggest_chain.invoke(
-        {"number": 3, "ask": ask, "ai_answer": reply}
+    follow_questions = await llm_scheduler.ainvoke(
+        suggest_chain,
+        {"number": 3, "ask": ask, "ai_answer": reply},
+        provider=LLMType.ZHIPU,
+        model="GLM-4-Flash",
+        priority=LLMPriority.BACKGROUND,
     )
     LogUtils.log_info(f"follow_questions: {follow_questions}")
     return follow_questions
+
+
+async def send_follow_questions(
+    websocket: WebSocket, ask: str, reply: str, timeout: float, as_json: bool = False
+):
+    """生成引导问题,在结束信号之后作为单独的一帧发送,超时或者失败就放弃
+    默认和之前一样发送原始文本, as_json为true时发送 {chat_follow_questions: ...}
+    用户开始下一轮提问时任务会被取消,原始文本不会混进下一轮的回答
+    """
+    try:
+        follow_questions = await asyncio.wait_for(
+            agenerate_follow_questions(ask, reply), timeout=timeout
+        )
+    except asyncio.TimeoutError:
+        LogUtils.log_info(f"follow_questions timeout: {timeout} seconds")
+        return
+    except Exception as e:
+        LogUtils.log_error(f"follow_questions error: {e}")
+        return
+
+    if websocket.client_state != WebSocketState.CONNECTED:
+        return
+    message = (
+        json.dumps({CHAT_FOLLOW_QUESTIONS: follow_questions})
+        if as_json
+        else follow_questions
+    )
+    try:
+        await websocket.send_text(message)
+    except (WebSocketDisconnect, RuntimeError) as e:
+        # 检查状态之后,发送之前连接可能已经断开
+        LogUtils.log_info(f"follow_questions not sent, websocket closed: {e}")
+
+
+def schedule_follow_questions(
+    websocket: WebSocket,
+    ask: str,
+    reply: str,
+    timeout: float,
+    as_json: bool = False,
+    connection: Optional[WebsocketConnection] = None,
+) -> asyncio.Task:
+    """在后台生成引导问题,不阻塞结束信号和用户的下一轮提问
+    connection收到新的请求时取消还没发送的引导问题
+    """
+    task = asyncio.create_task(
+        send_follow_questions(websocket, ask, reply, timeout, as_json)
+    )
+    _follow_question_tasks.add(task)
+    task.add_done_callback(_follow_question_tasks.discard)
+    if connection is not None:
+        connection.add_turn_task(task)
+    return task
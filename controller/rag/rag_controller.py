@@ -3,20 +3,23 @@ import json
 import time
 import traceback
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Response
 from langfuse.decorators import observe, langfuse_context
+from llama_index.core import Settings
 from llama_index.core.vector_stores import MetadataFilters, ExactMatchFilter
 from starlette.websockets import WebSocket, WebSocketState, WebSocketDisconnect
 
-from controller.question_prompt import generate_follow_questions
+from config.base_config import BaseConfiguration
+from controller.question_prompt import schedule_follow_questions
 from controller.rag.request_type import (
     UserNameRequest,
     FileIdKnowledgeRequest,
     FileIdChunkRequest,
 )
 from dao.knowledge_dao import KnowledgeDao
-from dao.redis_dao import ChatRedisManager
+from dao.redis_dao import get_chat_redis_manager
 from rag.rag_base_manager import RagBaseManager, check_image_node
+from rag.rag_manager_registry import rag_manager_registry
 from schema.chat_schema import ChatRequestData
 from schema.frontend_node import (
     FrontendNodesPayload,
@@ -26,14 +29,27 @@ from schema.frontend_node import (
 from schema.rag_config import RagFrontendConfig
 from utils.command_constants import *
 from utils.log_utils import LogUtils
+from utils.metrics import (
+    get_llm_provider_label,
+    record_llm_cancelled,
+    record_llm_stream,
+)
+from utils.semantic_cache import (
+    build_cache_key,
+    is_semantic_cache_enabled,
+    semantic_cache,
+)
+from utils.stream_writer import StreamClosedError, get_stream_writer
+from utils.token_utils import estimate_tokens
+from utils.ws_connection import STREAM_STOPPED, WebsocketConnection
 
 rag_router = APIRouter()
 
 knowledge_dao = KnowledgeDao()
 
-rag_base_manager = RagBaseManager()
+chat_manager = get_chat_redis_manager()
 
-chat_manager = ChatRedisManager()
+_history_config = BaseConfiguration().get_chat_history_config()
 
 
 @rag_router.post("/rag/knowledge/query_all")
@@ -52,10 +68,10 @@ def query_nodes_by_file_id(file: FileIdKnowledgeRequest):
     from rag.db.milvus.client import MyMilvusClient
 
     client = MyMilvusClient()
-
-    return client.search_nodes_from_file_id(
-        collect_name=rag_base_manager.get_collection_name(), file_id=file.file_id
-    )
+    with rag_manager_registry.use_manager(file.rag_tenant) as rag_manager:
+        return client.search_nodes_from_file_id(
+            collect_name=rag_manager.get_collection_name(), file_id=file.file_id
+        )
 
 
 @rag_router.post("/rag/vector/query_match_chunk")
@@ -68,9 +84,10 @@ def query_chunk_by_file_id(file: FileIdChunkRequest):
         filters=[ExactMatchFilter(key="file_id", value=file.file_id)]
     )
 
-    retrieve_nodes, cost_time = rag_base_manager.retrieve_chunk(
-        query=file.query, filters=filters
-    )
+    with rag_manager_registry.use_manager(file.rag_tenant) as rag_manager:
+        retrieve_nodes, cost_time = rag_manager.retrieve_chunk(
+            query=file.query, filters=filters
+        )
 
     frontend_nodes = []
     for node in retrieve_nodes:
@@ -78,10 +95,30 @@ def query_chunk_by_file_id(file: FileIdChunkRequest):
     return frontend_nodes
 
 
+@rag_router.get("/rag/ready")
+async def rag_ready(response: Response):
+    """就绪检查,同时返回已经加载的租户"""
+    status = rag_manager_registry.readiness()
+    if not status["ready"]:
+        response.status_code = 503
+    return status
+
+
 @observe()
-async def send_streaming_data(chat_request_data, parse_question, websocket, all_nodes):
+async def send_streaming_data(
+    chat_request_data,
+    parse_question,
+    websocket,
+    all_nodes,
+    cached_answer=None,
+    semantic_cache_key=None,
+    nodes_payload_json=None,
+    rag_manager: RagBaseManager = None,
+    connection: WebsocketConnection = None,
+):
     """用解析之后的问题去问大模型
     聊天记录也保存解析后的,后续解析更好的理解意图,不能用原始的问题,不然一直迭代,问题会越来越偏
+    命中语义缓存时直接发送缓存的回答
     """
     start_time = time.time()
     # 4.1 send generate start flag ,not need ,auto
@@ -91,23 +128,72 @@ async def send_streaming_data(chat_request_data, parse_question, websocket, all_
     await asyncio.sleep(0)
 
     # 4.3 generate stream
-    stream_response = rag_base_manager.generate_chat_stream_response(
-        parse_question, all_nodes
-    )
+    if cached_answer is not None:
+        response_gen = cached_response_gen(cached_answer)
+    else:
+        stream_response = await rag_manager.agenerate_chat_stream_response(
+            parse_question, all_nodes
+        )
+        response_gen = stream_response.response_gen
     final_result = ""
+    first_token_time = None
+    completed = False
+    cancel_reason = None
+    stream_writer = get_stream_writer(websocket, "rag")
     try:
-        for chunk in stream_response.response_gen:
+        async for chunk in response_gen:
             if chunk is not None:
+                if first_token_time is None:
+                    first_token_time = time.time()
                 final_result += str(chunk)
-                await websocket.send_text(str(chunk))
-            await asyncio.sleep(0)  # 让出控制权
+                await stream_writer.write(str(chunk))
+        completed = True
+
+        # 只缓存完整的回答,中途停止的不缓存
+        if semantic_cache_key is not None:
+            semantic_cache.add(semantic_cache_key, final_result, nodes_payload_json)
+        if cached_answer is None:
+            rag_manager.observe_stage("generate", start_time)
+
+    except asyncio.CancelledError:
+        # 客户端停止或者断开,发送任务被取消
+        cancel_reason = "cancelled"
+        raise
+
+    except StreamClosedError as e:
+        cancel_reason = "client_closed"
+        LogUtils.log_info(f"stop streaming: {e}")
 
     finally:
-        inputs = [{"role": "user", "content": parse_question}]
-        chat_manager.add_chat_record(
-            chat_request_data.user_name, chat_request_data.session_id, inputs
-        )
+        # 关闭合成器的生成器,里面的llm流和provider的http响应跟着关闭
+        if hasattr(response_gen, "aclose"):
+            await response_gen.aclose()
+
+        if cached_answer is None and first_token_time is not None:
+            record_llm_stream(
+                endpoint="rag",
+                provider=get_llm_provider_label(Settings.llm),
+                model=Settings.llm.metadata.model_name,
+                first_token_seconds=first_token_time - start_time,
+                tokens=estimate_tokens(final_result),
+                stream_seconds=time.time() - first_token_time,
+                completed=completed,
+            )
+        if cached_answer is None and cancel_reason is not None:
+            partial_tokens = estimate_tokens(final_result)
+            saved_tokens = record_llm_cancelled(
+                "rag",
+                get_llm_provider_label(Settings.llm),
+                Settings.llm.metadata.model_name,
+                partial_tokens,
+                cancel_reason,
+            )
+            LogUtils.log_info(
+                f"rag stream {cancel_reason}: keep {partial_tokens} tokens, "
+                f"about {saved_tokens} tokens saved"
+            )
 
+        inputs = [{"role": "user", "content": parse_question}]
         outputs = [
             {
                 "role": "assistant",
@@ -115,32 +201,67 @@ async def send_streaming_data(chat_request_data, parse_question, websocket, all_
                 "model_name": "",
             }
         ]
-        chat_manager.add_chat_record(
-            chat_request_data.user_name, chat_request_data.session_id, outputs
+        await chat_manager.add_chat_record(
+            chat_request_data.user_name, chat_request_data.session_id, inputs + outputs
         )
 
-        follow_questions = generate_follow_questions(parse_question, final_result)
         LogUtils.log_info(f"end_stream_time: {time.time() - start_time}")
 
-        if websocket.client_state == WebSocketState.CONNECTED:
+        if (
+            websocket.client_state == WebSocketState.CONNECTED
+            and not stream_writer.closed
+        ):
+            await stream_writer.flush()
             await websocket.send_text(CHAT_STREAM_SERVE_DONE)
-            await websocket.send_text(follow_questions)
 
+            if chat_request_data.follow_questions_enabled:
+                schedule_follow_questions(
+                    websocket,
+                    parse_question,
+                    final_result,
+                    chat_request_data.follow_questions_timeout,
+                    chat_request_data.follow_questions_json,
+                    connection,
+                )
+
+
+async def cached_response_gen(answer: str):
+    yield answer
 
-def get_chat_history(user_name, session_id):
-    history = chat_manager.get_history_record(user_name, session_id)
+
+async def get_chat_history(user_name, session_id):
+    # 解析上下文只需要最近的对话
+    entries = await chat_manager.get_history_tail(
+        user_name, session_id, _history_config["window_max_messages"]
+    )
+    history = [msg for msg, _ in entries] or None
     LogUtils.log_info("history:")
     LogUtils.log_info(history)
     return history
 
 
 @observe()
-async def perform_chat(websocket, chat_request_data: ChatRequestData):
+async def perform_chat(
+    websocket, chat_request_data: ChatRequestData, connection: WebsocketConnection
+):
     langfuse_context.update_current_trace(
         name=chat_request_data.user_name,
         user_id=chat_request_data.session_id,
     )
 
+    # 租户第一次使用时才加载向量模型和连接向量库,回答发送完之前不会被回收
+    async with rag_manager_registry.ause_manager(
+        chat_request_data.rag_tenant
+    ) as rag_manager:
+        await answer_question(websocket, chat_request_data, connection, rag_manager)
+
+
+async def answer_question(
+    websocket,
+    chat_request_data: ChatRequestData,
+    connection: WebsocketConnection,
+    rag_manager,
+):
     rag_config = RagFrontendConfig(**chat_request_data.model_dump())
     LogUtils.log_info("rag_config =", rag_config)
 
@@ -148,10 +269,10 @@ async def perform_chat(websocket, chat_request_data: ChatRequestData):
     await websocket.send_text(RAG_PARSE_QUESTION_START)
     await asyncio.sleep(0)
     if chat_request_data.rag_multi_turn_chat_enabled:
-        history = get_chat_history(
+        history = await get_chat_history(
             chat_request_data.user_name, chat_request_data.session_id
         )
-        parse_question, parse_cost_time = rag_base_manager.parse_context_question(
+        parse_question, parse_cost_time = await rag_manager.aparse_context_question(
             origin_query=chat_request_data.data, context=history
         )
 
@@ -167,12 +288,36 @@ async def perform_chat(websocket, chat_request_data: ChatRequestData):
         json.dumps({"rag_parse_context_question": parse_send_text})
     )
 
+    semantic_cache_key = None
+    if chat_request_data.semantic_cache_enabled and is_semantic_cache_enabled():
+        # 用解析后的问题查缓存,多轮对话的上下文已经包含在问题里
+        semantic_cache_key = await build_cache_key(
+            parse_question,
+            collection=rag_manager.get_collection_name(),
+            embed_model=rag_manager.get_embed_model(),
+            endpoint="rag",
+            llm=Settings.llm.metadata.model_name,
+            file_ids=sorted(chat_request_data.rag_file_ids or []),
+            rag_config=rag_config.model_dump(),
+        )
+        # 读取不到知识库的版本号时为None,不确定缓存是否过时,这次不使用缓存
+        cached_entry = (
+            semantic_cache.lookup(semantic_cache_key)
+            if semantic_cache_key is not None
+            else None
+        )
+        if cached_entry is not None:
+            await send_cached_answer(
+                websocket, connection, chat_request_data, parse_question, cached_entry
+            )
+            return
+
     # 1.1 send retrieve start flag
     # await websocket.send_text(RAG_RETRIEVE_CHUNK_START)
     # await asyncio.sleep(0)
 
     # 1.2 retrieve nodes
-    retrieve_nodes, retrieve_cost_time = await rag_base_manager.aretrieve_chunk(
+    retrieve_nodes, retrieve_cost_time = await rag_manager.aretrieve_chunk(
         query=parse_question, rag_config=rag_config
     )
 
@@ -183,7 +328,7 @@ async def perform_chat(websocket, chat_request_data: ChatRequestData):
     # 2.1 send rerank start flag, not need, when retrieve done,auto rerank
 
     # 2.2 rerank nodes
-    rerank_nodes, rerank_cost_time = rag_base_manager.rerank_chunks(
+    rerank_nodes, rerank_cost_time = await rag_manager.arerank_chunks(
         origin_query=parse_question,
         retrieve_nodes=retrieve_nodes,
         rag_config=rag_config,
@@ -211,7 +356,7 @@ async def perform_chat(websocket, chat_request_data: ChatRequestData):
 
         # 3.3 modul llm generate
         image_nodes, image_qa_cost_time = (
-            await rag_base_manager.agenerate_image_nodes_response(
+            await rag_manager.agenerate_image_nodes_response(
                 parse_question, image_nodes
             )
         )
@@ -224,46 +369,70 @@ async def perform_chat(websocket, chat_request_data: ChatRequestData):
     # 4 generate final answer
 
     send_task = asyncio.create_task(
-        send_streaming_data(chat_request_data, parse_question, websocket, all_nodes)
+        send_streaming_data(
+            chat_request_data,
+            parse_question,
+            websocket,
+            all_nodes,
+            semantic_cache_key=semantic_cache_key,
+            nodes_payload_json=nodes_payload_json,
+            rag_manager=rag_manager,
+            connection=connection,
+        )
     )
+    await wait_streaming_data(websocket, connection, send_task)
 
-    while not send_task.done():
-        try:
-            # LogUtils.log_info("waiting for message")
-            request_msg = await asyncio.wait_for(websocket.receive_text(), timeout=1.0)
-            LogUtils.log_info("receive new text: ", request_msg)
-            if CHAT_STREAM_CLIENT_STOP in request_msg:
-                LogUtils.log_info("receive stop command")
-                send_task.cancel()  # 取消发送任务
-                await asyncio.gather(
-                    send_task, return_exceptions=True
-                )  # 等待任务完成或被取消
-                LogUtils.log_info("send_stop_flag")
-                stop_flag = '<span style="color: #5989F7;"><br><br>[[客户端停止接收信息]]<br><br></span>'
-                await websocket.send_text(stop_flag)
-                break
-        except asyncio.TimeoutError:
-            # 没有接收到消息，继续循环
-            continue
-        except WebSocketDisconnect:
-            LogUtils.log_info("Client disconnected")
-            break
+
+async def send_cached_answer(
+    websocket, connection, chat_request_data, parse_question, cached_entry
+):
+    """命中语义缓存,跳过检索,重排序和生成,按原来的协议回放引用片段和回答"""
+    await websocket.send_text(RAG_RETRIEVE_CHUNK_DONE + "0")
+    await websocket.send_text(RAG_RERANK_CHUNK_DONE + "0")
+    if cached_entry.payload:
+        await websocket.send_text(cached_entry.payload)
+    await asyncio.sleep(0)
+
+    send_task = asyncio.create_task(
+        send_streaming_data(
+            chat_request_data,
+            parse_question,
+            websocket,
+            [],
+            cached_answer=cached_entry.answer,
+            connection=connection,
+        )
+    )
+    await wait_streaming_data(websocket, connection, send_task)
+
+
+async def wait_streaming_data(websocket, connection: WebsocketConnection, send_task):
+    """等待回答发送完成,期间处理客户端的停止指令"""
+    stream_result = await connection.wait_streaming(send_task)
+    if stream_result == STREAM_STOPPED:
+        LogUtils.log_info("send_stop_flag")
+        stop_flag = '<span style="color: #5989F7;"><br><br>[[客户端停止接收信息]]<br><br></span>'
+        await websocket.send_text(stop_flag)
 
 
 @observe()
 @rag_router.websocket("/ws/rag/chat_query")
 async def chat_query_websocket(websocket: WebSocket):
     await websocket.accept()
+    connection = WebsocketConnection(websocket, "rag")
+    connection.start()
     try:
         LogUtils.log_info("connection open ", websocket.client)
         while True:
             try:
-                request_msg = await websocket.receive_text()
+                request_msg = await connection.receive_request()
+                if request_msg is None:
+                    break
                 LogUtils.log_info("request_msg: ", request_msg)
 
                 chat_request_data = ChatRequestData(**json.loads(request_msg))
 
-                await perform_chat(websocket, chat_request_data)
+                await perform_chat(websocket, chat_request_data, connection)
 
             except WebSocketDisconnect:
                 LogUtils.log_info("Client disconnected")
@@ -279,6 +448,7 @@ async def chat_query_websocket(websocket: WebSocket):
     except Exception as e:
         LogUtils.log_error(f"Error: {e}")
     finally:
+        await connection.close()
         if websocket.client_state != WebSocketState.DISCONNECTED:
             try:
                 await websocket.close()
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseModel
 
 
@@ -7,11 +9,13 @@ class UserNameRequest(BaseModel):
 
 class FileIdKnowledgeRequest(BaseModel):
     file_id: str
+    rag_tenant: Optional[str] = None
 
 
 class FileIdChunkRequest(BaseModel):
     file_id: str
     query: str
+    rag_tenant: Optional[str] = None
 
 
 class ChatQueryRequest(BaseModel):
@@ -0,0 +1,85 @@
+import time
+from typing import Dict, List
+
+import numpy as np
+from sqlalchemy import BigInteger, Column, Integer, LargeBinary, String
+from sqlalchemy.exc import IntegrityError
+
+from dao.db_config import Base, engine, get_db
+
+# sqlite单条语句的参数个数有上限,IN查询分批
+_QUERY_BATCH_SIZE = 500
+
+
+class ChunkEmbedding(Base):
+    """文档片段的向量,按内容哈希复用,一个(模型, 片段内容)一条"""
+
+    __tablename__ = "chunk_embedding"
+
+    content_hash = Column(
+        String, primary_key=True, comment="sha256(向量模型 + 参与向量化的文本和元数据)"
+    )
+    model_name = Column(String, nullable=False, index=True, comment="向量模型")
+    dim = Column(Integer, nullable=False, comment="向量维度")
+    embedding = Column(LargeBinary, nullable=False, comment="float32的向量")
+    created_at = Column(BigInteger, comment="创建时间")
+
+
+class ChunkEmbeddingDao:
+    """片段向量的持久化缓存,重新入库时没有变化的片段不再调用向量模型"""
+
+    def __init__(self):
+        self._initialize_database()
+
+    def _initialize_database(self):
+        """初始化数据库表"""
+        Base.metadata.create_all(bind=engine)
+
+    def get_embeddings(self, content_hashes: List[str]) -> Dict[str, List[float]]:
+        """返回已经存在的向量, content_hash -> 向量"""
+        result = {}
+        with get_db() as db:
+            for start in range(0, len(content_hashes), _QUERY_BATCH_SIZE):
+                batch = content_hashes[start:start + _QUERY_BATCH_SIZE]
+                rows = (
+                    db.query(ChunkEmbedding.content_hash, ChunkEmbedding.embedding)
+                    .filter(ChunkEmbedding.content_hash.in_(batch))
+                    .all()
+                )
+                for content_hash, embedding in rows:
+                    result[content_hash] = np.frombuffer(
+                        embedding, dtype=np.float32
+                    ).tolist()
+        return result
+
+    def add_embeddings(self, model_name: str, embeddings: Dict[str, List[float]]):
+        """批量写入,同时入库的其他进程已经写入的跳过"""
+        if not embeddings:
+            return
+        now = int(time.time())
+        rows = [
+            ChunkEmbedding(
+                content_hash=content_hash,
+                model_name=model_name,
+                dim=len(embedding),
+                embedding=np.asarray(embedding, dtype=np.float32).tobytes(),
+                created_at=now,
+            )
+            for content_hash, embedding in embeddings.items()
+        ]
+        with get_db() as db:
+            try:
+                db.add_all(rows)
+                db.commit()
+            except IntegrityError:
+                db.rollback()
+                for row in rows:
+                    db.merge(row)
+                db.commit()
+
+    def delete_by_model_name(self, model_name: str) -> int:
+        """更换向量模型之后清理旧模型的向量"""
+        with get_db() as db:
+            count = db.query(ChunkEmbedding).filter_by(model_name=model_name).delete()
+            db.commit()
+            return count
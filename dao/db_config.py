@@ -1,10 +1,12 @@
+import time
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from path_config import SQLALCHEMY_DATABASE_URL
+from utils.metrics import STORAGE_SECONDS
 
 if "sqlite" in SQLALCHEMY_DATABASE_URL:
     engine = create_engine(
@@ -13,6 +15,22 @@ if "sqlite" in SQLALCHEMY_DATABASE_URL:
 else:
     engine = create_engine(SQLALCHEMY_DATABASE_URL, pool_pre_ping=True)
 
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start_time = time.perf_counter()
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """所有sql的耗时按语句类型(select, insert...)统计"""
+    operation = statement.lstrip().split(" ", 1)[0].lower()
+    STORAGE_SECONDS.labels(backend="sql", operation=operation).observe(
+        time.perf_counter() - context._query_start_time
+    )
+
+
 SessionLocal = sessionmaker(
     autocommit=False, autoflush=False, bind=engine, expire_on_commit=False
 )
@@ -3,7 +3,16 @@ import uuid
 from typing import Optional, List
 
 from pydantic import BaseModel, ConfigDict
-from sqlalchemy import Column, BigInteger, Integer, String, Text
+from sqlalchemy import (
+    Column,
+    BigInteger,
+    Integer,
+    String,
+    Text,
+    UniqueConstraint,
+    inspect,
+    text,
+)
 
 from dao.db_config import Base, get_db, engine
 
@@ -12,16 +21,23 @@ class Knowledge(Base):
     """知识库模型定义,一个文件一个对象"""
 
     __tablename__ = "knowledge"
+    # 不同租户可以入库同一个文件,各自一条记录
+    __table_args__ = (
+        UniqueConstraint("user_name", "file_path", name="uq_knowledge_user_file_path"),
+        UniqueConstraint("user_name", "file_id", name="uq_knowledge_user_file_id"),
+    )
 
     id = Column(String, primary_key=True)
     user_name = Column(String, nullable=False, comment="用户名")
-    file_id = Column(String, unique=True, nullable=False, comment="文件id")
-    file_path = Column(Text, unique=True, nullable=False, comment="文件路径")
+    file_id = Column(String, nullable=False, comment="文件id")
+    file_path = Column(Text, nullable=False, comment="文件路径")
     file_name = Column(Text, nullable=False, comment="文件名")
     file_size = Column(BigInteger, comment="文件大小")
     chunk_size = Column(Integer, comment="块大小")
     chunk_overlap = Column(Integer, comment="块重叠")
     file_title = Column(Text, nullable=False, comment="文件标题")
+    content_hash = Column(String, comment="文件内容的sha256")
+    mtime = Column(BigInteger, comment="文件的修改时间(纳秒)")
     updated_at = Column(BigInteger, comment="更新时间")
     created_at = Column(BigInteger, comment="创建时间")
 
@@ -38,12 +54,22 @@ class KnowledgeModel(BaseModel):
     chunk_size: int
     chunk_overlap: int
     file_title: str
+    content_hash: Optional[str] = None
+    mtime: Optional[int] = None
     updated_at: int
     created_at: int
 
     model_config = ConfigDict(from_attributes=True)
 
 
+def _query_by_file_id(db, file_id: str, user_name: Optional[str]):
+    """file_id只在一个租户内唯一,传了用户名时只查这个用户的记录"""
+    query = db.query(Knowledge).filter_by(file_id=file_id)
+    if user_name is not None:
+        query = query.filter_by(user_name=user_name)
+    return query
+
+
 class KnowledgeDao:
     """知识数据访问对象"""
 
@@ -53,6 +79,47 @@ class KnowledgeDao:
     def _initialize_database(self):
         """初始化数据库表"""
         Base.metadata.create_all(bind=engine)
+        self._migrate_columns()
+        self._migrate_unique_constraints()
+
+    @staticmethod
+    def _migrate_columns():
+        """已经存在的表补上后来新增的列, create_all不会修改已有的表"""
+        existing = {
+            column["name"] for column in inspect(engine).get_columns("knowledge")
+        }
+        with engine.begin() as connection:
+            for column in Knowledge.__table__.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(
+                    text(f"ALTER TABLE knowledge ADD COLUMN {column.name} {column_type}")
+                )
+
+    @staticmethod
+    def _migrate_unique_constraints():
+        """之前的表file_path和file_id全局唯一,另一个租户入库同一个文件会覆盖这条记录
+        旧的唯一约束不能直接删除,重建表之后复制数据
+        """
+        unique_columns = [
+            constraint["column_names"]
+            for constraint in inspect(engine).get_unique_constraints("knowledge")
+        ]
+        if ["file_path"] not in unique_columns and ["file_id"] not in unique_columns:
+            return
+
+        columns = ", ".join(column.name for column in Knowledge.__table__.columns)
+        with engine.begin() as connection:
+            connection.execute(text("ALTER TABLE knowledge RENAME TO knowledge_old"))
+            Knowledge.__table__.create(bind=connection)
+            connection.execute(
+                text(
+                    f"INSERT INTO knowledge ({columns}) "
+                    f"SELECT {columns} FROM knowledge_old"
+                )
+            )
+            connection.execute(text("DROP TABLE knowledge_old"))
 
     def add_new_knowledge(
         self,
@@ -64,22 +131,27 @@ class KnowledgeDao:
         file_title: str = None,
         chunk_size: int = None,
         chunk_overlap: int = None,
+        content_hash: str = None,
+        mtime: int = None,
     ) -> Optional[KnowledgeModel]:
         """添加新知识"""
         _file_title = file_name if file_title is None else file_title
         with get_db() as db:
             existing_knowledge = (
-                db.query(Knowledge).filter_by(file_path=file_path).first()
+                db.query(Knowledge)
+                .filter_by(user_name=user_name, file_path=file_path)
+                .first()
             )
             if existing_knowledge:
-                # 如果文件路径已存在，更新知识
-                existing_knowledge.user_name = user_name
+                # 如果这个用户的文件路径已存在，更新知识
                 existing_knowledge.file_id = file_id
                 existing_knowledge.file_name = file_name
                 existing_knowledge.file_size = file_size
                 existing_knowledge.chunk_size = chunk_size
                 existing_knowledge.chunk_overlap = chunk_overlap
                 existing_knowledge.file_title = _file_title
+                existing_knowledge.content_hash = content_hash
+                existing_knowledge.mtime = mtime
                 existing_knowledge.updated_at = int(time.time())
                 db.commit()
                 db.refresh(existing_knowledge)
@@ -96,6 +168,8 @@ class KnowledgeDao:
                     chunk_size=chunk_size,
                     chunk_overlap=chunk_overlap,
                     file_title=_file_title,
+                    content_hash=content_hash,
+                    mtime=mtime,
                     created_at=int(time.time()),
                     updated_at=int(time.time()),
                 )
@@ -129,11 +203,11 @@ class KnowledgeDao:
             ]
 
     def update_knowledge_by_file_id(
-        self, file_id: str, file_title: str
+        self, file_id: str, file_title: str, user_name: str = None
     ) -> Optional[KnowledgeModel]:
         """通过id更新知识"""
         with get_db() as db:
-            knowledge = db.query(Knowledge).filter_by(file_id=file_id).first()
+            knowledge = _query_by_file_id(db, file_id, user_name).first()
             if knowledge:
                 knowledge.file_title = file_title
                 knowledge.updated_at = int(time.time())
@@ -142,10 +216,32 @@ class KnowledgeDao:
                 return KnowledgeModel.model_validate(knowledge)
             return None
 
-    def delete_knowledge_by_file_id(self, file_id: str) -> Optional[KnowledgeModel]:
+    def update_file_state_by_file_id(
+        self,
+        file_id: str,
+        content_hash: str,
+        file_size: int,
+        mtime: int,
+        user_name: str = None,
+    ) -> Optional[KnowledgeModel]:
+        """文件被touch或者复制过,内容没有变化,只更新记录的文件状态"""
+        with get_db() as db:
+            knowledge = _query_by_file_id(db, file_id, user_name).first()
+            if knowledge:
+                knowledge.content_hash = content_hash
+                knowledge.file_size = file_size
+                knowledge.mtime = mtime
+                db.commit()
+                db.refresh(knowledge)
+                return KnowledgeModel.model_validate(knowledge)
+            return None
+
+    def delete_knowledge_by_file_id(
+        self, file_id: str, user_name: str = None
+    ) -> Optional[KnowledgeModel]:
         """通过file_id删除知识"""
         with get_db() as db:
-            knowledge = db.query(Knowledge).filter_by(file_id=file_id).first()
+            knowledge = _query_by_file_id(db, file_id, user_name).first()
             if knowledge:
                 db.delete(knowledge)
                 db.commit()
@@ -0,0 +1,135 @@
+import base64
+import binascii
+import json
+import threading
+
+import msgpack
+import zstandard as zstd
+
+from config.base_config import BaseConfiguration
+
+_redis_config = BaseConfiguration().get_redis_config()
+
+# 二进制格式的前缀,json一定是以可见字符开头的,和旧数据不会冲突
+MAGIC = b"\x00hf"
+FORMAT_MSGPACK = 1  # msgpack,不压缩
+FORMAT_ZSTD_DICT_V1 = 2  # msgpack + zstd, 使用_DICTIONARY_V1
+
+# msgpack扩展类型: base64的data url按二进制存储,比base64文本小四分之一
+_EXT_DATA_URL = 1
+_DATA_URL_MARK = ";base64,"
+
+# 共享字典: 聊天消息里反复出现的字段名和内容片段,短消息单独压缩也能有不错的压缩率
+# 已经存储的数据依赖这个字典,不能修改,需要调整时新增一个版本
+_DICTIONARY_V1 = b"".join(
+    msgpack.packb(sample)
+    for sample in [
+        {"role": "user", "content": "你好,请介绍下你自己"},
+        {"role": "assistant", "content": "你好!我是一个人工智能助手", "model_name": "deepseek-chat"},
+        {"role": "assistant", "content": "", "model_name": "GLM-4-Flash"},
+        {"role": "assistant", "content": "", "model_name": "gpt-4o-mini"},
+        {"role": "assistant", "content": "", "model_name": "qwen-plus"},
+        {"role": "assistant", "content": "", "model_name": "llama-3.1-70b-versatile"},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "这张图片描述了什么"},
+                {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,/9j/4AAQSkZJRgABAQAAAQABAAD"}},
+                {"type": "image_url", "image_url": {"url": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAA"}},
+                {"type": "image_url", "image_url": {"url": "https://"}},
+            ],
+        },
+    ]
+) + (
+    "以下是,首先,其次,最后,总之,例如,因此,但是,如果,可以,需要,我们,这个,一个,"
+    "什么,怎么,为什么,如何,问题,方法,使用,进行,通过,包括,主要,以及,\n\n### **"
+    "```python\n```\n1. 2. 3. - "
+).encode("utf-8")
+
+_zstd_dict_v1 = zstd.ZstdCompressionDict(
+    _DICTIONARY_V1, dict_type=zstd.DICT_TYPE_RAWCONTENT
+)
+
+# 压缩和解压对象不能在多个线程里同时使用
+_local = threading.local()
+
+
+def _get_compressor() -> zstd.ZstdCompressor:
+    if not hasattr(_local, "compressor"):
+        _local.compressor = zstd.ZstdCompressor(
+            level=_redis_config.get("chat_message_compress_level", 3),
+            dict_data=_zstd_dict_v1,
+            write_content_size=True,
+            write_checksum=False,
+            write_dict_id=False,
+        )
+    return _local.compressor
+
+
+def _get_decompressor() -> zstd.ZstdDecompressor:
+    if not hasattr(_local, "decompressor"):
+        _local.decompressor = zstd.ZstdDecompressor(dict_data=_zstd_dict_v1)
+    return _local.decompressor
+
+
+def _pack_data_url(value: str):
+    """只转换能原样还原的data url,不规范的base64保持字符串"""
+    header, _, data = value.partition(_DATA_URL_MARK)
+    try:
+        raw = base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError):
+        return value
+    if base64.b64encode(raw).decode("ascii") != data:
+        return value
+    return msgpack.ExtType(_EXT_DATA_URL, header.encode("utf-8") + b"\x00" + raw)
+
+
+def _pack_value(value):
+    if isinstance(value, str):
+        if value.startswith("data:") and _DATA_URL_MARK in value:
+            return _pack_data_url(value)
+        return value
+    if isinstance(value, dict):
+        return {key: _pack_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_pack_value(item) for item in value]
+    return value
+
+
+def _ext_hook(code: int, data: bytes):
+    if code == _EXT_DATA_URL:
+        header, _, raw = data.partition(b"\x00")
+        return (
+            header.decode("utf-8")
+            + _DATA_URL_MARK
+            + base64.b64encode(raw).decode("ascii")
+        )
+    return msgpack.ExtType(code, data)
+
+
+def encode_message(msg: dict) -> bytes:
+    """聊天消息序列化成redis的member,压缩之后更大的就不压缩"""
+    if _redis_config.get("chat_message_codec", "msgpack_zstd") == "json":
+        return json.dumps(msg).encode("utf-8")
+
+    packed = msgpack.packb(_pack_value(msg), use_bin_type=True)
+    compressed = _get_compressor().compress(packed)
+    if len(compressed) < len(packed):
+        return MAGIC + bytes([FORMAT_ZSTD_DICT_V1]) + compressed
+    return MAGIC + bytes([FORMAT_MSGPACK]) + packed
+
+
+def decode_message(raw) -> dict:
+    """兼容旧的json字符串"""
+    if isinstance(raw, str):
+        return json.loads(raw)
+    if not raw.startswith(MAGIC):
+        return json.loads(raw.decode("utf-8"))
+
+    fmt = raw[len(MAGIC)]
+    payload = raw[len(MAGIC) + 1:]
+    if fmt == FORMAT_ZSTD_DICT_V1:
+        payload = _get_decompressor().decompress(payload)
+    elif fmt != FORMAT_MSGPACK:
+        raise ValueError(f"unknown chat message format: {fmt}")
+    return msgpack.unpackb(payload, raw=False, ext_hook=_ext_hook)
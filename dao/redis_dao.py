@@ -1,81 +1,299 @@
-import json
+import asyncio
 import random
 import time
 from datetime import datetime
+from functools import lru_cache
+from typing import Optional
 
-import redis
+import redis as sync_redis
+import redis.asyncio as redis
 from pydantic import BaseModel
 
 from config.base_config import BaseConfiguration
+from dao.message_codec import decode_message, encode_message
 from utils.log_utils import LogUtils
+from utils.metrics import track_storage
 
 
-class ChatHistoryModel(BaseModel):
-    user_question: str
-    ai_reply: str
-    summary: str
+class ChatSummaryModel(BaseModel):
+    """会话的滚动摘要,summarized_until之前(包含)的消息都已经折叠进摘要"""
+
+    summary: str = ""
+    summarized_until: float = 0
+
+
+def _session_key(username, sessionid) -> str:
+    """单个会话的消息,有序集合,score是时间戳"""
+    return f"{username}:{sessionid}"
+
+
+def _session_index_key(username) -> str:
+    """用户的会话索引,有序集合,member是session_id,score是session_id(创建时间戳)"""
+    return f"chat_sessions:{username}"
+
+
+def _last_msg_key(username) -> str:
+    """用户每个会话的最后一条提问,hash,field是session_id"""
+    return f"chat_last_msg:{username}"
+
+
+def _summary_key(username) -> str:
+    """用户每个会话的滚动摘要,hash,field是session_id"""
+    return f"chat_summary:{username}"
+
+
+# 已经建立过会话索引的用户
+SESSION_INDEX_READY_KEY = "chat_sessions_ready"
+
+
+def _get_message_text(msg: dict) -> str:
+    content = msg["content"]
+    if isinstance(content, list):
+        # 提取多模态图片提问的text
+        content = content[0]["text"]
+    return content
+
+
+def create_redis_connection_pool(db: int = None) -> redis.ConnectionPool:
+    """创建异步连接池,连接数和超时时间来自 base_settings.toml"""
+    redis_config = BaseConfiguration().get_redis_config()
+    # 连接池用满的时候等待空闲连接,而不是无限制地新建连接
+    return redis.BlockingConnectionPool(
+        host=redis_config["redis_host"],
+        port=redis_config["redis_port"],
+        db=redis_config["redis_chat_table"] if db is None else db,
+        max_connections=redis_config.get("redis_max_connections", 50),
+        timeout=redis_config.get("redis_pool_timeout", 5),
+        socket_timeout=redis_config.get("redis_socket_timeout", 5),
+        socket_connect_timeout=redis_config.get("redis_socket_connect_timeout", 2),
+        # 聊天消息是二进制编码的,读取的结果都是bytes,文本字段用到的时候再解码
+        decode_responses=False,
+    )
+
+
+def create_sync_redis_client(db: int) -> sync_redis.Redis:
+    """线程里同步访问redis使用,连接数和超时时间和异步连接池一致"""
+    redis_config = BaseConfiguration().get_redis_config()
+    return sync_redis.Redis(
+        connection_pool=sync_redis.BlockingConnectionPool(
+            host=redis_config["redis_host"],
+            port=redis_config["redis_port"],
+            db=db,
+            max_connections=redis_config.get("redis_max_connections", 50),
+            timeout=redis_config.get("redis_pool_timeout", 5),
+            socket_timeout=redis_config.get("redis_socket_timeout", 5),
+            socket_connect_timeout=redis_config.get("redis_socket_connect_timeout", 2),
+        )
+    )
 
 
 class ChatRedisManager:
-    def __init__(self, redis_table=None):
-        redis_config = BaseConfiguration().get_redis_config()
-        try:
-            self.redis_client = redis.Redis(
-                host=redis_config["redis_host"],
-                port=redis_config["redis_port"],
-                decode_responses=True,
-            )
-            self.redis_client.execute_command("SELECT", redis_config["redis_chat_table"])
-        except Exception as e:
-            LogUtils.log_error("Failed to connect to Redis: ", str(e))
+    def __init__(self, connection_pool: redis.ConnectionPool = None):
+        # 连接是用到的时候才建立的,这里不会访问redis
+        self.redis_client = redis.Redis(
+            connection_pool=connection_pool or create_redis_connection_pool()
+        )
 
-    def add_chat_record(self, username, sessionid, msg_list):
-        key = f"{username}:{sessionid}"
+    async def close(self):
+        await self.redis_client.aclose()
+        await self.redis_client.connection_pool.disconnect()
+
+    @track_storage("redis")
+    async def add_chat_record(self, username, sessionid, msg_list):
+        key = _session_key(username, sessionid)
         LogUtils.log_info("add_chat_record: ", key)
-        for msg in msg_list:
-            timestamp = time.time()
-            self.redis_client.zadd(key, {json.dumps(msg): timestamp})
-
-    def get_history_snapshots(self, username):
-        keys = self.redis_client.keys(f"{username}:*")
-        # 按照时间戳从大到小进行排序
-        sorted_keys = sorted(keys, key=lambda k: int(k.split(":")[1]), reverse=True)
-        LogUtils.log_info("sorted_keys :", sorted_keys)
-        snapshots = []  # 使用列表来存储快照
-        for key in sorted_keys:
-            messages = self.redis_client.zrange(key, 0, -1)  # 获取所有消息
-            messages = [json.loads(msg) for msg in messages]
-            if messages:
-                last_message = messages[-2] if len(messages) >= 2 else messages[-1]
-                content = last_message["content"]
-
-                if isinstance(content, list):
-                    # 提取多模态图片提问的text
-                    content = content[0]["text"]
-
-                session_id = key.split(":")[1]
-                snapshot = {
-                    "user_name": username,
-                    "session_id": int(session_id),  # 转换为整数以保持一致性
-                    "last_msg": content,
-                }
-                snapshots.append(snapshot)  # 将快照添加到列表中
-        LogUtils.log_info("snapshots: ", snapshots)
+        if not msg_list:
+            return
+
+        # 同一批消息的时间戳递增,保证顺序
+        timestamp = time.time()
+        members = {
+            encode_message(msg): timestamp + index * 1e-6
+            for index, msg in enumerate(msg_list)
+        }
+
+        # 所有写操作一次round trip
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.zadd(key, members)
+        pipe.zadd(_session_index_key(username), {str(sessionid): int(sessionid)})
+
+        user_msgs = [msg for msg in msg_list if msg.get("role") == "user"]
+        if user_msgs:
+            pipe.hset(
+                _last_msg_key(username), str(sessionid), _get_message_text(user_msgs[-1])
+            )
+        else:
+            # 只有回复的时候,保留之前的提问作为快照
+            pipe.hsetnx(
+                _last_msg_key(username), str(sessionid), _get_message_text(msg_list[-1])
+            )
+        await pipe.execute()
+
+    async def get_history_snapshots(self, username):
+        snapshots, _ = await self.get_history_snapshots_page(username)
         return snapshots
 
-    def get_history_record(self, username, sessionid):
-        key = f"{username}:{sessionid}"
+    @track_storage("redis")
+    async def get_history_snapshots_page(
+        self, username, before: int = None, limit: int = None
+    ) -> tuple[list[dict], Optional[int]]:
+        """按session_id(创建时间戳)从大到小分页
+        返回session_id小于before的最近limit个会话和下一页的游标, limit为None时返回全部
+        """
+        # 多取一个,判断是否还有下一页
+        num = None if limit is None else limit + 1
+        max_score = "+inf" if before is None else f"({before}"
+        index_key = _session_index_key(username)
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.zrevrangebyscore(index_key, max_score, "-inf", start=0 if num else None, num=num)
+        pipe.sismember(SESSION_INDEX_READY_KEY, username)
+        session_ids, index_ready = await pipe.execute()
+        if not index_ready:
+            await self._rebuild_session_index(username)
+            session_ids = await self.redis_client.zrevrangebyscore(
+                index_key, max_score, "-inf", start=0 if num else None, num=num
+            )
+
+        next_cursor = None
+        if limit is not None and len(session_ids) > limit:
+            session_ids = session_ids[:limit]
+            next_cursor = int(session_ids[-1])
+        if not session_ids:
+            return [], None
+
+        last_msgs = await self.redis_client.hmget(_last_msg_key(username), session_ids)
+
+        snapshots = []  # 使用列表来存储快照
+        for session_id, last_msg in zip(session_ids, last_msgs):
+            if last_msg is None:
+                continue
+            snapshot = {
+                "user_name": username,
+                "session_id": int(session_id),  # 转换为整数以保持一致性
+                "last_msg": last_msg.decode("utf-8"),
+            }
+            snapshots.append(snapshot)  # 将快照添加到列表中
+        LogUtils.log_info("snapshots count: ", len(snapshots))
+        return snapshots, next_cursor
+
+    @track_storage("redis")
+    async def _rebuild_session_index(self, username) -> list[str]:
+        """兼容旧数据: 用SCAN找到用户的会话,重建会话索引和最后提问,每个用户只会执行一次"""
+        session_keys = [
+            key.decode("utf-8")
+            async for key in self.redis_client.scan_iter(
+                match=_session_key(username, "*"), count=1000
+            )
+        ]
+        session_keys = [key for key in session_keys if key.split(":", 1)[1].isdigit()]
+        if not session_keys:
+            await self.redis_client.sadd(SESSION_INDEX_READY_KEY, username)
+            return []
+
+        read_pipe = self.redis_client.pipeline(transaction=False)
+        for key in session_keys:
+            read_pipe.zrange(key, 0, -1)
+        all_messages = await read_pipe.execute()
+
+        write_pipe = self.redis_client.pipeline(transaction=False)
+        for key, messages in zip(session_keys, all_messages):
+            if not messages:
+                continue
+            messages = [decode_message(msg) for msg in messages]
+            last_message = messages[-2] if len(messages) >= 2 else messages[-1]
+            session_id = key.split(":", 1)[1]
+            write_pipe.zadd(_session_index_key(username), {session_id: int(session_id)})
+            write_pipe.hset(
+                _last_msg_key(username), session_id, _get_message_text(last_message)
+            )
+        write_pipe.sadd(SESSION_INDEX_READY_KEY, username)
+        await write_pipe.execute()
+        LogUtils.log_info(f"rebuild session index: {username}, {len(session_keys)} sessions")
+
+        return await self.redis_client.zrevrange(_session_index_key(username), 0, -1)
+
+    @track_storage("redis")
+    async def get_history_record(self, username, sessionid):
+        key = _session_key(username, sessionid)
         LogUtils.log_info("get_history_record ", key)
-        if self.redis_client.exists(key):
-            messages = self.redis_client.zrange(key, 0, -1)
-            return [json.loads(msg) for msg in messages]
+        messages = await self.redis_client.zrange(key, 0, -1)
+        if messages:
+            return [decode_message(msg) for msg in messages]
         else:
             return None
 
-    def delete_chat_record(self, username, sessionid):
-        key = f"{username}:{sessionid}"
-        if self.redis_client.exists(key):
-            self.redis_client.delete(key)
+    @track_storage("redis")
+    async def get_history_page(
+        self, username, sessionid, before: float = None, limit: int = 50
+    ) -> tuple[list[dict], Optional[float]]:
+        """按时间戳从新到旧分页,返回时间戳小于before的最近limit条消息(按时间顺序)和下一页的游标"""
+        key = _session_key(username, sessionid)
+        max_score = "+inf" if before is None else f"({before!r}"
+        messages = await self.redis_client.zrevrangebyscore(
+            key, max_score, "-inf", start=0, num=limit + 1, withscores=True
+        )
+        next_cursor = None
+        if len(messages) > limit:
+            messages = messages[:limit]
+            next_cursor = messages[-1][1]
+        return [decode_message(msg) for msg, _ in reversed(messages)], next_cursor
+
+    @track_storage("redis")
+    async def get_history_tail(
+        self, username, sessionid, count: int
+    ) -> list[tuple[dict, float]]:
+        """最近的count条消息和时间戳,按时间顺序,按下标读取,不需要读整个会话"""
+        key = _session_key(username, sessionid)
+        messages = await self.redis_client.zrange(key, -count, -1, withscores=True)
+        return [(decode_message(msg), score) for msg, score in messages]
+
+    @track_storage("redis")
+    async def get_history_entries(
+        self, username, sessionid, after: float = None, limit: int = None
+    ) -> list[tuple[dict, float]]:
+        """带时间戳的消息,用于和摘要的进度做比较, after之前(包含)的消息不读取
+        limit限制从最早开始读取的数量
+        """
+        key = _session_key(username, sessionid)
+        min_score = "-inf" if after is None else f"({after!r}"
+        page = {} if limit is None else {"start": 0, "num": limit}
+        messages = await self.redis_client.zrangebyscore(
+            key, min_score, "+inf", withscores=True, **page
+        )
+        return [(decode_message(msg), score) for msg, score in messages]
+
+    @track_storage("redis")
+    async def count_history_entries(
+        self, username, sessionid, after: float = None
+    ) -> int:
+        """after之后的消息数量,不读取消息内容"""
+        min_score = "-inf" if after is None else f"({after!r}"
+        return await self.redis_client.zcount(
+            _session_key(username, sessionid), min_score, "+inf"
+        )
+
+    @track_storage("redis")
+    async def get_chat_summary(self, username, sessionid) -> ChatSummaryModel:
+        summary = await self.redis_client.hget(_summary_key(username), str(sessionid))
+        if summary is None:
+            return ChatSummaryModel()
+        return ChatSummaryModel.model_validate_json(summary)
+
+    @track_storage("redis")
+    async def save_chat_summary(self, username, sessionid, summary: ChatSummaryModel):
+        await self.redis_client.hset(
+            _summary_key(username), str(sessionid), summary.model_dump_json()
+        )
+
+    @track_storage("redis")
+    async def delete_chat_record(self, username, sessionid):
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.delete(_session_key(username, sessionid))
+        pipe.zrem(_session_index_key(username), str(sessionid))
+        pipe.hdel(_last_msg_key(username), str(sessionid))
+        pipe.hdel(_summary_key(username), str(sessionid))
+        await pipe.execute()
 
 
 def generate_random_message():
@@ -86,27 +304,33 @@ def generate_random_message():
     }
 
 
-def generate_test_data(
+@lru_cache(maxsize=1)
+def get_chat_redis_manager() -> ChatRedisManager:
+    """所有controller共享同一个连接池"""
+    return ChatRedisManager()
+
+
+async def generate_test_data(
         num_users=3, num_sessions_per_user=5, num_messages_per_session=10
 ):
-    manager = ChatRedisManager()
-    manager.redis_client.execute_command("SELECT", 4)
-    manager.redis_client.flushdb()
+    manager = ChatRedisManager(create_redis_connection_pool(db=4))
+    await manager.redis_client.flushdb()
     for i in range(num_users):
         username = f"hope{i}"
         for j in range(num_sessions_per_user):
-            time.sleep(1)
+            await asyncio.sleep(1)
             msg_list = [
                 generate_random_message() for _ in range(num_messages_per_session)
             ]
-            manager.add_chat_record(
+            await manager.add_chat_record(
                 username=username, sessionid=str(int(time.time())), msg_list=msg_list
             )
+    await manager.close()
 
 
 # Example usage:
 if __name__ == "__main__":
-    generate_test_data()
+    asyncio.run(generate_test_data())
     # manager = ChatRedisManager()
     # manager.redis_client.execute_command('SELECT', 3)
     # manager.redis_client.flushdb()
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import sys
 
@@ -14,8 +15,15 @@ from controller.agent.translate_human_controller import translate_human_router
 from controller.chat_controller import chat_router
 from controller.config.config_controller import config_router
 from controller.file_controller import file_router
+from controller.metrics_controller import metrics_router
 from controller.rag.rag_controller import rag_router
 from controller.user_controller import user_router
+from dao.redis_dao import get_chat_redis_manager
+from models.factory.llm_client_cache import shared_http_clients
+from rag.embedding.cached_embedding import query_embedding_cache
+from rag.rag_manager_registry import rag_manager_registry
+from rag.reader.pdf.extract_pdf_img import shutdown_pdf_pool
+from utils.semantic_cache import collection_versions
 
 # 正常情况日志级别使用 INFO，需要定位时可以修改为 DEBUG，此时 SDK 会打印和服务端的通信信息
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
@@ -42,6 +50,23 @@ app.include_router(user_router)
 app.include_router(rag_router)
 app.include_router(config_router)
 app.include_router(agent_manager_router)
+app.include_router(metrics_router)
+
+
+@app.on_event("startup")
+async def startup():
+    # 知识库的模型和向量库在第一次使用时加载,这里只启动空闲回收和可选的后台预加载
+    rag_manager_registry.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await rag_manager_registry.aclose()
+    await query_embedding_cache.aclose()
+    await collection_versions.aclose()
+    await get_chat_redis_manager().close()
+    await shared_http_clients.aclose()
+    await asyncio.to_thread(shutdown_pdf_pool)
 
 
 @app.get("/")
@@ -0,0 +1,148 @@
+import asyncio
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+import httpx
+
+from config.base_config import BaseConfiguration
+from utils.log_utils import LogUtils
+
+_llm_client_config = BaseConfiguration().get_llm_client_config()
+
+
+def _get_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=_llm_client_config["max_connections"],
+        max_keepalive_connections=_llm_client_config["max_keepalive_connections"],
+        keepalive_expiry=_llm_client_config["keepalive_expiry"],
+    )
+
+
+def _get_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        _llm_client_config["timeout"],
+        connect=_llm_client_config["connect_timeout"],
+    )
+
+
+class LoopLocalAsyncClient(httpx.AsyncClient):
+    """异步连接池里的连接只能在创建它的事件循环里使用
+    这个客户端在导入时创建,传给模型客户端之后一直不变,请求时按当前的事件循环使用各自的连接池
+    事件循环被回收之后对应的连接池跟着释放
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # 每个事件循环的连接池使用相同的参数创建
+        self._client_kwargs = kwargs
+        self._loop_lock = threading.Lock()
+        self._loop_clients: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, httpx.AsyncClient
+        ] = weakref.WeakKeyDictionary()
+
+    def _get_loop_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._loop_lock:
+            client = self._loop_clients.get(loop)
+            if client is None:
+                client = httpx.AsyncClient(**self._client_kwargs)
+                self._loop_clients[loop] = client
+            return client
+
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        return await self._get_loop_client().send(request, **kwargs)
+
+    async def aclose(self) -> None:
+        """关闭当前事件循环的连接池,其他事件循环的连接池不能在这里关闭,只是不再使用
+        关闭之后还可以继续使用,下次请求时重新创建连接池
+        """
+        loop = asyncio.get_running_loop()
+        with self._loop_lock:
+            client = self._loop_clients.pop(loop, None)
+            self._loop_clients.clear()
+        if client is not None:
+            await client.aclose()
+
+
+class SharedHttpClients:
+    """每个provider的base_url共享一个有上限的http连接池
+    同步和异步各一个,保持keep-alive连接,不用每次请求都重新握手
+    异步的连接池按事件循环区分,导入时创建的客户端在之后的任何事件循环里都可以使用
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients: dict[str, tuple[httpx.Client, LoopLocalAsyncClient]] = {}
+
+    @staticmethod
+    def _create_clients() -> tuple[httpx.Client, LoopLocalAsyncClient]:
+        return (
+            httpx.Client(limits=_get_limits(), timeout=_get_timeout()),
+            LoopLocalAsyncClient(limits=_get_limits(), timeout=_get_timeout()),
+        )
+
+    def get(
+        self, base_url: Optional[str]
+    ) -> tuple[httpx.Client, LoopLocalAsyncClient]:
+        key = base_url or "default"
+        with self._lock:
+            if key not in self._clients:
+                LogUtils.log_info(f"create http connection pool: {key}")
+                self._clients[key] = self._create_clients()
+            return self._clients[key]
+
+    async def aclose(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client, async_client in clients:
+            client.close()
+            await async_client.aclose()
+
+
+class LLMClientCache:
+    """按(provider, model, 参数)缓存模型客户端
+    超过ttl的重新创建,数量超过max_size时淘汰最久没用的
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (创建时间, 客户端)
+        self._cache: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get_or_create(self, key: Hashable, create_func: Callable[[], Any]) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            item = self._cache.get(key)
+            if item is not None and now - item[0] < self.ttl:
+                self._cache.move_to_end(key)
+                return item[1]
+
+        # 创建客户端不持有锁,避免慢的初始化阻塞其他模型
+        client = create_func()
+        if client is None:
+            return None
+        with self._lock:
+            self._cache[key] = (now, client)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                evicted_key, _ = self._cache.popitem(last=False)
+                LogUtils.log_info(f"evict llm client: {evicted_key}")
+        return client
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+shared_http_clients = SharedHttpClients()
+
+llm_client_cache = LLMClientCache(
+    max_size=_llm_client_config["cache_max_size"],
+    ttl=_llm_client_config["cache_ttl"],
+)
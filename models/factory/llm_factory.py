@@ -1,5 +1,6 @@
 from dotenv import load_dotenv
 
+from models.factory.llm_client_cache import llm_client_cache
 from models.llm.langchain.minmax_llm_factory import MinimaxLlmFactory
 from models.llm.langchain.openai.baichuan_llm_factory import BaichuanLlmFactory
 from models.llm.langchain.openai.base_agi_llm_factory import BaseAgiLLMFactory
@@ -21,6 +22,14 @@ load_dotenv()
 class LLMFactory:
     @staticmethod
     def get_llm(mode_type: LLMType, mode_name: str = None):
+        """按(provider, model)缓存复用模型客户端,不用每次请求都重新创建"""
+        return llm_client_cache.get_or_create(
+            (mode_type, mode_name),
+            lambda: LLMFactory.create_llm(mode_type, mode_name),
+        )
+
+    @staticmethod
+    def create_llm(mode_type: LLMType, mode_name: str = None):
         if mode_type == LLMType.OPENAI:
             return OpenaiLlmFactory().get_llm(mode_name)
 
@@ -0,0 +1,218 @@
+import asyncio
+from typing import Any, Optional
+
+from config.base_config import BaseConfiguration
+from models.factory.llm_factory import LLMFactory
+from models.factory.llm_scheduler import LLMPriority, llm_scheduler
+from models.model_type import LLMType
+from utils.log_utils import LogUtils
+from utils.metrics import LLM_HEDGE_REQUESTS
+
+_STREAM_END = object()
+
+
+def _has_content(chunk: Any) -> bool:
+    return bool(getattr(chunk, "content", chunk))
+
+
+async def _first_content_chunks(stream) -> list:
+    """读取到第一个有内容的chunk为止,前面的空chunk(比如只有role的chunk)一起返回
+    很多provider连接之后马上返回空chunk,按它判断谁先输出的话,deadline就没有意义了
+    流结束时最后一个元素是_STREAM_END
+    """
+    chunks = []
+    while True:
+        try:
+            chunk = await stream.__anext__()
+        except StopAsyncIteration:
+            chunks.append(_STREAM_END)
+            return chunks
+        chunks.append(chunk)
+        if _has_content(chunk):
+            return chunks
+
+
+def _parse_model(item: str) -> tuple[str, str]:
+    # "provider:model_name", 模型名里可能有冒号,只按第一个分割
+    provider, model = item.split(":", 1)
+    return provider, model
+
+
+class HedgedStream:
+    """主模型超过deadline还没有输出第一个有内容的token,同时请求备用模型
+    谁先输出就用谁,另一个取消; 主模型在deadline之前失败时直接切到备用模型
+    provider和model是最终输出内容的模型
+    """
+
+    def __init__(
+        self,
+        llm: Any,
+        inputs: Any,
+        primary: tuple[str, str],
+        fallback: tuple[str, str],
+        group: str,
+        deadline: float,
+        priority: LLMPriority,
+        **kwargs,
+    ):
+        self.provider, self.model = primary
+        self._llm = llm
+        self._inputs = inputs
+        self._primary = primary
+        self._fallback = fallback
+        self._group = group
+        self._deadline = deadline
+        self._priority = priority
+        self._kwargs = kwargs
+        self._stream = self._hedged_stream()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._stream.__anext__()
+
+    async def aclose(self):
+        await self._stream.aclose()
+
+    def _open(self, target: tuple[str, str], llm: Any = None):
+        provider, model = target
+        if llm is None:
+            llm = LLMFactory.get_llm(LLMType.get_enum_from_value(provider), model)
+        return llm_scheduler.astream(
+            llm, self._inputs, provider, model, self._priority, **self._kwargs
+        )
+
+    def _record(self, outcome: str):
+        LLM_HEDGE_REQUESTS.labels(group=self._group, outcome=outcome).inc()
+
+    async def _hedged_stream(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._deadline
+        primary_stream = self._open(self._primary, self._llm)
+        # 等待第一个有内容的chunk的任务 -> (模型, 流)
+        tasks = {
+            asyncio.create_task(_first_content_chunks(primary_stream)): (
+                self._primary,
+                primary_stream,
+            )
+        }
+        hedged = False
+        winner = None
+        errors = []
+
+        try:
+            while winner is None:
+                timeout = None if hedged else max(0.0, deadline - loop.time())
+                done, _ = await asyncio.wait(
+                    tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    target, stream = tasks.pop(task)
+                    if winner is None and task.exception() is None:
+                        winner = (task.result(), target, stream)
+                        continue
+                    if task.exception() is not None:
+                        LogUtils.log_error(
+                            f"hedge {self._group} {target} error: {task.exception()}"
+                        )
+                        errors.append(task.exception())
+                    await stream.aclose()
+
+                if winner is not None:
+                    break
+                if not hedged:
+                    hedged = True
+                    LogUtils.log_info(
+                        f"hedge {self._group}: start {self._fallback} "
+                        f"after {round(self._deadline - max(0.0, deadline - loop.time()), 2)}s"
+                    )
+                    fallback_stream = self._open(self._fallback)
+                    tasks[asyncio.create_task(_first_content_chunks(fallback_stream))] = (
+                        self._fallback,
+                        fallback_stream,
+                    )
+                elif not tasks:
+                    self._record("failed")
+                    raise errors[0]
+        finally:
+            # 输掉的请求取消掉,释放调度器的名额和provider的连接
+            for task, (_, stream) in tasks.items():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await stream.aclose()
+
+        first_chunks, target, stream = winner
+        if not hedged:
+            self._record("not_hedged")
+        elif target == self._primary:
+            self._record("primary_won")
+        else:
+            self._record("fallback_won")
+        self.provider, self.model = target
+
+        try:
+            # 赢的一方缓存的空chunk和第一个有内容的chunk原样输出
+            for chunk in first_chunks:
+                if chunk is _STREAM_END:
+                    return
+                yield chunk
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+
+class LLMHedge:
+    """按 base_settings.toml 里 [llm_hedge.groups] 的模型分组选择备用模型"""
+
+    def __init__(self, config: dict):
+        self.default_deadline = config["first_token_deadline"]
+        # (provider, model) -> (组名, 同组的模型列表, deadline)
+        self._groups: dict[tuple[str, str], tuple[str, list, float]] = {}
+        for group, group_config in config.get("groups", {}).items():
+            models = [_parse_model(item) for item in group_config["models"]]
+            deadline = group_config.get("first_token_deadline", self.default_deadline)
+            for target in models:
+                self._groups[target] = (group, models, deadline)
+
+    def get_fallback(
+        self, provider: str, model: str
+    ) -> Optional[tuple[str, tuple[str, str], float]]:
+        """同组里排在最前面的其他模型, 没有分组返回None"""
+        item = self._groups.get((provider, model))
+        if item is None:
+            return None
+        group, models, deadline = item
+        for target in models:
+            if target != (provider, model):
+                return group, target, deadline
+        return None
+
+    def astream(
+        self,
+        llm: Any,
+        inputs: Any,
+        provider: str,
+        model: str,
+        priority: LLMPriority = LLMPriority.INTERACTIVE,
+        **kwargs,
+    ):
+        """有备用模型时返回HedgedStream,否则和调度器的流式调用一样"""
+        fallback = self.get_fallback(provider, model)
+        if fallback is None:
+            return llm_scheduler.astream(llm, inputs, provider, model, priority, **kwargs)
+        group, target, deadline = fallback
+        return HedgedStream(
+            llm,
+            inputs,
+            (provider, model),
+            target,
+            group,
+            deadline,
+            priority,
+            **kwargs,
+        )
+
+
+llm_hedge = LLMHedge(BaseConfiguration().get_llm_hedge_config())
@@ -0,0 +1,535 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional
+
+from config.base_config import BaseConfiguration
+from utils.async_utils import astream_llm
+from utils.log_utils import LogUtils
+from utils.metrics import (
+    LLM_RATE_LIMITED,
+    LLM_SCHEDULER_QUEUE_DEPTH,
+    LLM_SCHEDULER_WAIT_SECONDS,
+)
+
+
+class LLMPriority(IntEnum):
+    """排队时数值小的先执行"""
+
+    INTERACTIVE = 0  # 用户正在等待的回答
+    BACKGROUND = 1  # 引导问题,历史摘要
+    INGESTION = 2  # 知识库入库时的图片描述
+
+
+class LLMRateLimitError(Exception):
+    """provider持续返回429,重试之后仍然失败"""
+
+
+# openai兼容的SDK(openai, groq...)是RateLimitError, zhipuai是APIReachLimitError
+_RATE_LIMIT_ERROR_NAMES = {"RateLimitError", "APIReachLimitError"}
+# 没有状态码的异常只按明确的限流信息判断,不匹配单独的"429",请求id或者token数里也可能有429
+_RATE_LIMIT_PHRASES = ("rate limit", "rate_limit", "ratelimit", "too many requests")
+
+
+def _is_rate_limit_error(e: BaseException) -> bool:
+    status_code = getattr(e, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(e, "response", None), "status_code", None)
+    if status_code is not None:
+        return status_code == 429
+    if any(cls.__name__ in _RATE_LIMIT_ERROR_NAMES for cls in type(e).__mro__):
+        return True
+    message = str(e).lower()
+    return any(phrase in message for phrase in _RATE_LIMIT_PHRASES)
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    """各家SDK的限流异常不一样,按状态码,异常类型和错误信息判断
+    raise ... from 包装过的异常也检查原始的异常
+    """
+    seen = set()
+    while e is not None and id(e) not in seen:
+        if _is_rate_limit_error(e):
+            return True
+        seen.add(id(e))
+        e = e.__cause__
+    return False
+
+
+def _get_retry_after(e: Exception) -> Optional[float]:
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """按每分钟请求数限流,rate为0时只在429之后暂停"""
+
+    def __init__(self, requests_per_minute: float, burst: int):
+        self.rate = requests_per_minute / 60
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._cooldown_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """预约一个请求,返回需要等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            if self.rate <= 0:
+                return max(0.0, self._cooldown_until - now)
+
+            if now > self._updated:
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+            self._tokens -= 1
+            # 冷却期间_updated在未来,令牌从冷却结束时开始补充
+            return max(0.0, self._updated - now) + max(0.0, -self._tokens) / self.rate
+
+    def cool_down(self, seconds: float):
+        with self._lock:
+            self._cooldown_until = max(
+                self._cooldown_until, time.monotonic() + seconds
+            )
+            if self.rate > 0:
+                # 冷却结束之后按rate重新放行,不会一下子把积压的请求全发出去
+                self._tokens = min(self._tokens, 0.0)
+                self._updated = max(self._updated, self._cooldown_until)
+
+
+class _PriorityLimiter:
+    """按优先级排队的并发上限,同一优先级先到先得
+    同时支持协程和线程等待,入库脚本是在线程里同步调用的
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # [priority, seq, wake, waiting]
+        self._waiters: list[list] = []
+        self._seq = itertools.count()
+
+    def _enqueue(self, priority: LLMPriority, wake) -> Optional[list]:
+        """有空位直接占用返回None,否则排队返回等待项"""
+        with self._lock:
+            if self._in_flight < self.max_concurrency and not self._waiters:
+                self._in_flight += 1
+                return None
+            entry = [int(priority), next(self._seq), wake, True]
+            heapq.heappush(self._waiters, entry)
+            return entry
+
+    def release(self):
+        with self._lock:
+            while self._waiters:
+                entry = heapq.heappop(self._waiters)
+                if entry[3]:
+                    # 名额直接交给排在最前面的等待者,_in_flight不变
+                    entry[3] = False
+                    entry[2]()
+                    return
+            self._in_flight -= 1
+
+    async def acquire(self, priority: LLMPriority):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(_set_future_done, future)
+
+        entry = self._enqueue(priority, wake)
+        if entry is None:
+            return
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = not entry[3]
+                entry[3] = False
+            if granted:
+                # 已经分到名额但是被取消了,交给下一个等待者
+                self.release()
+            raise
+
+    def acquire_sync(self, priority: LLMPriority):
+        event = threading.Event()
+        if self._enqueue(priority, event.set) is not None:
+            event.wait()
+
+
+def _set_future_done(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+@dataclass
+class _LimitState:
+    limiter: _PriorityLimiter
+    bucket: TokenBucket
+
+
+class LLMScheduler:
+    """所有大模型调用的调度入口
+    每个provider一个并发上限和令牌桶,单独配置的模型再加一层限制
+    429之后暂停这个provider的新请求,在还没有输出内容之前自动重试
+    """
+
+    def __init__(self, config: dict):
+        self.rate_limit_cooldown = config["rate_limit_cooldown"]
+        self.max_rate_limit_retries = config["max_rate_limit_retries"]
+        self._default_config = config["default"]
+        self._provider_config = config.get("provider", {})
+        self._model_config = config.get("model", {})
+
+        self._lock = threading.Lock()
+        self._providers: dict[str, _LimitState] = {}
+        self._models: dict[str, Optional[_LimitState]] = {}
+
+    @staticmethod
+    def _create_state(config: dict) -> _LimitState:
+        return _LimitState(
+            limiter=_PriorityLimiter(config["max_concurrency"]),
+            bucket=TokenBucket(config["requests_per_minute"], config["burst"]),
+        )
+
+    def _get_states(self, provider: str, model: Optional[str]) -> list[_LimitState]:
+        """先模型后provider,加锁的顺序固定,不会互相等待"""
+        with self._lock:
+            if provider not in self._providers:
+                self._providers[provider] = self._create_state(
+                    {**self._default_config, **self._provider_config.get(provider, {})}
+                )
+            states = [self._providers[provider]]
+
+            if model:
+                if model not in self._models:
+                    model_config = self._model_config.get(model)
+                    self._models[model] = (
+                        self._create_state(
+                            {
+                                "max_concurrency": self._default_config["max_concurrency"],
+                                "requests_per_minute": 0,
+                                "burst": 1,
+                                **model_config,
+                            }
+                        )
+                        if model_config
+                        else None
+                    )
+                if self._models[model] is not None:
+                    states.insert(0, self._models[model])
+            return states
+
+    @staticmethod
+    def _labels(provider: str, priority: LLMPriority) -> dict:
+        return {"provider": provider, "priority": priority.name.lower()}
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        provider: Any,
+        model: Optional[str] = None,
+        priority: LLMPriority = LLMPriority.INTERACTIVE,
+    ):
+        """占用一个调用名额,流式输出需要在整个读取过程中持有"""
+        provider = get_provider_name(provider)
+        states = self._get_states(provider, model)
+        labels = self._labels(provider, priority)
+        acquired = []
+
+        LLM_SCHEDULER_QUEUE_DEPTH.labels(**labels).inc()
+        start_time = time.perf_counter()
+        try:
+            for state in states:
+                await state.limiter.acquire(priority)
+                acquired.append(state)
+            wait_seconds = max(state.bucket.reserve() for state in states)
+            if wait_seconds > 0:
+                await asyncio.sleep(wait_seconds)
+        except BaseException:
+            for state in reversed(acquired):
+                state.limiter.release()
+            raise
+        finally:
+            LLM_SCHEDULER_QUEUE_DEPTH.labels(**labels).dec()
+            LLM_SCHEDULER_WAIT_SECONDS.labels(**labels).observe(
+                time.perf_counter() - start_time
+            )
+
+        try:
+            yield
+        finally:
+            for state in reversed(acquired):
+                state.limiter.release()
+
+    @contextmanager
+    def slot_sync(
+        self,
+        provider: Any,
+        model: Optional[str] = None,
+        priority: LLMPriority = LLMPriority.INGESTION,
+    ):
+        """线程里的同步调用使用,在事件循环里等待会卡住持有名额的协程"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError("slot_sync can not be used in event loop, use slot")
+
+        provider = get_provider_name(provider)
+        states = self._get_states(provider, model)
+        labels = self._labels(provider, priority)
+        acquired = []
+
+        LLM_SCHEDULER_QUEUE_DEPTH.labels(**labels).inc()
+        start_time = time.perf_counter()
+        try:
+            for state in states:
+                state.limiter.acquire_sync(priority)
+                acquired.append(state)
+            wait_seconds = max(state.bucket.reserve() for state in states)
+            if wait_seconds > 0:
+                time.sleep(wait_seconds)
+        except BaseException:
+            for state in reversed(acquired):
+                state.limiter.release()
+            raise
+        finally:
+            LLM_SCHEDULER_QUEUE_DEPTH.labels(**labels).dec()
+            LLM_SCHEDULER_WAIT_SECONDS.labels(**labels).observe(
+                time.perf_counter() - start_time
+            )
+
+        try:
+            yield
+        finally:
+            for state in reversed(acquired):
+                state.limiter.release()
+
+    def _on_rate_limited(
+        self, provider: Any, model: Optional[str], error: Exception, attempt: int
+    ):
+        """暂停provider的新请求,重试次数用完时抛出LLMRateLimitError"""
+        provider = get_provider_name(provider)
+        cooldown = _get_retry_after(error) or self.rate_limit_cooldown
+        LLM_RATE_LIMITED.labels(provider=provider, model=model or "").inc()
+        LogUtils.log_info(
+            f"llm rate limited: {provider}/{model}, cool down {cooldown} seconds"
+        )
+        for state in self._get_states(provider, model):
+            state.bucket.cool_down(cooldown)
+
+        if attempt >= self.max_rate_limit_retries:
+            raise LLMRateLimitError(
+                f"{provider}/{model} rate limited after {attempt + 1} attempts"
+            ) from error
+
+    async def acall(
+        self,
+        func: Callable[[], Awaitable[Any]],
+        provider: Any,
+        model: Optional[str] = None,
+        priority: LLMPriority = LLMPriority.BACKGROUND,
+    ):
+        """在调用名额里执行 await func(), 429之后冷却重试"""
+        attempt = 0
+        while True:
+            async with self.slot(provider, model, priority):
+                try:
+                    return await func()
+                except Exception as e:
+                    if not is_rate_limit_error(e):
+                        raise
+                    self._on_rate_limited(provider, model, e, attempt)
+            attempt += 1
+
+    def call(
+        self,
+        func: Callable[[], Any],
+        provider: Any,
+        model: Optional[str] = None,
+        priority: LLMPriority = LLMPriority.INGESTION,
+    ):
+        attempt = 0
+        while True:
+            with self.slot_sync(provider, model, priority):
+                try:
+                    return func()
+                except Exception as e:
+                    if not is_rate_limit_error(e):
+                        raise
+                    self._on_rate_limited(provider, model, e, attempt)
+            attempt += 1
+
+    async def astream_call(
+        self,
+        open_stream: Callable[[], AsyncIterator],
+        provider: Any,
+        model: Optional[str] = None,
+        priority: LLMPriority = LLMPriority.INTERACTIVE,
+    ):
+        """流式调用,整个读取过程持有名额,输出第一个chunk之前遇到429会等待冷却之后重试"""
+        attempt = 0
+        while True:
+            async with self.slot(provider, model, priority):
+                stream = open_stream()
+                started = False
+                try:
+                    async for chunk in stream:
+                        started = True
+                        yield chunk
+                    return
+                except Exception as e:
+                    if started or not is_rate_limit_error(e):
+                        raise
+                    self._on_rate_limited(provider, model, e, attempt)
+                finally:
+                    if hasattr(stream, "aclose"):
+                        await stream.aclose()
+            attempt += 1
+
+    def stream_call(
+        self,
+        open_stream: Callable[[], Iterator],
+        provider: Any,
+        model: Optional[str] = None,
+        priority: LLMPriority = LLMPriority.INGESTION,
+    ):
+        attempt = 0
+        while True:
+            with self.slot_sync(provider, model, priority):
+                stream = open_stream()
+                started = False
+                try:
+                    for chunk in stream:
+                        started = True
+                        yield chunk
+                    return
+                except Exception as e:
+                    if started or not is_rate_limit_error(e):
+                        raise
+                    self._on_rate_limited(provider, model, e, attempt)
+                finally:
+                    if hasattr(stream, "close"):
+                        stream.close()
+            attempt += 1
+
+    async def ainvoke(
+        self,
+        runnable: Any,
+        inputs: Any,
+        provider: Any,
+        model: Optional[str] = None,
+        priority: LLMPriority = LLMPriority.BACKGROUND,
+        **kwargs,
+    ):
+        return await self.acall(
+            lambda: runnable.ainvoke(inputs, **kwargs), provider, model, priority
+        )
+
+    def invoke(
+        self,
+        runnable: Any,
+        inputs: Any,
+        provider: Any,
+        model: Optional[str] = None,
+        priority: LLMPriority = LLMPriority.INGESTION,
+        **kwargs,
+    ):
+        return self.call(
+            lambda: runnable.invoke(inputs, **kwargs), provider, model, priority
+        )
+
+    def astream(
+        self,
+        llm: Any,
+        inputs: Any,
+        provider: Any,
+        model: Optional[str] = None,
+        priority: LLMPriority = LLMPriority.INTERACTIVE,
+        **kwargs,
+    ) -> AsyncIterator:
+        """langchain模型的流式调用"""
+        return self.astream_call(
+            lambda: astream_llm(llm, inputs, **kwargs), provider, model, priority
+        )
+
+    def bind(
+        self,
+        llm: Any,
+        provider: Any,
+        model: Optional[str] = None,
+        priority: LLMPriority = LLMPriority.INTERACTIVE,
+    ) -> "ScheduledChatModel":
+        """模型和调度参数绑在一起,传给只认模型对象的代码(比如agent的状态)"""
+        return ScheduledChatModel(self, llm, provider, model, priority)
+
+
+class ScheduledChatModel:
+    """langchain模型的包装, invoke/ainvoke/astream 经过调度器,其他属性透传"""
+
+    def __init__(
+        self,
+        scheduler: LLMScheduler,
+        llm: Any,
+        provider: Any,
+        model: Optional[str],
+        priority: LLMPriority,
+    ):
+        self.inner = llm
+        self._scheduler = scheduler
+        self._provider = provider
+        self._model = model
+        self._priority = priority
+
+    def __getattr__(self, name: str):
+        return getattr(self.inner, name)
+
+    @property
+    def provider_name(self) -> str:
+        return get_provider_name(self._provider)
+
+    async def ainvoke(self, inputs: Any, **kwargs):
+        return await self._scheduler.ainvoke(
+            self.inner, inputs, self._provider, self._model, self._priority, **kwargs
+        )
+
+    def invoke(self, inputs: Any, **kwargs):
+        return self._scheduler.invoke(
+            self.inner, inputs, self._provider, self._model, self._priority, **kwargs
+        )
+
+    def astream(self, inputs: Any, **kwargs) -> AsyncIterator:
+        return self._scheduler.astream(
+            self.inner, inputs, self._provider, self._model, self._priority, **kwargs
+        )
+
+    def stream(self, inputs: Any, **kwargs) -> Iterator:
+        return self._scheduler.stream_call(
+            lambda: self.inner.stream(inputs, **kwargs),
+            self._provider,
+            self._model,
+            self._priority,
+        )
+
+
+def get_provider_name(provider: Any) -> str:
+    # LLMType 或者请求里的 model_type 字符串
+    return str(getattr(provider, "value", provider))
+
+
+llm_scheduler = LLMScheduler(BaseConfiguration().get_llm_scheduler_config())
@@ -3,6 +3,7 @@ from abc import ABC, abstractmethod
 from langchain_core.language_models import BaseChatModel
 
 from models.api_key_config import ApiKeyUrlConfig
+from models.factory.llm_client_cache import shared_http_clients
 from models.llm.langchain.base_llm_factory import BaseLLMFactory
 
 
@@ -19,9 +20,13 @@ class BaseOpenaiTypeFactory(BaseLLMFactory, ABC):
         from langchain_openai import ChatOpenAI
 
         _config = self.get_api_key_url_config()
+        # 同一个provider的模型共享连接池,复用keep-alive连接
+        http_client, http_async_client = shared_http_clients.get(_config.base_url)
 
         return ChatOpenAI(
             api_key=_config.api_key,
             base_url=_config.base_url,
             model=self.get_default_mode_name() if mode_name is None else mode_name,
+            http_client=http_client,
+            http_async_client=http_async_client,
         )
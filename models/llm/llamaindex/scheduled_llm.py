@@ -0,0 +1,140 @@
+from typing import Any, Optional, Sequence
+
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    ChatResponseGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    LLMMetadata,
+)
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.llms import LLM
+
+from models.factory.llm_scheduler import (
+    LLMPriority,
+    get_provider_name,
+    llm_scheduler,
+)
+
+
+class ScheduledLlamaLLM(LLM):
+    """llama-index模型的包装,所有调用经过 llm_scheduler 排队,限流和429重试
+    设置成 Settings.llm 之后,RAG的多路查询生成和回答生成都受provider的并发和速率限制
+    流式调用在读取完之前一直持有名额
+    """
+
+    _inner: LLM = PrivateAttr()
+    _provider: Any = PrivateAttr()
+    _model: Optional[str] = PrivateAttr()
+    _priority: LLMPriority = PrivateAttr()
+
+    def __init__(
+        self,
+        inner: LLM,
+        provider: Any,
+        priority: LLMPriority = LLMPriority.INTERACTIVE,
+        **kwargs: Any,
+    ):
+        # 提示词的格式化和原模型保持一致
+        super().__init__(
+            callback_manager=inner.callback_manager,
+            system_prompt=inner.system_prompt,
+            messages_to_prompt=inner.messages_to_prompt,
+            completion_to_prompt=inner.completion_to_prompt,
+            output_parser=inner.output_parser,
+            pydantic_program_mode=inner.pydantic_program_mode,
+            **kwargs,
+        )
+        self._inner = inner
+        self._provider = provider
+        self._model = inner.metadata.model_name
+        self._priority = priority
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ScheduledLlamaLLM"
+
+    @property
+    def inner(self) -> LLM:
+        return self._inner
+
+    @property
+    def provider_name(self) -> str:
+        return get_provider_name(self._provider)
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return self._inner.metadata
+
+    def _call(self, func):
+        return llm_scheduler.call(func, self._provider, self._model, self._priority)
+
+    async def _acall(self, func):
+        return await llm_scheduler.acall(
+            func, self._provider, self._model, self._priority
+        )
+
+    def _stream(self, open_stream):
+        return llm_scheduler.stream_call(
+            open_stream, self._provider, self._model, self._priority
+        )
+
+    def _astream(self, open_stream):
+        return llm_scheduler.astream_call(
+            open_stream, self._provider, self._model, self._priority
+        )
+
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        return self._call(lambda: self._inner.chat(messages, **kwargs))
+
+    def complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        return self._call(lambda: self._inner.complete(prompt, formatted, **kwargs))
+
+    def stream_chat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponseGen:
+        return self._stream(lambda: self._inner.stream_chat(messages, **kwargs))
+
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        return self._stream(
+            lambda: self._inner.stream_complete(prompt, formatted, **kwargs)
+        )
+
+    async def achat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponse:
+        return await self._acall(lambda: self._inner.achat(messages, **kwargs))
+
+    async def acomplete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        return await self._acall(
+            lambda: self._inner.acomplete(prompt, formatted, **kwargs)
+        )
+
+    async def astream_chat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponseAsyncGen:
+        async def open_stream():
+            stream = await self._inner.astream_chat(messages, **kwargs)
+            async for chunk in stream:
+                yield chunk
+
+        return self._astream(open_stream)
+
+    async def astream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        async def open_stream():
+            stream = await self._inner.astream_complete(prompt, formatted, **kwargs)
+            async for chunk in stream:
+                yield chunk
+
+        return self._astream(open_stream)
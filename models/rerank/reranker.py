@@ -1,17 +1,76 @@
-from typing import Optional
+from typing import List, Optional
 
 from dotenv import load_dotenv
 from llama_index.core import Settings
+from llama_index.core.callbacks import CBEventType, EventPayload
 from llama_index.core.llms import LLM
 import os
 
 from llama_index.core.postprocessor.rankGPT_rerank import RankGPTRerank
 from llama_index.core.postprocessor.sbert_rerank import SentenceTransformerRerank
-from llama_index.postprocessor.jinaai_rerank.base import JinaRerank
+from llama_index.core.schema import MetadataMode, NodeWithScore
+from llama_index.postprocessor.jinaai_rerank.base import (
+    DEFAULT_JINA_AI_API_URL,
+    JinaRerank,
+)
+
+from models.factory.llm_client_cache import shared_http_clients
 
 load_dotenv()
 
 
+class AsyncJinaRerank(JinaRerank):
+    """JinaRerank只有requests的同步调用,这里加上httpx的异步调用
+    top_n按参数传入,并发的请求不会互相修改
+    """
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "AsyncJinaRerank"
+
+    async def arerank(
+        self, query: str, nodes: List[NodeWithScore], top_n: int
+    ) -> List[NodeWithScore]:
+        if len(nodes) == 0:
+            return []
+
+        with self.callback_manager.event(
+            CBEventType.RERANKING,
+            payload={
+                EventPayload.NODES: nodes,
+                EventPayload.MODEL_NAME: self.model,
+                EventPayload.QUERY_STR: query,
+                EventPayload.TOP_K: top_n,
+            },
+        ) as event:
+            _, async_client = shared_http_clients.get(DEFAULT_JINA_AI_API_URL)
+            response = await async_client.post(
+                self.api_url,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                json={
+                    "query": query,
+                    "documents": [
+                        node.node.get_content(metadata_mode=MetadataMode.EMBED)
+                        for node in nodes
+                    ],
+                    "model": self.model,
+                    "top_n": top_n,
+                },
+            )
+            resp = response.json()
+            if "results" not in resp:
+                raise RuntimeError(resp.get("detail", resp))
+
+            new_nodes = [
+                NodeWithScore(
+                    node=nodes[result["index"]].node, score=result["relevance_score"]
+                )
+                for result in resp["results"]
+            ]
+            event.on_end(payload={EventPayload.NODES: new_nodes})
+        return new_nodes
+
+
 class RagReranker:
     """重排序3种类型
     1.排序模型
@@ -33,14 +92,12 @@ class RagReranker:
         return reranker
 
     @staticmethod
-    def get_jina_rerank(top_n: int = 3) -> JinaRerank:
+    def get_jina_rerank(top_n: int = 3) -> AsyncJinaRerank:
         # pip install llama-index-postprocessor-jinaai-rerank
-        from llama_index.postprocessor.jinaai_rerank import JinaRerank
-
         # jina-reranker-v1-base-en
         # jina-reranker-v2-base-multilingual
         # 远程模型
-        jina_reranker = JinaRerank(
+        jina_reranker = AsyncJinaRerank(
             top_n=top_n,
             model="jina-reranker-v1-base-en",
             api_key=os.getenv("JINA_API_KEY"),
@@ -22,12 +22,27 @@ class RagConfiguration:
     def get_embedding_config(self):
         return self.config['rag']['embedding']['config']
 
+    def get_embedding_cache_config(self):
+        return self.config['rag']['embedding']['cache']
+
+    def get_document_embedding_cache_config(self):
+        return self.config['rag']['embedding']['document_cache']
+
     def get_embedding_name(self):
         return self.config['rag']['embedding']['config']['config_model_name']
 
     def get_embedding_info(self, simple_embedding_name: str):
         return self.config['rag']['embedding'][simple_embedding_name]
 
+    def get_pdf_reader_config(self):
+        return self.config['rag']['reader']['pdf']
+
+    def get_image_caption_config(self):
+        return self.config['rag']['reader']['image_caption']
+
+    def get_registry_config(self):
+        return self.config['rag']['registry']
+
     def get_retriever_config(self):
         return self.config['rag']['retriver']
 
@@ -8,6 +8,7 @@ from pymilvus import MilvusClient
 from rag.config.rag_config import RagConfiguration
 from utils.image_utils import get_image_base64
 from utils.log_utils import LogUtils
+from utils.metrics import track_storage
 
 
 # 跟文件关联的节点
@@ -58,6 +59,7 @@ class MyMilvusClient:
     def __init__(self):
         self.client = MilvusClient(uri=RagConfiguration().get_milvus_uri())
 
+    @track_storage("milvus")
     def search_nodes_from_file_id(self, collect_name, file_id: str):
         # 构建 SQL 过滤条件
         filter_condition = f'file_id == "{file_id}"'
@@ -83,6 +85,7 @@ class MyMilvusClient:
 
         return nodes
 
+    @track_storage("milvus")
     def delete_nodes_from_file_id(self, collect_name, file_id: str):
         filter_condition = f'file_id == "{file_id}"'
         res = self.client.delete(
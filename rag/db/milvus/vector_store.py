@@ -1,5 +1,11 @@
+import asyncio
 import time
+from typing import Any
 
+from llama_index.core.vector_stores.types import (
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
 from llama_index.vector_stores.milvus import MilvusVectorStore
 
 from rag.config.rag_config import RagConfiguration
@@ -7,11 +13,26 @@ from rag.db.milvus.sparse_bedding import LocalSparseEmbeddingFunction
 from utils.log_utils import LogUtils
 
 
+class AsyncMilvusVectorStore(MilvusVectorStore):
+    """MilvusVectorStore没有实现aquery,默认的aquery是在事件循环里同步查询
+    pymilvus的客户端是线程安全的,放到线程里查询
+    """
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "AsyncMilvusVectorStore"
+
+    async def aquery(
+        self, query: VectorStoreQuery, **kwargs: Any
+    ) -> VectorStoreQueryResult:
+        return await asyncio.to_thread(self.query, query, **kwargs)
+
+
 def load_single_milvus(
         overwrite=False, collection_name: str = "hope_test", dim: int = 1024
 ) -> MilvusVectorStore:
     start_time = time.time()
-    vector_store = MilvusVectorStore(
+    vector_store = AsyncMilvusVectorStore(
         uri=RagConfiguration().get_milvus_uri(),
         collection_name=collection_name,
         dim=dim,
@@ -26,7 +47,7 @@ def load_hybrid_milvus(
         overwrite=False, collection_name: str = "hope_test", dim: int = 1024
 ) -> MilvusVectorStore:
     start_time = time.time()
-    vector_store = MilvusVectorStore(
+    vector_store = AsyncMilvusVectorStore(
         uri=RagConfiguration().get_milvus_uri(),
         collection_name=collection_name,
         dim=dim,
@@ -0,0 +1,271 @@
+import asyncio
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+from rag.config.rag_config import RagConfiguration
+from utils.log_utils import LogUtils
+from utils.metrics import EMBEDDING_CACHE_REQUESTS
+
+_REDIS_KEY_PREFIX = "emb:q:"
+
+
+def normalize_query(text: str) -> str:
+    """全角半角统一,去掉首尾和重复的空白"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class QueryEmbeddingCache:
+    """查询向量的两级缓存: 进程内LRU + 可选的redis
+    向量按float16存储,内存和redis的占用都是float32的一半,检索的精度影响可以忽略
+    redis访问失败按未命中处理,不影响检索
+    """
+
+    def __init__(self, config: dict):
+        self.max_size = config["max_size"]
+        self.redis_enabled = config["redis_enabled"]
+        self.redis_db = config["redis_db"]
+        self.redis_ttl = config["redis_ttl"]
+
+        self._lock = threading.Lock()
+        self._cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._redis = None
+        self._aredis = None
+
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        raw = f"{model_name}\x00{normalize_query(text)}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _get_memory(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+        EMBEDDING_CACHE_REQUESTS.labels(
+            tier="memory", result="miss" if vector is None else "hit"
+        ).inc()
+        return vector
+
+    def _put_memory(self, key: str, vector: np.ndarray):
+        with self._lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    @staticmethod
+    def _record_redis(vector: Optional[np.ndarray]):
+        EMBEDDING_CACHE_REQUESTS.labels(
+            tier="redis", result="miss" if vector is None else "hit"
+        ).inc()
+
+    def _get_redis(self):
+        if self._redis is None:
+            from dao.redis_dao import create_sync_redis_client
+
+            self._redis = create_sync_redis_client(self.redis_db)
+        return self._redis
+
+    def _get_aredis(self):
+        if self._aredis is None:
+            import redis.asyncio as redis
+
+            from dao.redis_dao import create_redis_connection_pool
+
+            self._aredis = redis.Redis(
+                connection_pool=create_redis_connection_pool(db=self.redis_db)
+            )
+        return self._aredis
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        vector = self._get_memory(key)
+        if vector is not None or not self.redis_enabled:
+            return vector
+        try:
+            raw = self._get_redis().get(_REDIS_KEY_PREFIX + key)
+        except Exception as e:
+            LogUtils.log_error(f"query embedding cache redis get error: {e}")
+            return None
+        vector = None if raw is None else np.frombuffer(raw, dtype=np.float16)
+        self._record_redis(vector)
+        if vector is not None:
+            self._put_memory(key, vector)
+        return vector
+
+    async def aget(self, key: str) -> Optional[np.ndarray]:
+        vector = self._get_memory(key)
+        if vector is not None or not self.redis_enabled:
+            return vector
+        try:
+            raw = await self._get_aredis().get(_REDIS_KEY_PREFIX + key)
+        except Exception as e:
+            LogUtils.log_error(f"query embedding cache redis get error: {e}")
+            return None
+        vector = None if raw is None else np.frombuffer(raw, dtype=np.float16)
+        self._record_redis(vector)
+        if vector is not None:
+            self._put_memory(key, vector)
+        return vector
+
+    def put(self, key: str, embedding: List[float]):
+        vector = np.asarray(embedding, dtype=np.float16)
+        self._put_memory(key, vector)
+        if not self.redis_enabled:
+            return
+        try:
+            self._get_redis().set(
+                _REDIS_KEY_PREFIX + key, vector.tobytes(), ex=self.redis_ttl
+            )
+        except Exception as e:
+            LogUtils.log_error(f"query embedding cache redis set error: {e}")
+
+    async def aput(self, key: str, embedding: List[float]):
+        vector = np.asarray(embedding, dtype=np.float16)
+        self._put_memory(key, vector)
+        if not self.redis_enabled:
+            return
+        try:
+            await self._get_aredis().set(
+                _REDIS_KEY_PREFIX + key, vector.tobytes(), ex=self.redis_ttl
+            )
+        except Exception as e:
+            LogUtils.log_error(f"query embedding cache redis set error: {e}")
+
+    async def aclose(self):
+        if self._aredis is not None:
+            await self._aredis.aclose()
+            await self._aredis.connection_pool.disconnect()
+            self._aredis = None
+        if self._redis is not None:
+            self._redis.close()
+            self._redis = None
+
+
+def _to_list(vector: np.ndarray) -> List[float]:
+    return vector.astype(np.float32).tolist()
+
+
+class CachedEmbedding(BaseEmbedding):
+    """包装向量模型,只缓存查询的向量,文档的向量直接调用原模型
+    设置成 Settings.embed_model 之后,检索和语义缓存都会经过缓存
+    """
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _cache: QueryEmbeddingCache = PrivateAttr()
+    _cache_model_name: str = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, cache: QueryEmbeddingCache, **kwargs: Any):
+        super().__init__(
+            model_name=inner.model_name,
+            embed_batch_size=inner.embed_batch_size,
+            callback_manager=inner.callback_manager,
+            **kwargs,
+        )
+        self._inner = inner
+        self._cache = cache
+        self._cache_model_name = f"{inner.class_name()}:{inner.model_name}"
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def inner(self) -> BaseEmbedding:
+        return self._inner
+
+    def _key(self, query: str) -> str:
+        return self._cache.make_key(self._cache_model_name, query)
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        key = self._key(query)
+        vector = self._cache.get(key)
+        if vector is not None:
+            return _to_list(vector)
+        embedding = self._inner._get_query_embedding(query)
+        self._cache.put(key, embedding)
+        return embedding
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        key = self._key(query)
+        vector = await self._cache.aget(key)
+        if vector is not None:
+            return _to_list(vector)
+        embedding = await self._inner._aget_query_embedding(query)
+        await self._cache.aput(key, embedding)
+        return embedding
+
+    def get_query_embedding_batch(self, queries: List[str]) -> List[List[float]]:
+        """只有未命中的查询交给原模型,原模型支持批量时一次请求"""
+        keys = [self._key(query) for query in queries]
+        results: List[Optional[List[float]]] = []
+        for key in keys:
+            vector = self._cache.get(key)
+            results.append(None if vector is None else _to_list(vector))
+
+        missing = [index for index, result in enumerate(results) if result is None]
+        if missing:
+            missing_queries = [queries[index] for index in missing]
+            if hasattr(self._inner, "get_query_embedding_batch"):
+                embeddings = self._inner.get_query_embedding_batch(missing_queries)
+            else:
+                embeddings = [
+                    self._inner._get_query_embedding(query) for query in missing_queries
+                ]
+            for index, embedding in zip(missing, embeddings):
+                results[index] = embedding
+                self._cache.put(keys[index], embedding)
+        return results
+
+    async def aget_query_embedding_batch(
+        self, queries: List[str]
+    ) -> List[List[float]]:
+        keys = [self._key(query) for query in queries]
+        vectors = await asyncio.gather(*[self._cache.aget(key) for key in keys])
+        results: List[Optional[List[float]]] = [
+            None if vector is None else _to_list(vector) for vector in vectors
+        ]
+
+        missing = [index for index, result in enumerate(results) if result is None]
+        if missing:
+            missing_queries = [queries[index] for index in missing]
+            if hasattr(self._inner, "aget_query_embedding_batch"):
+                embeddings = await self._inner.aget_query_embedding_batch(
+                    missing_queries
+                )
+            else:
+                embeddings = await asyncio.gather(
+                    *[
+                        self._inner._aget_query_embedding(query)
+                        for query in missing_queries
+                    ]
+                )
+            for index, embedding in zip(missing, embeddings):
+                results[index] = embedding
+            await asyncio.gather(
+                *[self._cache.aput(keys[index], results[index]) for index in missing]
+            )
+        return results
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._inner._get_text_embedding(text)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return await self._inner._aget_text_embedding(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._inner._get_text_embeddings(texts)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return await self._inner._aget_text_embeddings(texts)
+
+
+query_embedding_cache = QueryEmbeddingCache(
+    RagConfiguration().get_embedding_cache_config()
+)
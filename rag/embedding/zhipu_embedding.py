@@ -1,3 +1,4 @@
+import asyncio
 from enum import Enum
 from typing import Optional, Any, List, Union
 
@@ -92,12 +93,29 @@ class ZhipuEmbedding(BaseEmbedding):
             api_key=self._api_key,
         )
 
-    # TODO: use proper async methods
+    # zhipuai的SDK没有异步的embeddings接口,放到线程里调用,不阻塞事件循环
     async def _aget_text_embedding(self, query: str) -> List[float]:
         """Get text embedding."""
-        return self._get_text_embedding(query)
+        return await asyncio.to_thread(self._get_text_embedding, query)
 
-    # TODO: user proper async methods
     async def _aget_query_embedding(self, query: str) -> List[float]:
         """Get query embedding."""
-        return self._get_query_embedding(query)
+        return await asyncio.to_thread(self._get_query_embedding, query)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Get text embeddings."""
+        return await asyncio.to_thread(self._get_text_embeddings, texts)
+
+    def get_query_embedding_batch(self, queries: List[str]) -> List[List[float]]:
+        """多路查询的向量一次请求计算,查询和文本的向量是同一个接口"""
+        embeddings = []
+        for start in range(0, len(queries), self.embed_batch_size):
+            embeddings.extend(
+                self._get_text_embeddings(queries[start:start + self.embed_batch_size])
+            )
+        return embeddings
+
+    async def aget_query_embedding_batch(
+            self, queries: List[str]
+    ) -> List[List[float]]:
+        return await asyncio.to_thread(self.get_query_embedding_batch, queries)
@@ -1,6 +1,7 @@
 import time
 
 from rag.config.rag_config import RagConfiguration
+from rag.embedding.cached_embedding import CachedEmbedding, query_embedding_cache
 from rag.embedding.embedding_models import get_embedding_model, get_simple_embedding_name
 from utils.log_utils import LogUtils
 
@@ -25,6 +26,9 @@ class EmbeddingManager:
             self.embedding_name = embedding_name
 
         self.embed_model = get_embedding_model(self.embedding_type, self.embedding_name)
+        if RagConfiguration().get_embedding_cache_config()["enabled"]:
+            # 查询向量经过两级缓存,文档的向量不缓存
+            self.embed_model = CachedEmbedding(self.embed_model, query_embedding_cache)
 
         elapsed_time = round(time.time() - start_time, 2)  # Calculate elapsed time
         LogUtils.log_info(f"Embedding model loaded in {elapsed_time} seconds")
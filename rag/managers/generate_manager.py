@@ -46,3 +46,12 @@ class GenerateManager:
         )
 
         return response
+
+    async def agenerate_stream_response(
+        self, query_str: str, nodes: List[NodeWithScore]
+    ) -> RESPONSE_TYPE:
+        """返回AsyncStreamingResponse, response_gen是异步生成器"""
+        return await self.response_synthesizer.asynthesize(
+            query=query_str,
+            nodes=nodes,
+        )
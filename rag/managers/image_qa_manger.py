@@ -1,10 +1,15 @@
+import asyncio
 import time
 
 from llama_index.core.schema import NodeWithScore
 
+from models.factory.llm_scheduler import LLMPriority, llm_scheduler
 from utils.image_utils import get_image_base64_url
 from utils.log_utils import LogUtils
-from utils.multi_modal_utils import get_mutil_modal_config_model
+from utils.multi_modal_utils import (
+    get_mutil_modal_config_item,
+    get_mutil_modal_model,
+)
 
 IMAGE_QA_PROMPT = (
     "你是一个善于解析图片内容的专家,根据用户的问题,参考下面提供的照片,回答问题"
@@ -13,9 +18,27 @@ IMAGE_QA_PROMPT = (
 )
 
 
+def _build_inputs(query: str, image_urls: list[str]):
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": IMAGE_QA_PROMPT.format(query=query),
+                },
+            ]
+            + [{"type": "image_url", "image_url": {"url": url}} for url in image_urls],
+        },
+    ]
+
+
 class ImageNodeQAManager:
     def __init__(self):
-        self.multi_modal_llm = get_mutil_modal_config_model()
+        modal_item = get_mutil_modal_config_item()
+        self.model_name = modal_item[0]
+        self.model_type = modal_item[1]
+        self.multi_modal_llm = get_mutil_modal_model(self.model_name)
 
     def generate_image_node_answer(self, query: str, image_nodes: list[NodeWithScore]):
         image_urls = []
@@ -24,21 +47,7 @@ class ImageNodeQAManager:
                 get_image_base64_url(image_node.node.metadata["file_path"])
             )
 
-        inputs = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": IMAGE_QA_PROMPT.format(query=query),
-                    },
-                ]
-                + [
-                    {"type": "image_url", "image_url": {"url": url}}
-                    for url in image_urls
-                ],
-            },
-        ]
+        inputs = _build_inputs(query, image_urls)
         start_time = time.time()
 
         try:
@@ -51,3 +60,36 @@ class ImageNodeQAManager:
         except Exception as e:
             LogUtils.log_error("发生了一个错误：", str(e))
             return ""
+
+    async def agenerate_image_node_answer(
+        self, query: str, image_nodes: list[NodeWithScore]
+    ):
+        """读图片和调用多模态模型都不阻塞事件循环,用户在等待回答,按INTERACTIVE排队"""
+        image_urls = await asyncio.gather(
+            *[
+                asyncio.to_thread(
+                    get_image_base64_url, image_node.node.metadata["file_path"]
+                )
+                for image_node in image_nodes
+            ]
+        )
+
+        inputs = _build_inputs(query, list(image_urls))
+        start_time = time.time()
+
+        try:
+            response = await llm_scheduler.ainvoke(
+                self.multi_modal_llm,
+                inputs,
+                self.model_type,
+                self.model_name,
+                LLMPriority.INTERACTIVE,
+            )
+
+            cost_time = round(time.time() - start_time, 2)
+            LogUtils.log_info(f"multi_modal_llm cost time: {cost_time} seconds")
+            LogUtils.log_info(f"multi_modal_llm answer: {response.content}")
+            return response.content
+        except Exception as e:
+            LogUtils.log_error("发生了一个错误：", str(e))
+            return ""
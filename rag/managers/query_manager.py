@@ -6,6 +6,7 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 
 from models.factory.llm_factory import LLMFactory
+from models.factory.llm_scheduler import LLMPriority, llm_scheduler
 from models.model_type import LLMType
 from utils.log_utils import LogUtils
 
@@ -69,6 +70,27 @@ class QueryManager:
         LogUtils.log_info(f"parse_question: {parse_question}")
         return parse_question, parse_elapsed_time
 
+    async def aparse_context_question(self, origin_query: str, context: str):
+        """用户在等待回答,经过调度器按INTERACTIVE排队"""
+        start_time = time.time()
+        if context is None:
+            return origin_query, "0"
+
+        rag_parse_prompt = ChatPromptTemplate.from_template(CONTEXT_PARSE_PROMPT)
+        parse_chain = rag_parse_prompt | self.parse_context_llm | StrOutputParser()
+        parse_question = await llm_scheduler.ainvoke(
+            parse_chain,
+            {"ask": origin_query, "context": context},
+            LLMType.ZHIPU,
+            "GLM-4-Flash",
+            LLMPriority.INTERACTIVE,
+        )
+
+        parse_elapsed_time = str(round(time.time() - start_time, 2))
+        LogUtils.log_info(f"parse_elapsed_time:{parse_elapsed_time} seconds")
+        LogUtils.log_info(f"parse_question: {parse_question}")
+        return parse_question, parse_elapsed_time
+
 
 if __name__ == "__main__":
     # query_manager = QueryManager()
@@ -1,26 +1,47 @@
 import os
 import time
-import uuid
 from typing import Optional, List
 
 from llama_index.core import Document, SimpleDirectoryReader
 from llama_index.readers.file import PyMuPDFReader
 from tqdm import tqdm
 
-from rag.reader.image_reader import HopeImageVisionLLMReader
-from rag.reader.pdf.extract_pdf_img import parse_pdf_to_images
+from rag.config.rag_config import RagConfiguration
+from rag.rag_utils import get_file_id
+from rag.reader.image_reader import HopeImageVisionLLMReader, ImagePathReader
+from rag.reader.pdf.extract_pdf_img import (
+    get_legacy_output_dir,
+    get_output_dir,
+    parse_pdfs_to_images,
+    remove_output_dir,
+)
 from utils.log_utils import LogUtils
 
 
 class ReaderManager:
     def __init__(self):
         # 定义支持的文件类型及其对应的读取器
+        # 读取时只记录图片路径,读取完之后由image_captioner并发生成描述
         self.file_extractor = {
             ".pdf": PyMuPDFReader(),
-            ".png": HopeImageVisionLLMReader(),
-            ".jpg": HopeImageVisionLLMReader(),
-            ".jpeg": HopeImageVisionLLMReader(),
+            ".png": ImagePathReader(),
+            ".jpg": ImagePathReader(),
+            ".jpeg": ImagePathReader(),
         }
+        self.image_captioner = HopeImageVisionLLMReader()
+        self.pdf_config = RagConfiguration().get_pdf_reader_config()
+
+    def _parse_pdfs_to_images(self, pdf_file_paths: list[str]) -> None:
+        """所有PDF的页一起分配给进程池"""
+        start_time = time.time()
+        parse_pdfs_to_images(
+            pdf_file_paths,
+            max_workers=self.pdf_config["workers"],
+            pages_per_task=self.pdf_config["pages_per_task"],
+        )
+        LogUtils.log_info(
+            f"{len(pdf_file_paths)} 个PDF文件的图片提取完成,耗时 {round(time.time() - start_time, 2)}秒"
+        )
 
     def manual_load_pdf(
             self, input_dir: Optional[str] = None, input_files: Optional[List] = None
@@ -50,28 +71,31 @@ class ReaderManager:
             LogUtils.log_info(f"在提供的文件列表中找到 {len(pdf_files)} 个PDF文件")
 
         if pdf_files:
-            for pdf_file in tqdm(pdf_files, desc="提取PDF文件的图片"):
-                LogUtils.log_info(f"正在处理文件: {pdf_file}")
-                parse_pdf_to_images(pdf_file)
+            self._parse_pdfs_to_images(pdf_files)
 
         LogUtils.log_info("PDF文件图片提取完成")
 
     def _extract_pdf_image_document(
-            self, pdf_file_paths: list[str], need_extrac_img: bool = True
+            self,
+            pdf_file_paths: list[str],
+            need_extrac_img: bool = True,
+            tenant: Optional[str] = None,
     ) -> list[Document]:
         all_img_documents = []
 
+        # 可以手动在本地提取,然后清洗过滤,就不需要自动提取了
+        if need_extrac_img:
+            self._parse_pdfs_to_images(pdf_file_paths)
+
         for pdf_file_path in tqdm(pdf_file_paths, desc="提取PDF文件的图片文档"):
-            output_dir, _ = os.path.splitext(pdf_file_path)
-            # 可以手动在本地提取,然后清洗过滤,就不需要自动提取了
-            if need_extrac_img:
-                parse_pdf_to_images(pdf_file_path)
+            output_dir = get_output_dir(pdf_file_path)
+            if not need_extrac_img and not os.path.isdir(output_dir):
+                # 之前的版本手动提取和清洗过的图片在同名目录下
+                output_dir = get_legacy_output_dir(pdf_file_path)
 
             if os.path.exists(output_dir) and os.listdir(output_dir):
-                # 根据文件路径生成唯一的文件ID
-                file_id = str(
-                    uuid.uuid5(uuid.NAMESPACE_URL, os.path.abspath(pdf_file_path))
-                )
+                # 根据租户和文件路径生成唯一的文件ID
+                file_id = get_file_id(pdf_file_path, tenant)
 
                 LogUtils.log_info(f"\n正在提取图片内容：{pdf_file_path}")
 
@@ -96,13 +120,17 @@ class ReaderManager:
 
                 all_img_documents.extend(file_img_documents)
 
+        # 所有PDF的图片一起生成描述
+        self.image_captioner.caption_documents(all_img_documents)
         LogUtils.log_info(f"总共提取了 {len(all_img_documents)} 个图片文档")
         return all_img_documents
 
     def load_file_list(
             self, input_file_paths: List[str],
-            need_extrac_img: bool = True
+            need_extrac_img: bool = True,
+            tenant: Optional[str] = None,
     ) -> List[Document]:
+        """读取文件,文档的file_id按租户生成,共用的ReaderManager不记录租户"""
 
         start_time = time.time()
 
@@ -111,7 +139,9 @@ class ReaderManager:
 
         img_documents = (
             self._extract_pdf_image_document(
-                pdf_file_paths=pdf_file_paths, need_extrac_img=need_extrac_img
+                pdf_file_paths=pdf_file_paths,
+                need_extrac_img=need_extrac_img,
+                tenant=tenant,
             )
             if pdf_file_paths
             else []
@@ -121,30 +151,46 @@ class ReaderManager:
             input_files=input_file_paths,
             file_extractor=self.file_extractor,
         ).load_data(show_progress=True)
+        self.image_captioner.caption_documents(text_documents)
 
-        return self._process_documents(text_documents, img_documents, start_time)
+        return self._process_documents(
+            text_documents, img_documents, start_time, tenant
+        )
 
     def load_file_dir(
             self, input_dir: str,
             need_extrac_img: bool = True
     ) -> list[Document]:
+        return self.load_file_list(
+            input_file_paths=self.list_file_dir(input_dir),
+            need_extrac_img=need_extrac_img,
+        )
+
+    @staticmethod
+    def remove_pdf_images(file_paths: List[str]) -> None:
+        """删除PDF提取的图片目录,PDF从知识库删除时调用"""
+        for file_path in file_paths:
+            if file_path.lower().endswith(".pdf"):
+                remove_output_dir(file_path)
+
+    @staticmethod
+    def list_file_dir(input_dir: str) -> list[str]:
+        """目录下所有文件的绝对路径,不包含子目录"""
         if not os.path.isdir(input_dir):
             raise ValueError(f"提供的路径 '{input_dir}' 不是一个有效的目录")
 
-        input_file_paths = [
+        return [
             os.path.abspath(os.path.join(input_dir, f))
             for f in os.listdir(input_dir)
             if os.path.isfile(os.path.join(input_dir, f))
         ]
-        return self.load_file_list(
-            input_file_paths=input_file_paths, need_extrac_img=need_extrac_img
-        )
 
     def _process_documents(
             self,
             text_documents: list[Document],
             img_documents: list[Document],
             start_time: float,
+            tenant: Optional[str] = None,
     ) -> list[Document]:
         """
         处理文档，添加文件ID，并计算加载时间
@@ -153,14 +199,13 @@ class ReaderManager:
             text_documents: 原始文档列表
             img_documents: 图片文档列表
             start_time: 开始时间
+            tenant: 租户,用于生成文件ID
 
         Returns:
             处理后的所有文档列表
         """
         for text_document_item in text_documents:
-            file_id = str(
-                uuid.uuid5(uuid.NAMESPACE_URL, text_document_item.metadata["file_path"])
-            )
+            file_id = get_file_id(text_document_item.metadata["file_path"], tenant)
             text_document_item.metadata["file_id"] = file_id
             text_document_item.excluded_llm_metadata_keys.append("file_id")
             text_document_item.excluded_embed_metadata_keys.append("file_id")
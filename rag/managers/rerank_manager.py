@@ -1,3 +1,4 @@
+import asyncio
 import time
 from typing import List
 
@@ -40,3 +41,29 @@ class RerankManager:
         except Exception as e:
             LogUtils.log_error(f"RerankManager rerank error: {e}")
             return nodes[: self.rerank_top_n]
+
+    async def arerank(
+        self,
+        query: str,
+        nodes: List[NodeWithScore],
+        rag_config: RagFrontendConfig = None,
+    ) -> List[NodeWithScore]:
+        """top_n只在这次调用里使用,不修改共用的重排序模型"""
+        top_n = rag_config.rag_rerank_count if rag_config else self.rerank_top_n
+
+        try:
+            if hasattr(self.rerank_model, "arerank"):
+                rerank_nodes = await self.rerank_model.arerank(query, nodes, top_n)
+            else:
+                # 本地模型等没有异步接口的,复制一份设置top_n,放到线程里计算
+                rerank_model = self.rerank_model.model_copy(update={"top_n": top_n})
+                rerank_nodes = await asyncio.to_thread(
+                    rerank_model.postprocess_nodes, nodes, query_str=query
+                )
+            LogUtils.log_info(f"rerank {len(rerank_nodes)} nodes")
+            for node in rerank_nodes:
+                LogUtils.log_info(f"{node.node_id} : {node.score}")
+            return rerank_nodes
+        except Exception as e:
+            LogUtils.log_error(f"RerankManager rerank error: {e}")
+            return nodes[:top_n]
@@ -1,5 +1,6 @@
 from typing import List
 
+from llama_index.core.base.embeddings.base import BaseEmbedding
 from llama_index.core.schema import NodeWithScore
 from llama_index.core.vector_stores.types import (
     BasePydanticVectorStore,
@@ -12,11 +13,16 @@ from schema.rag_config import RagFrontendConfig
 
 
 class RetrieverManager:
-    def __init__(self, vector_store: BasePydanticVectorStore) -> None:
+    def __init__(
+        self,
+        vector_store: BasePydanticVectorStore,
+        embed_model: BaseEmbedding = None,
+    ) -> None:
         self.vector_store = vector_store
 
         self.hope_retriever = HopeRetriever(
             vector_store=vector_store,
+            embed_model=embed_model,
         )
 
     def retrieve_chunk(
@@ -28,7 +34,23 @@ class RetrieverManager:
         nodes = self.hope_retriever.retrieve(
             query=query, filters=filters, rag_config=rag_config
         )
+        self._log_nodes(nodes)
+        return nodes
+
+    async def aretrieve_chunk(
+        self,
+        query: str,
+        rag_config: RagFrontendConfig = None,
+        filters: MetadataFilters = None,
+    ) -> List[NodeWithScore]:
+        nodes = await self.hope_retriever.aretrieve(
+            query=query, filters=filters, rag_config=rag_config
+        )
+        self._log_nodes(nodes)
+        return nodes
+
+    @staticmethod
+    def _log_nodes(nodes: List[NodeWithScore]):
         LogUtils.log_info(f"retrieve_chunk {len(nodes)} nodes: ")
         for node in nodes:
             LogUtils.log_info(f"{node.node_id} : {node.score}")
-        return nodes
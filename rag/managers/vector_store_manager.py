@@ -1,14 +1,39 @@
 # 导入所需的库和模块
+import hashlib
 from time import time
 from llama_index.vector_stores.milvus.base import MilvusVectorStore
+from dao.chunk_embedding_dao import ChunkEmbeddingDao
+from rag.config.rag_config import RagConfiguration
 from rag.db.milvus.vector_store import load_hybrid_milvus, load_single_milvus
 from utils.log_utils import LogUtils
+from utils.metrics import EMBEDDING_CACHE_REQUESTS, track_storage
 from llama_index.core import (
+    Settings,
     StorageContext,
     VectorStoreIndex,
 )
 
-from llama_index.core.schema import BaseNode
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.core.vector_stores import ExactMatchFilter, MetadataFilters
+
+_chunk_embedding_dao = (
+    ChunkEmbeddingDao()
+    if RagConfiguration().get_document_embedding_cache_config()["enabled"]
+    else None
+)
+
+
+def _get_embedding_model_key(embed_model: BaseEmbedding) -> str:
+    # 查询向量缓存的包装不影响文档向量,按实际的向量模型区分
+    embed_model = getattr(embed_model, "inner", embed_model)
+    return f"{embed_model.class_name()}:{embed_model.model_name}"
+
+
+def _get_chunk_hash(model_key: str, node: BaseNode) -> str:
+    # 和向量模型实际输入的内容一致: 文本 + 参与向量化的元数据
+    content = node.get_content(metadata_mode=MetadataMode.EMBED)
+    return hashlib.sha256(f"{model_key}\x00{content}".encode("utf-8")).hexdigest()
 
 
 def _get_milvus_vector_store(
@@ -31,25 +56,97 @@ class VectorStoreManager:
         self,
         collection_name: str,
         embedding_size: int,
+        embed_model: BaseEmbedding = None,
     ) -> None:
         LogUtils.log_info(
             f"初始化 VectorStoreManager，集合名称：{collection_name}，嵌入维度：{embedding_size}"
         )
         # 初始化向量存储
         self.vector_store = _get_milvus_vector_store(collection_name, embedding_size)
+        # 为空时使用全局的 Settings.embed_model
+        self.embed_model = embed_model
         LogUtils.log_info("VectorStoreManager初始化完成")
 
+    def _fill_embeddings(self, nodes: list[BaseNode]) -> None:
+        """已经计算过的片段直接复用向量,其余的批量计算后写入缓存
+        设置了embedding的node, VectorStoreIndex不会再调用向量模型
+        """
+        embed_model = self.embed_model or Settings.embed_model
+        model_key = _get_embedding_model_key(embed_model)
+        pending = [node for node in nodes if node.embedding is None]
+        hashes = [_get_chunk_hash(model_key, node) for node in pending]
+        cached = _chunk_embedding_dao.get_embeddings(list(set(hashes)))
+
+        missing = {}
+        for node, content_hash in zip(pending, hashes):
+            embedding = cached.get(content_hash)
+            if embedding is not None:
+                node.embedding = embedding
+            else:
+                missing.setdefault(content_hash, []).append(node)
+
+        reused = len(pending) - sum(len(items) for items in missing.values())
+        EMBEDDING_CACHE_REQUESTS.labels(tier="document", result="hit").inc(reused)
+        EMBEDDING_CACHE_REQUESTS.labels(tier="document", result="miss").inc(
+            len(pending) - reused
+        )
+        LogUtils.log_info(
+            f"片段向量复用{reused}个,需要计算{len(pending) - reused}个"
+        )
+        if not missing:
+            return
+
+        # 内容相同的片段只计算一次
+        texts = [
+            items[0].get_content(metadata_mode=MetadataMode.EMBED)
+            for items in missing.values()
+        ]
+        embeddings = embed_model.get_text_embedding_batch(texts, show_progress=True)
+        for items, embedding in zip(missing.values(), embeddings):
+            for node in items:
+                node.embedding = embedding
+        _chunk_embedding_dao.add_embeddings(
+            model_key, dict(zip(missing.keys(), embeddings))
+        )
+
+    @track_storage("milvus", "insert")
     def load_nodes(self, nodes: list[BaseNode]) -> None:
+        if _chunk_embedding_dao is not None:
+            self._fill_embeddings(nodes)
+
         storage_context = StorageContext.from_defaults(vector_store=self.vector_store)
 
         # 构建向量索引
         start_time = time()  # 开始计时
         LogUtils.log_info("开始构建向量索引")
         VectorStoreIndex(
-            nodes=nodes, storage_context=storage_context, show_progress=True
+            nodes=nodes,
+            storage_context=storage_context,
+            embed_model=self.embed_model,
+            show_progress=True,
         )
         elapsed_time = round(time() - start_time, 2)  # 计算耗时
         LogUtils.log_info(f"向量索引构建完成，耗时：{elapsed_time}秒")
 
+    @track_storage("milvus", "delete")
+    def delete_file_nodes(self, file_id: str) -> None:
+        """删除一个文件的所有片段,包括PDF里提取的图片"""
+        self.vector_store.delete_nodes(
+            filters=MetadataFilters(
+                filters=[ExactMatchFilter(key="file_id", value=file_id)]
+            )
+        )
+        LogUtils.log_info(f"已删除文件 {file_id} 的向量数据")
+
     def get_vector_store(self):
         return self.vector_store
+
+    def close(self) -> None:
+        """释放Milvus的连接,租户被回收时调用"""
+        client = getattr(self.vector_store, "client", None)
+        if client is None or not hasattr(client, "close"):
+            return
+        try:
+            client.close()
+        except Exception as e:
+            LogUtils.log_error(f"关闭向量存储连接失败: {e}")
@@ -1,6 +1,7 @@
+import asyncio
 import os
 import time
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
 from langfuse.llama_index import LlamaIndexCallbackHandler
@@ -9,9 +10,12 @@ from llama_index.core import Settings
 from llama_index.core.callbacks import CallbackManager
 from llama_index.core.schema import NodeWithScore
 from llama_index.core.vector_stores import MetadataFilters
+from pydantic import BaseModel
 
-from dao.knowledge_dao import KnowledgeDao
+from dao.knowledge_dao import KnowledgeDao, KnowledgeModel
 from models.llm.llamaindex.groq_llm import GroqLlmaFactory
+from models.llm.llamaindex.scheduled_llm import ScheduledLlamaLLM
+from models.model_type import LLMType
 from rag.managers.chunk_manager import ChunkManager
 from rag.managers.embedding_manager import EmbeddingManager
 from rag.managers.generate_manager import GenerateManager
@@ -21,9 +25,15 @@ from rag.managers.reader_manager import ReaderManager
 from rag.managers.rerank_manager import RerankManager
 from rag.managers.retriever_manager import RetrieverManager
 from rag.managers.vector_store_manager import VectorStoreManager
-from rag.rag_utils import get_db_collection_name
+from rag.rag_utils import (
+    DEFAULT_RAG_TENANT,
+    get_db_collection_name,
+    get_file_content_hash,
+)
 from schema.rag_config import RagFrontendConfig
 from utils.log_utils import LogUtils
+from utils.metrics import RAG_STAGE_SECONDS
+from utils.semantic_cache import invalidate_collection
 
 load_dotenv()
 os.environ["LANGFUSE_SECRET_KEY"] = os.getenv("LANGFUSE_SECRET_KEY")
@@ -48,85 +58,278 @@ def check_image_node(nodes: List[NodeWithScore]):
     return text_nodes, image_nodes
 
 
-class RagBaseManager:
+class IngestionReport(BaseModel):
+    """一次入库的文件变化,都是文件的绝对路径"""
 
-    def __init__(self, user_name: str = "admin_test") -> None:
-        """初始化所有Verba组件。"""
-        LogUtils.log_info("开始初始化HopeManager")
+    added: List[str] = []
+    changed: List[str] = []
+    removed: List[str] = []
+    unchanged: List[str] = []
 
-        start_time = time.time()
 
-        self.user_name = user_name
+class RagSharedManagers:
+    """所有租户共用的组件: 大模型,重排序,图片问答等,只创建一次"""
 
-        Settings.llm = GroqLlmaFactory().get_llm()
+    def __init__(self) -> None:
+        start_time = time.time()
+
+        # 多路查询的生成和回答的生成都经过调度器,受groq的并发和速率限制
+        Settings.llm = ScheduledLlamaLLM(GroqLlmaFactory().get_llm(), LLMType.GROQ)
 
         self.query_manager = QueryManager()
         # 初始化数据访问对象
         self.knowledge_dao = KnowledgeDao()
 
-        # 初始化各个管理器
         self.reader_manager = ReaderManager()
         self.chunk_manager = ChunkManager()
-        self.embedding_manager = EmbeddingManager()
+        self.rerank_manager = RerankManager()
+        self.image_qa_manager = ImageNodeQAManager()
+        self.generate_manager = GenerateManager()
+
+        elapsed_time = round(time.time() - start_time, 2)
+        LogUtils.log_info(f"RagSharedManagers初始化完成,耗时: {elapsed_time}秒")
+
+
+class RagBaseManager:
 
-        Settings.embed_model = self.embedding_manager.get_model()
+    def __init__(
+            self,
+            user_name: str = DEFAULT_RAG_TENANT,
+            shared: RagSharedManagers = None,
+            embedding_manager: EmbeddingManager = None,
+    ) -> None:
+        """初始化所有Verba组件。
+        shared和embedding_manager由RagManagerRegistry传入,多个租户共用,
+        单独创建时(比如入库脚本)自己加载
+        """
+        LogUtils.log_info(f"开始初始化HopeManager: {user_name}")
+
+        start_time = time.time()
+
+        self.user_name = user_name
+
+        if shared is None:
+            shared = RagSharedManagers()
+        self.shared = shared
+        self.query_manager = shared.query_manager
+        self.knowledge_dao = shared.knowledge_dao
+        self.reader_manager = shared.reader_manager
+        self.chunk_manager = shared.chunk_manager
+        self.rerank_manager = shared.rerank_manager
+        self.image_qa_manager = shared.image_qa_manager
+        self.generate_manager = shared.generate_manager
+
+        if embedding_manager is None:
+            embedding_manager = EmbeddingManager()
+            Settings.embed_model = embedding_manager.get_model()
+        self.embedding_manager = embedding_manager
 
         # 获取嵌入向量大小
         self.embedding_size = self.embedding_manager.get_dim()
 
         # 设置数据库集合名称
         self.db_collection_name = get_db_collection_name(
-            self.embedding_manager.get_simple_model_name()
+            self.embedding_manager.get_simple_model_name(), user_name
         )
-        try:
-
-            # 初始化向量存储管理器
-            self.vector_store_manager = VectorStoreManager(
-                collection_name=self.db_collection_name,
-                embedding_size=self.embedding_size,
-            )
 
-            self.retriever_manager = RetrieverManager(
-                vector_store=self.vector_store_manager.get_vector_store(),
-            )
-        except Exception as e:
-            LogUtils.log_error(f"初始化向量存储管理器失败: {e}")
+        # 连接失败直接抛出,不缓存初始化了一半的租户,下次请求重新创建
+        self.vector_store_manager = VectorStoreManager(
+            collection_name=self.db_collection_name,
+            embedding_size=self.embedding_size,
+            embed_model=self.embedding_manager.get_model(),
+        )
 
-        self.rerank_manager = RerankManager()
-        self.image_qa_manager = ImageNodeQAManager()
-        self.generate_manager = GenerateManager()
+        self.retriever_manager = RetrieverManager(
+            vector_store=self.vector_store_manager.get_vector_store(),
+            embed_model=self.embedding_manager.get_model(),
+        )
 
         elapsed_time = round(time.time() - start_time, 2)  # 计算耗时
         LogUtils.log_info(f"HopeManager初始化完成,耗时: {elapsed_time}秒")
 
+    def close(self) -> None:
+        """租户被回收时释放自己的向量库连接,共用的组件不关闭"""
+        self.vector_store_manager.close()
+
+    def get_embed_model(self):
+        return self.embedding_manager.get_model()
+
     def parse_context_question(self, origin_query: str, context: str):
-        return self.query_manager.parse_context_question(
+        start_time = time.time()
+        result = self.query_manager.parse_context_question(
             origin_query=origin_query, context=context
         )
+        self.observe_stage("parse", start_time)
+        return result
+
+    async def aparse_context_question(self, origin_query: str, context: str):
+        start_time = time.time()
+        result = await self.query_manager.aparse_context_question(
+            origin_query=origin_query, context=context
+        )
+        self.observe_stage("parse", start_time)
+        return result
 
     def get_collection_name(self):
         return self.db_collection_name
 
-    def auto_load_file_dir(self, file_dir: str) -> None:
-        self._process_documents(self.reader_manager.load_file_dir(file_dir, True))
+    def observe_stage(self, stage: str, start_time: float):
+        """记录RAG阶段的耗时到 /metrics"""
+        RAG_STAGE_SECONDS.labels(stage=stage, collection=self.db_collection_name).observe(
+            time.time() - start_time
+        )
 
-    def auto_load_file_list(self, file_list: list[str]) -> None:
-        self._process_documents(self.reader_manager.load_file_list(file_list, True))
+    def auto_load_file_dir(self, file_dir: str, force: bool = False) -> IngestionReport:
+        return self._load_files(
+            self.reader_manager.list_file_dir(file_dir), True, force, file_dir
+        )
+
+    def auto_load_file_list(
+            self, file_list: list[str], force: bool = False
+    ) -> IngestionReport:
+        return self._load_files(file_list, True, force)
 
     # 先调用ReaderManager的manual_load_pdf方法,本地提取所有图片,然后人工清洗过滤,然后下面的方法,就不需要再次提取pdf的图片了
-    def manual_load_file_dir(self, file_dir: str) -> None:
-        self._process_documents(self.reader_manager.load_file_dir(file_dir, False))
+    def manual_load_file_dir(self, file_dir: str, force: bool = False) -> IngestionReport:
+        return self._load_files(
+            self.reader_manager.list_file_dir(file_dir), False, force, file_dir
+        )
+
+    def manual_load_file_list(
+            self, file_list: list[str], force: bool = False
+    ) -> IngestionReport:
+        return self._load_files(file_list, False, force)
+
+    def _diff_files(
+            self,
+            file_paths: list[str],
+            known: Dict[str, KnowledgeModel],
+            file_dir: Optional[str],
+            force: bool,
+    ) -> Tuple[IngestionReport, Dict[str, Tuple[str, int]]]:
+        """和知识库的记录比较,找出新增,修改和删除的文件
+        大小和修改时间都没变的文件直接跳过,不读取内容; 变了再比较内容的哈希
+        返回 (文件变化, 需要入库的文件 -> (内容哈希, 修改时间))
+        """
+        report = IngestionReport()
+        file_states = {}
+
+        for file_path in file_paths:
+            knowledge = known.get(file_path)
+            if not os.path.isfile(file_path):
+                if knowledge is not None:
+                    report.removed.append(file_path)
+                else:
+                    LogUtils.log_error(f"文件不存在: {file_path}")
+                continue
+
+            stat = os.stat(file_path)
+            if (
+                    not force
+                    and knowledge is not None
+                    and knowledge.file_size == stat.st_size
+                    and knowledge.mtime == stat.st_mtime_ns
+            ):
+                report.unchanged.append(file_path)
+                continue
+
+            content_hash = get_file_content_hash(file_path)
+            if knowledge is None:
+                report.added.append(file_path)
+            elif force or knowledge.content_hash != content_hash:
+                # 之前没有记录哈希的文件也按修改处理,重新入库一次
+                report.changed.append(file_path)
+            else:
+                # 只是被touch或者复制过,更新记录的状态,下次不用再计算哈希
+                self.knowledge_dao.update_file_state_by_file_id(
+                    knowledge.file_id,
+                    content_hash,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    user_name=self.user_name,
+                )
+                report.unchanged.append(file_path)
+                continue
+            file_states[file_path] = (content_hash, stat.st_mtime_ns)
+
+        if file_dir is not None:
+            # 目录入库时,记录在这个目录下(包括子目录)但已经不存在的文件
+            # 目录的列表不包含子目录,子目录里的文件是按文件列表入库的,只有被删除了才算删除
+            dir_path = os.path.abspath(file_dir)
+            current = set(file_paths)
+            for file_path in known:
+                if not file_path.startswith(dir_path + os.sep) or file_path in current:
+                    continue
+                if os.path.dirname(file_path) == dir_path or not os.path.isfile(
+                        file_path
+                ):
+                    report.removed.append(file_path)
+
+        return report, file_states
+
+    def _load_files(
+            self,
+            file_paths: list[str],
+            need_extrac_img: bool,
+            force: bool = False,
+            file_dir: str = None,
+    ) -> IngestionReport:
+        """增量入库: 跳过没有变化的文件,修改的文件先删除旧的片段再写入新的"""
+        file_paths = [os.path.abspath(file_path) for file_path in file_paths]
+        known = {
+            knowledge.file_path: knowledge
+            for knowledge in self.knowledge_dao.get_all_knowledges_by_user_name(
+                self.user_name
+            )
+        }
+        report, file_states = self._diff_files(file_paths, known, file_dir, force)
+
+        to_load = report.added + report.changed
+        documents = (
+            self.reader_manager.load_file_list(
+                to_load, need_extrac_img, tenant=self.user_name
+            )
+            if to_load
+            else []
+        )
+
+        # 读取成功之后再删除,读取失败时知识库保持原样,下次重新检测到变化
+        for file_path in report.changed + report.removed:
+            self.vector_store_manager.delete_file_nodes(known[file_path].file_id)
+        for file_path in report.removed:
+            self.knowledge_dao.delete_knowledge_by_file_id(
+                known[file_path].file_id, user_name=self.user_name
+            )
+        self.reader_manager.remove_pdf_images(report.removed)
+
+        if documents:
+            self._process_documents(documents, file_states)
+        elif report.removed:
+            invalidate_collection(self.db_collection_name)
 
-    def manual_load_file_list(self, file_list: list[str]) -> None:
-        self._process_documents(self.reader_manager.load_file_list(file_list, False))
+        LogUtils.log_info(
+            f"{self.db_collection_name} 入库完成: 新增{len(report.added)}个,"
+            f"修改{len(report.changed)}个,删除{len(report.removed)}个,"
+            f"未变化{len(report.unchanged)}个"
+        )
+        for name in ("added", "changed", "removed"):
+            for file_path in getattr(report, name):
+                LogUtils.log_info(f"{name}: {file_path}")
+        return report
 
-    def _process_documents(self, documents: list[Document]) -> None:
+    def _process_documents(
+            self,
+            documents: list[Document],
+            file_states: Dict[str, Tuple[str, int]] = None,
+    ) -> None:
         """
         处理文档：分块、向量化并存储。
 
         Args:
             documents: 文档列表
+            file_states: 文件路径 -> (内容哈希, 修改时间),记录到知识库用于下次比较
         """
+        file_states = file_states or {}
         LogUtils.log_info(f"开始chunk {len(documents)} 个文档")
 
         # 文档分块
@@ -135,6 +338,9 @@ class RagBaseManager:
         # 加载节点到向量存储
         self.vector_store_manager.load_nodes(nodes)
 
+        # 知识库内容变了,之前缓存的回答可能过时
+        invalidate_collection(self.db_collection_name)
+
         # 将文档信息添加到知识库
         # 创建一个临时集合来存储已处理的file_id
         processed_file_ids = set()
@@ -146,6 +352,9 @@ class RagBaseManager:
 
             file_id = metadata["file_id"]
             if file_id not in processed_file_ids:
+                content_hash, mtime = file_states.get(
+                    os.path.abspath(metadata["file_path"]), (None, None)
+                )
                 self.knowledge_dao.add_new_knowledge(
                     user_name=self.user_name,
                     file_id=file_id,
@@ -155,6 +364,8 @@ class RagBaseManager:
                     chunk_size=self.chunk_manager.get_chunk_size(),
                     chunk_overlap=self.chunk_manager.get_chunk_overlap(),
                     file_title=metadata["file_name"],
+                    content_hash=content_hash,
+                    mtime=mtime,
                 )
                 processed_file_ids.add(file_id)
                 LogUtils.log_info(f"文档 {metadata['file_name']} 信息已添加到知识库")
@@ -179,6 +390,7 @@ class RagBaseManager:
             query=query, filters=filters, rag_config=rag_config
         )
         retrieve_elapsed_time = str(round(time.time() - start_time, 2))
+        self.observe_stage("retrieve", start_time)
         LogUtils.log_info(f"retrieve_elapsed_time :{retrieve_elapsed_time} seconds")
 
         langfuse_callback_handler.flush()
@@ -191,7 +403,20 @@ class RagBaseManager:
             rag_config: RagFrontendConfig = None,
             filters: MetadataFilters = None,
     ) -> Tuple[List[NodeWithScore], str]:
-        return self.retrieve_chunk(query, rag_config, filters)
+        LogUtils.log_info(f"aretrieve_chunk: {query}")
+
+        start_time = time.time()
+        retrieve_nodes = await self.retriever_manager.aretrieve_chunk(
+            query=query, filters=filters, rag_config=rag_config
+        )
+        retrieve_elapsed_time = str(round(time.time() - start_time, 2))
+        self.observe_stage("retrieve", start_time)
+        LogUtils.log_info(f"retrieve_elapsed_time :{retrieve_elapsed_time} seconds")
+
+        # flush会等待上报完成,不能在事件循环里等
+        await asyncio.to_thread(langfuse_callback_handler.flush)
+
+        return retrieve_nodes, retrieve_elapsed_time
 
     def rerank_chunks(
             self,
@@ -206,6 +431,7 @@ class RagBaseManager:
         )
 
         rerank_elapsed_time = str(round(time.time() - start_time, 2))
+        self.observe_stage("rerank", start_time)
         LogUtils.log_info(f"rerank_elapsed_time: {rerank_elapsed_time} seconds")
 
         langfuse_callback_handler.flush()
@@ -218,7 +444,19 @@ class RagBaseManager:
             retrieve_nodes: list[NodeWithScore],
             rag_config: RagFrontendConfig = None,
     ) -> Tuple[List[NodeWithScore], str]:
-        return self.rerank_chunks(origin_query, retrieve_nodes, rag_config)
+        start_time = time.time()
+
+        rerank_nodes = await self.rerank_manager.arerank(
+            origin_query, retrieve_nodes, rag_config
+        )
+
+        rerank_elapsed_time = str(round(time.time() - start_time, 2))
+        self.observe_stage("rerank", start_time)
+        LogUtils.log_info(f"rerank_elapsed_time: {rerank_elapsed_time} seconds")
+
+        await asyncio.to_thread(langfuse_callback_handler.flush)
+
+        return rerank_nodes, rerank_elapsed_time
 
     def generate_image_nodes_response(
             self, query: str, image_nodes: list[NodeWithScore]
@@ -228,6 +466,7 @@ class RagBaseManager:
         reply = self.image_qa_manager.generate_image_node_answer(query, image_nodes)
 
         iamge_qa_elapsed_time = str(round(time.time() - start_time, 2))
+        self.observe_stage("image_qa", start_time)
         LogUtils.log_info(f"iamge_qa_elapsed_time : {iamge_qa_elapsed_time} seconds")
         LogUtils.log_info(f"generate_image_nodes_response:\n {reply}")
         if reply:
@@ -239,9 +478,28 @@ class RagBaseManager:
     async def agenerate_image_nodes_response(
             self, query: str, image_nodes: list[NodeWithScore]
     ) -> Tuple[List[NodeWithScore], str]:
-        return self.generate_image_nodes_response(query, image_nodes)
+        start_time = time.time()
+
+        reply = await self.image_qa_manager.agenerate_image_node_answer(
+            query, image_nodes
+        )
+
+        iamge_qa_elapsed_time = str(round(time.time() - start_time, 2))
+        self.observe_stage("image_qa", start_time)
+        LogUtils.log_info(f"iamge_qa_elapsed_time : {iamge_qa_elapsed_time} seconds")
+        LogUtils.log_info(f"generate_image_nodes_response:\n {reply}")
+        if reply:
+            for image_node in image_nodes:
+                image_node.node.set_content(reply)
+        await asyncio.to_thread(langfuse_callback_handler.flush)
+        return image_nodes, iamge_qa_elapsed_time
 
     def generate_chat_stream_response(self, query: str, nodes: list[NodeWithScore]):
         reply = self.generate_manager.generate_stream_response(query, nodes)
         # langfuse_callback_handler.flush()
         return reply
+
+    async def agenerate_chat_stream_response(
+            self, query: str, nodes: list[NodeWithScore]
+    ):
+        return await self.generate_manager.agenerate_stream_response(query, nodes)
@@ -0,0 +1,380 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+from llama_index.core import Settings
+
+from rag.config.rag_config import RagConfiguration
+from rag.managers.embedding_manager import EmbeddingManager
+from rag.rag_base_manager import RagBaseManager, RagSharedManagers
+from rag.rag_utils import DEFAULT_RAG_TENANT
+from utils.log_utils import LogUtils
+
+# (租户, 向量模型类型, 向量模型名称)
+ManagerKey = tuple[str, str, str]
+
+
+@dataclass
+class _ManagerEntry:
+    key: ManagerKey
+    manager: RagBaseManager
+    created_at: float
+    last_used: float
+    # 正在使用的请求数,大于0时不回收
+    refs: int = 0
+    # 已经移出注册表,最后一个请求结束时关闭
+    closing: bool = False
+
+
+class RagManagerRegistry:
+    """按(租户, 向量模型)懒加载RagBaseManager,第一次使用时才加载模型和连接Milvus
+    大模型,重排序等共用组件只创建一次,同一个向量模型的租户共用一个向量模型,
+    每个租户只有自己的向量库集合和检索器
+    空闲超过idle_ttl秒,或者数量超过max_tenants时回收最久没用的租户,
+    处理请求时用use_manager/ause_manager持有manager,正在使用的租户不回收
+    """
+
+    def __init__(self, config: dict, embedding_config: dict):
+        self.idle_ttl = config["idle_ttl"]
+        self.max_tenants = config["max_tenants"]
+        self.evict_interval = config["evict_interval"]
+        self.warm_up_on_startup = config["warm_up_on_startup"]
+        self._tenant_config = config.get("tenant", {})
+        self._default_embedding = (embedding_config["type"], embedding_config["name"])
+
+        self._lock = threading.Lock()
+        # 每个键一个创建锁,同一个租户只创建一次,不同租户可以同时创建
+        self._build_locks: dict = {}
+        self._shared: Optional[RagSharedManagers] = None
+        self._embeddings: dict[tuple[str, str], EmbeddingManager] = {}
+        self._managers: OrderedDict[ManagerKey, _ManagerEntry] = OrderedDict()
+        # 最近一次创建失败的原因,创建成功后清掉
+        self._errors: dict[str, str] = {}
+        self._evict_task: Optional[asyncio.Task] = None
+        self._warm_up_task: Optional[asyncio.Task] = None
+
+    def _get_build_lock(self, key) -> threading.Lock:
+        with self._lock:
+            return self._build_locks.setdefault(key, threading.Lock())
+
+    def resolve_key(
+        self,
+        tenant: Optional[str] = None,
+        embedding_type: Optional[str] = None,
+        embedding_name: Optional[str] = None,
+    ) -> ManagerKey:
+        """没有指定向量模型时,先找租户单独的配置,再用默认配置"""
+        tenant = tenant or DEFAULT_RAG_TENANT
+        if embedding_type is None:
+            tenant_config = self._tenant_config.get(tenant)
+            if tenant_config:
+                embedding_type, embedding_name = (
+                    tenant_config["type"],
+                    tenant_config["name"],
+                )
+            else:
+                embedding_type, embedding_name = self._default_embedding
+        return tenant, embedding_type, embedding_name
+
+    def get_shared(self) -> RagSharedManagers:
+        if self._shared is None:
+            with self._get_build_lock("shared"):
+                if self._shared is None:
+                    self._shared = self._build("shared", RagSharedManagers)
+        return self._shared
+
+    def get_embedding_manager(
+        self, embedding_type: str, embedding_name: str
+    ) -> EmbeddingManager:
+        key = (embedding_type, embedding_name)
+        embedding_manager = self._embeddings.get(key)
+        if embedding_manager is not None:
+            return embedding_manager
+
+        with self._get_build_lock(key):
+            if key not in self._embeddings:
+                embedding_manager = self._build(
+                    f"embedding:{embedding_type}/{embedding_name}",
+                    lambda: EmbeddingManager(embedding_type, embedding_name),
+                )
+                if key == self._default_embedding:
+                    # 语义缓存等没有区分租户的地方使用默认的向量模型
+                    Settings.embed_model = embedding_manager.get_model()
+                self._embeddings[key] = embedding_manager
+        return self._embeddings[key]
+
+    def get_embed_model(self):
+        """默认的向量模型"""
+        return self.get_embedding_manager(*self._default_embedding).get_model()
+
+    def get_manager(
+        self,
+        tenant: Optional[str] = None,
+        embedding_type: Optional[str] = None,
+        embedding_name: Optional[str] = None,
+    ) -> RagBaseManager:
+        """同步创建,会加载模型和连接Milvus,在协程里使用aget_manager
+        不持有manager,处理请求时使用use_manager
+        """
+        key = self.resolve_key(tenant, embedding_type, embedding_name)
+        return self._get_entry(key, acquire=False).manager
+
+    def _get_entry(self, key: ManagerKey, acquire: bool) -> _ManagerEntry:
+        self.evict_idle()
+
+        entry = self._touch(key, acquire)
+        if entry is not None:
+            return entry
+
+        with self._get_build_lock(key):
+            entry = self._touch(key, acquire)
+            if entry is not None:
+                return entry
+
+            tenant, embedding_type, embedding_name = key
+            shared = self.get_shared()
+            embedding_manager = self.get_embedding_manager(
+                embedding_type, embedding_name
+            )
+            manager = self._build(
+                self._key_name(key),
+                lambda: RagBaseManager(
+                    tenant, shared=shared, embedding_manager=embedding_manager
+                ),
+            )
+            now = time.monotonic()
+            entry = _ManagerEntry(key, manager, now, now, refs=1 if acquire else 0)
+            with self._lock:
+                self._managers[key] = entry
+                overflow = self._pop_overflow(keep=key)
+        self._close_all(overflow, "max_tenants")
+        return entry
+
+    async def aget_manager(
+        self,
+        tenant: Optional[str] = None,
+        embedding_type: Optional[str] = None,
+        embedding_name: Optional[str] = None,
+    ) -> RagBaseManager:
+        """已经创建的直接返回,第一次使用时在线程里创建,不阻塞事件循环
+        不持有manager,处理请求时使用ause_manager
+        """
+        key = self.resolve_key(tenant, embedding_type, embedding_name)
+        entry = self._touch(key)
+        if entry is not None:
+            return entry.manager
+        return (await asyncio.to_thread(self._get_entry, key, False)).manager
+
+    @contextmanager
+    def use_manager(
+        self,
+        tenant: Optional[str] = None,
+        embedding_type: Optional[str] = None,
+        embedding_name: Optional[str] = None,
+    ):
+        """使用期间持有manager,不会被回收和关闭"""
+        key = self.resolve_key(tenant, embedding_type, embedding_name)
+        entry = self._get_entry(key, acquire=True)
+        try:
+            yield entry.manager
+        finally:
+            self._release(entry)
+
+    @asynccontextmanager
+    async def ause_manager(
+        self,
+        tenant: Optional[str] = None,
+        embedding_type: Optional[str] = None,
+        embedding_name: Optional[str] = None,
+    ):
+        """use_manager的协程版本,第一次使用时在线程里创建"""
+        key = self.resolve_key(tenant, embedding_type, embedding_name)
+        entry = self._touch(key, acquire=True)
+        while entry is None:
+            # 线程里只创建不持有,协程在等待时被取消也不会漏掉release
+            await asyncio.to_thread(self._get_entry, key, False)
+            entry = self._touch(key, acquire=True)
+        try:
+            yield entry.manager
+        finally:
+            self._release(entry)
+
+    async def aget_embed_model(self):
+        if self._default_embedding in self._embeddings:
+            return self._embeddings[self._default_embedding].get_model()
+        return await asyncio.to_thread(self.get_embed_model)
+
+    def _touch(
+        self, key: ManagerKey, acquire: bool = False
+    ) -> Optional[_ManagerEntry]:
+        with self._lock:
+            entry = self._managers.get(key)
+            if entry is None:
+                return None
+            entry.last_used = time.monotonic()
+            if acquire:
+                entry.refs += 1
+            self._managers.move_to_end(key)
+            return entry
+
+    def _release(self, entry: _ManagerEntry):
+        with self._lock:
+            entry.refs -= 1
+            entry.last_used = time.monotonic()
+            should_close = entry.refs == 0 and entry.closing
+        if should_close:
+            self._close(entry, "released")
+
+    def _build(self, name: str, factory):
+        start_time = time.time()
+        try:
+            result = factory()
+        except Exception as e:
+            LogUtils.log_error(f"RAG {name} 初始化失败: {e}")
+            with self._lock:
+                self._errors[name] = str(e)
+            raise
+        with self._lock:
+            self._errors.pop(name, None)
+        LogUtils.log_info(
+            f"RAG {name} 初始化完成,耗时: {round(time.time() - start_time, 2)}秒"
+        )
+        return result
+
+    @staticmethod
+    def _key_name(key: ManagerKey) -> str:
+        tenant, embedding_type, embedding_name = key
+        return f"tenant:{tenant}/{embedding_type}/{embedding_name}"
+
+    def _pop_overflow(self, keep: ManagerKey) -> list[_ManagerEntry]:
+        """调用方持有self._lock,从最久没用的开始回收,跳过正在使用的和刚创建的keep"""
+        overflow = []
+        for key in list(self._managers):
+            if len(self._managers) <= self.max_tenants:
+                break
+            entry = self._managers[key]
+            if entry.refs > 0 or key == keep:
+                continue
+            del self._managers[key]
+            overflow.append(entry)
+        return overflow
+
+    def evict_idle(self) -> int:
+        """回收空闲超时的租户,返回回收的数量"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                entry
+                for entry in self._managers.values()
+                if entry.refs == 0 and now - entry.last_used > self.idle_ttl
+            ]
+            for entry in expired:
+                del self._managers[entry.key]
+        self._close_all(expired, "idle")
+        return len(expired)
+
+    def _close_all(self, entries: list[_ManagerEntry], reason: str):
+        """已经移出注册表的manager,没有请求在使用的直接关闭,否则最后一个请求结束时关闭"""
+        idle, in_use = [], []
+        with self._lock:
+            for entry in entries:
+                if entry.refs > 0:
+                    entry.closing = True
+                    in_use.append((entry, entry.refs))
+                else:
+                    idle.append(entry)
+        for entry, refs in in_use:
+            LogUtils.log_info(
+                f"RAG 租户还有{refs}个请求在使用,结束之后关闭({reason}): "
+                f"{self._key_name(entry.key)}"
+            )
+        for entry in idle:
+            self._close(entry, reason)
+
+    def _close(self, entry: _ManagerEntry, reason: str):
+        LogUtils.log_info(f"RAG 回收租户({reason}): {self._key_name(entry.key)}")
+        try:
+            entry.manager.close()
+        except Exception as e:
+            LogUtils.log_error(f"RAG 回收租户失败: {e}")
+
+    def readiness(self) -> dict:
+        """就绪检查
+        懒加载时进程启动就可以接收请求; 配置了预加载时,默认租户加载完成才算就绪,
+        预加载失败时每次检查都会在后台重试
+        """
+        default_key = self.resolve_key()
+        now = time.monotonic()
+        with self._lock:
+            tenants = [
+                {
+                    "tenant": key[0],
+                    "embedding": f"{key[1]}/{key[2]}",
+                    "collection": entry.manager.get_collection_name(),
+                    "idle_seconds": round(now - entry.last_used, 1),
+                    "in_use": entry.refs,
+                }
+                for key, entry in self._managers.items()
+            ]
+            default_loaded = default_key in self._managers
+            errors = dict(self._errors)
+
+        if (
+            self.warm_up_on_startup
+            and not default_loaded
+            and self._warm_up_task is not None
+            and self._warm_up_task.done()
+        ):
+            self._warm_up_task = asyncio.create_task(self._warm_up())
+
+        return {
+            "ready": default_loaded or not self.warm_up_on_startup,
+            "shared_loaded": self._shared is not None,
+            "embeddings": [f"{t}/{n}" for t, n in self._embeddings],
+            "tenants": tenants,
+            "errors": errors,
+        }
+
+    def start(self):
+        """应用启动时调用: 定时回收空闲租户,按配置在后台预加载默认租户"""
+        if self._evict_task is None:
+            self._evict_task = asyncio.create_task(self._evict_loop())
+        if self.warm_up_on_startup and self._warm_up_task is None:
+            self._warm_up_task = asyncio.create_task(self._warm_up())
+
+    async def _warm_up(self):
+        try:
+            await self.aget_manager()
+        except Exception as e:
+            # 失败原因记录在readiness里,第一次请求时会重新创建
+            LogUtils.log_error(f"RAG 预加载失败: {e}")
+
+    async def _evict_loop(self):
+        while True:
+            await asyncio.sleep(self.evict_interval)
+            try:
+                await asyncio.to_thread(self.evict_idle)
+            except Exception as e:
+                LogUtils.log_error(f"RAG 回收空闲租户失败: {e}")
+
+    async def aclose(self):
+        for task in (self._evict_task, self._warm_up_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._evict_task = None
+        self._warm_up_task = None
+        with self._lock:
+            entries = list(self._managers.values())
+            self._managers.clear()
+        self._close_all(entries, "shutdown")
+
+
+_rag_config = RagConfiguration()
+rag_manager_registry = RagManagerRegistry(
+    _rag_config.get_registry_config(), _rag_config.get_embedding_config()
+)
@@ -1,5 +1,44 @@
+import hashlib
+import os
+import re
+import uuid
+from typing import Optional
+
+from config.base_config import BaseConfiguration
+
 COLLECTION_NAME_PREFIX = "hope_test_"
+TENANT_COLLECTION_PREFIX = "hope_tenant_"
+
+DEFAULT_RAG_TENANT = BaseConfiguration().get_username_admin_test()
+
+
+def get_db_collection_name(embedding_simple_name: str, tenant: Optional[str] = None):
+    """默认租户沿用原来的集合名,其他租户的集合名带上租户名
+    Milvus的集合名只能有字母,数字和下划线,租户名有其他字符时加上哈希避免冲突
+    """
+    if tenant is None or tenant == DEFAULT_RAG_TENANT:
+        return COLLECTION_NAME_PREFIX + embedding_simple_name
+
+    safe_tenant = re.sub(r"[^0-9a-zA-Z_]", "_", tenant)
+    if safe_tenant != tenant:
+        safe_tenant += "_" + hashlib.sha1(tenant.encode("utf-8")).hexdigest()[:8]
+    return f"{TENANT_COLLECTION_PREFIX}{safe_tenant}_{embedding_simple_name}"
+
+
+def get_file_id(file_path: str, tenant: Optional[str] = None) -> str:
+    """根据文件路径生成文件ID,不同租户入库同一个文件时ID不同
+    默认租户沿用原来只按路径生成的ID,已经入库的向量数据不需要重建
+    """
+    file_path = os.path.abspath(file_path)
+    if tenant is None or tenant == DEFAULT_RAG_TENANT:
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, file_path))
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{tenant}:{file_path}"))
 
 
-def get_db_collection_name(embedding_simple_name: str):
-    return COLLECTION_NAME_PREFIX + embedding_simple_name
+def get_file_content_hash(file_path: str, block_size: int = 1 << 20) -> str:
+    """按块读取,大文件也不会一次读进内存"""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
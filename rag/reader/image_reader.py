@@ -1,11 +1,23 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Dict, List, Optional
 
 from llama_index.core.readers.base import BaseReader
-from llama_index.core.schema import ImageDocument
+from llama_index.core.schema import Document, ImageDocument
+from tqdm import tqdm
 
+from models.factory.llm_scheduler import LLMPriority, llm_scheduler
+from rag.config.rag_config import RagConfiguration
 from utils.image_utils import get_image_base64_url
-from utils.multi_modal_utils import get_mutil_modal_config_model
+from utils.log_utils import LogUtils
+from utils.multi_modal_utils import (
+    get_mutil_modal_config_item,
+    get_mutil_modal_config_model,
+)
+
+CAPTION_PROMPT = "这张图片描述了什么,详细介绍下,要包含所有的专业术语"
 
 
 class HopeImageVisionLLMReader(BaseReader):
@@ -28,27 +40,59 @@ class HopeImageVisionLLMReader(BaseReader):
         self._keep_image = keep_image
 
         self._lc_modul_llm = get_mutil_modal_config_model()
+        self._modal_item = get_mutil_modal_config_item()
 
-    def load_data(
-            self, file: Path, extra_info: Optional[Dict] = None
-    ) -> List[ImageDocument]:
-        """Parse file."""
-
-        image_url = get_image_base64_url(file)
+        config = RagConfiguration().get_image_caption_config()
+        self._max_concurrency = config["max_concurrency"]
+        self._max_retries = config["max_retries"]
+        self._retry_backoff = config["retry_backoff"]
 
+    def _caption(self, image_url: str) -> str:
         inputs = [
             {
                 "role": "user",
                 "content": [
                     {
                         "type": "text",
-                        "text": "这张图片描述了什么,详细介绍下,要包含所有的专业术语",
+                        "text": CAPTION_PROMPT,
                     },
                     {"type": "image_url", "image_url": {"url": image_url}},
                 ],
             },
         ]
-        response = self._lc_modul_llm.invoke(inputs).content
+        # 入库的优先级最低,不会挤占用户聊天的调用名额
+        return llm_scheduler.invoke(
+            self._lc_modul_llm,
+            inputs,
+            provider=self._modal_item[1],
+            model=self._modal_item[0],
+            priority=LLMPriority.INGESTION,
+        ).content
+
+    def _caption_with_retry(self, image_path: str) -> str:
+        """429由调度器冷却重试,这里再处理超时,网络错误等失败,按指数退避重试"""
+        image_url = get_image_base64_url(image_path)
+        attempt = 0
+        while True:
+            try:
+                return self._caption(image_url)
+            except Exception as e:
+                if attempt >= self._max_retries:
+                    raise
+                delay = self._retry_backoff * (2 ** attempt) * random.uniform(0.5, 1.0)
+                LogUtils.log_error(
+                    f"图片描述失败,{round(delay, 2)}秒后重试({attempt + 1}/{self._max_retries}): {image_path}, {e}"
+                )
+                time.sleep(delay)
+                attempt += 1
+
+    def load_data(
+            self, file: Path, extra_info: Optional[Dict] = None
+    ) -> List[ImageDocument]:
+        """Parse file."""
+
+        image_url = get_image_base64_url(file)
+        response = self._caption(image_url)
         # print(response)
 
         return [
@@ -59,3 +103,64 @@ class HopeImageVisionLLMReader(BaseReader):
                 metadata=extra_info or {},
             )
         ]
+
+    def caption_documents(self, documents: List[Document]) -> None:
+        """并发生成 ImagePathReader 读取的图片文档的描述,按原来的顺序填入text
+        并发数受max_concurrency限制,provider的限流和并发由调度器控制
+        """
+        image_documents = [
+            document
+            for document in documents
+            if isinstance(document, ImageDocument)
+               and document.image_path
+               and not document.text
+        ]
+        if not image_documents:
+            return
+
+        start_time = time.time()
+        captions: List[Optional[str]] = [None] * len(image_documents)
+        with ThreadPoolExecutor(
+                max_workers=min(self._max_concurrency, len(image_documents)),
+                thread_name_prefix="image-caption",
+        ) as executor:
+            futures = {
+                executor.submit(self._caption_with_retry, document.image_path): index
+                for index, document in enumerate(image_documents)
+            }
+            try:
+                for future in tqdm(
+                        as_completed(futures), total=len(futures), desc="生成图片描述"
+                ):
+                    captions[futures[future]] = future.result()
+            except BaseException:
+                # 一张图片重试之后仍然失败,整批失败,未开始的任务不再执行
+                for future in futures:
+                    future.cancel()
+                raise
+
+        for document, caption in zip(image_documents, captions):
+            document.set_content(caption)
+            if self._keep_image:
+                document.image = get_image_base64_url(document.image_path)
+
+        LogUtils.log_info(
+            f"生成了 {len(image_documents)} 张图片的描述,耗时 {round(time.time() - start_time, 2)}秒"
+        )
+
+
+class ImagePathReader(BaseReader):
+    """只记录图片路径,不调用大模型
+    SimpleDirectoryReader 按文件串行读取,图片描述之后由 caption_documents 统一并发生成
+    """
+
+    def load_data(
+            self, file: Path, extra_info: Optional[Dict] = None
+    ) -> List[ImageDocument]:
+        return [
+            ImageDocument(
+                text="",
+                image_path=str(file),
+                metadata=extra_info or {},
+            )
+        ]
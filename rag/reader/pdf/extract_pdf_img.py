@@ -1,12 +1,15 @@
 import logging
+import multiprocessing
 import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import List, Tuple, Optional
 
 import fitz  # PyMuPDF
-import shapely.geometry as sg
-from shapely.geometry.base import BaseGeometry
-from shapely.validation import explain_validity
 
+from rag.reader.pdf.pdf_region_worker import parse_page_range
 from utils.log_utils import LogUtils
 
 # This Default Prompt Using Chinese and could be changed to other languages.
@@ -23,195 +26,140 @@ DEFAULT_ROLE_PROMPT = """你是一个PDF文档解析器，使用markdown和latex
 """
 
 
-def _is_near(rect1: BaseGeometry, rect2: BaseGeometry, distance: float = 20) -> bool:
-    """
-    Check if two rectangles are near each other if the distance between them is less than the target.
-    """
-    return rect1.buffer(0.1).distance(rect2.buffer(0.1)) < distance
+# 解析PDF的进程池,第一次并行解析时创建,一直复用到服务关闭,不用每次入库都启动子进程
+_pool_lock = threading.Lock()
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+
+
+def _get_pdf_pool(max_workers: int) -> ProcessPoolExecutor:
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is not None and _pool_workers != max_workers:
+            _pool.shutdown(wait=False)
+            _pool = None
+        if _pool is None:
+            # 解析在调用方的线程里进行,fork会复制其他线程持有的锁,用spawn创建子进程
+            # 子进程执行的任务在pdf_region_worker里,只导入fitz和shapely
+            # 用 uvicorn main:app 启动时子进程不会导入main.py;直接运行 python main.py 时
+            # spawn会在每个子进程里重新执行一次main.py的模块代码(不会启动服务),
+            # 进程池一直复用,这个开销每个子进程只有一次
+            _pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _pool_workers = max_workers
+        return _pool
 
 
-def _is_horizontal_near(
-    rect1: BaseGeometry, rect2: BaseGeometry, distance: float = 100
-) -> bool:
-    """
-    Check if two rectangles are near horizontally if one of them is a horizontal line.
-    """
-    result = False
-    if (
-        abs(rect1.bounds[3] - rect1.bounds[1]) < 0.1
-        or abs(rect2.bounds[3] - rect2.bounds[1]) < 0.1
-    ):
-        if (
-            abs(rect1.bounds[0] - rect2.bounds[0]) < 0.1
-            and abs(rect1.bounds[2] - rect2.bounds[2]) < 0.1
-        ):
-            result = abs(rect1.bounds[3] - rect2.bounds[3]) < distance
-    return result
-
-
-def _union_rects(rect1: BaseGeometry, rect2: BaseGeometry) -> BaseGeometry:
-    """
-    Union two rectangles.
-    """
-    return sg.box(*(rect1.union(rect2).bounds))
+def _discard_pdf_pool(pool: ProcessPoolExecutor) -> None:
+    """子进程异常退出之后进程池不能再用,下次解析时重新创建"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
 
 
-def _merge_rects(
-    rect_list: List[BaseGeometry],
-    distance: float = 20,
-    horizontal_distance: Optional[float] = None,
-) -> List[BaseGeometry]:
-    """
-    Merge rectangles in the list if the distance between them is less than the target.
-    """
-    merged = True
-    while merged:
-        merged = False
-        new_rect_list = []
-        while rect_list:
-            rect = rect_list.pop(0)
-            for other_rect in rect_list:
-                if _is_near(rect, other_rect, distance) or (
-                    horizontal_distance
-                    and _is_horizontal_near(rect, other_rect, horizontal_distance)
-                ):
-                    rect = _union_rects(rect, other_rect)
-                    rect_list.remove(other_rect)
-                    merged = True
-            new_rect_list.append(rect)
-        rect_list = new_rect_list
-    return rect_list
-
-
-def _adsorb_rects_to_rects(
-    source_rects: List[BaseGeometry],
-    target_rects: List[BaseGeometry],
-    distance: float = 10,
-) -> Tuple[List[BaseGeometry], List[BaseGeometry]]:
-    """
-    Adsorb a set of rectangles to another set of rectangles.
-    """
-    new_source_rects = []
-    for text_area_rect in source_rects:
-        adsorbed = False
-        for index, rect in enumerate(target_rects):
-            if _is_near(text_area_rect, rect, distance):
-                rect = _union_rects(text_area_rect, rect)
-                target_rects[index] = rect
-                adsorbed = True
-                break
-        if not adsorbed:
-            new_source_rects.append(text_area_rect)
-    return new_source_rects, target_rects
-
-
-def _parse_rects(page: fitz.Page) -> List[Tuple[float, float, float, float]]:
+def shutdown_pdf_pool() -> None:
+    """服务关闭时调用,等待正在解析的任务结束"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+# 提取的图片目录的后缀,这个目录只由这里创建和删除,不会删掉用户和PDF同名的目录
+OUTPUT_DIR_SUFFIX = ".hopeflow_regions"
+
+
+def get_output_dir(pdf_path: str) -> str:
+    """PDF的图片保存在 <文件名>.hopeflow_regions 目录下"""
+    stem, _ = os.path.splitext(pdf_path)
+    return stem + OUTPUT_DIR_SUFFIX
+
+
+def get_legacy_output_dir(pdf_path: str) -> str:
+    """之前的版本保存在和PDF同名的目录下,只读取,不删除"""
+    stem, _ = os.path.splitext(pdf_path)
+    return stem
+
+
+def remove_output_dir(pdf_path: str) -> None:
+    output_dir = get_output_dir(pdf_path)
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+
+
+def _reset_output_dir(pdf_path: str) -> str:
+    # PDF修改之后区域的数量和位置都可能变化,旧的图片不能留在目录里
+    remove_output_dir(pdf_path)
+    output_dir = get_output_dir(pdf_path)
+    os.makedirs(output_dir)
+    return output_dir
+
+
+def parse_pdfs_to_images(
+    pdf_paths: List[str], max_workers: int = 1, pages_per_task: int = 4
+) -> List[Tuple[str, List[List[str]]]]:
     """
-    Parse drawings in the page and merge adjacent rectangles.
+    Parse PDFs to images, the pages of all files are split into tasks for a process pool.
+    Results are in the order of pdf_paths and pages: [(output_dir, images of each page)].
+    Images left in output_dir by a previous run are removed first.
+    max_workers <= 0 uses all cpus, 1 parses in the current process.
     """
+    output_dirs = [_reset_output_dir(pdf_path) for pdf_path in pdf_paths]
+    tasks = []
+    for file_index, (pdf_path, output_dir) in enumerate(zip(pdf_paths, output_dirs)):
+        with fitz.open(pdf_path) as pdf_document:
+            page_count = pdf_document.page_count
+        for start in range(0, page_count, pages_per_task):
+            tasks.append((file_index, pdf_path, output_dir, start, start + pages_per_task))
+
+    if max_workers <= 0:
+        max_workers = os.cpu_count() or 1
+
+    # 进程池按配置的进程数创建,子进程在任务多的时候才会启动
+    if min(max_workers, len(tasks)) <= 1:
+        task_results = [
+            parse_page_range(pdf_path, output_dir, start, stop)
+            for _, pdf_path, output_dir, start, stop in tasks
+        ]
+    else:
+        pool = _get_pdf_pool(max_workers)
+        try:
+            task_results = list(
+                pool.map(
+                    parse_page_range,
+                    [task[1] for task in tasks],
+                    [task[2] for task in tasks],
+                    [task[3] for task in tasks],
+                    [task[4] for task in tasks],
+                )
+            )
+        except BrokenProcessPool:
+            _discard_pdf_pool(pool)
+            raise
+
+    results = [(output_dir, []) for output_dir in output_dirs]
+    for (file_index, *_), page_images in zip(tasks, task_results):
+        results[file_index][1].extend(page_images)
 
-    # 提取画的内容
-    drawings = page.get_drawings()
-
-    # 忽略掉长度小于30的水平直线
-    is_short_line = (
-        lambda x: abs(x["rect"][3] - x["rect"][1]) < 1
-        and abs(x["rect"][2] - x["rect"][0]) < 30
-    )
-    drawings = [drawing for drawing in drawings if not is_short_line(drawing)]
-
-    # 转换为shapely的矩形
-    rect_list = [sg.box(*drawing["rect"]) for drawing in drawings]
-
-    # 提取图片区域
-    images = page.get_image_info()
-    image_rects = [sg.box(*image["bbox"]) for image in images]
-
-    # 合并drawings和images
-    rect_list += image_rects
-
-    merged_rects = _merge_rects(rect_list, distance=10, horizontal_distance=100)
-    merged_rects = [
-        rect for rect in merged_rects if explain_validity(rect) == "Valid Geometry"
-    ]
-
-    # 将大文本区域和小文本区域分开处理: 大文本相小合并，小文本靠近合并
-    is_large_content = lambda x: (len(x[4]) / max(1, len(x[4].split("\n")))) > 5
-    small_text_area_rects = [
-        sg.box(*x[:4]) for x in page.get_text("blocks") if not is_large_content(x)
-    ]
-    large_text_area_rects = [
-        sg.box(*x[:4]) for x in page.get_text("blocks") if is_large_content(x)
-    ]
-    _, merged_rects = _adsorb_rects_to_rects(
-        large_text_area_rects, merged_rects, distance=0.1
-    )  # 完全相交
-    _, merged_rects = _adsorb_rects_to_rects(
-        small_text_area_rects, merged_rects, distance=5
-    )  # 靠近
-
-    # 再次自身合并
-    merged_rects = _merge_rects(merged_rects, distance=10)
-
-    # 过滤比较小的矩形
-    merged_rects = [
-        rect
-        for rect in merged_rects
-        if rect.bounds[2] - rect.bounds[0] > 20 and rect.bounds[3] - rect.bounds[1] > 20
-    ]
-
-    return [rect.bounds for rect in merged_rects]
-
-
-def parse_pdf_to_images(pdf_path: str) -> List[Tuple[str, List[str]]]:
+    for output_dir, image_infos in results:
+        LogUtils.log_info(
+            f"PDF extract  {len(image_infos)} images, saved to {output_dir}"
+        )
+    return results
+
+
+def parse_pdf_to_images(
+    pdf_path: str, max_workers: int = 1, pages_per_task: int = 4
+) -> Tuple[str, List[List[str]]]:
     """
     Parse PDF to images and save to output_dir.
     """
-    output_dir, _ = os.path.splitext(pdf_path)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    # 打开PDF文件
-    pdf_document = fitz.open(pdf_path)
-    image_infos = []
-
-    for page_index, page in enumerate(pdf_document):
-        # LogUtils.log_info(f"Processing page {page_index + 1}/{len(pdf_document)}")
-        rect_images = []
-        rects = _parse_rects(page)
-        for index, rect in enumerate(rects):
-            fitz_rect = fitz.Rect(rect)
-            # 保存页面为图片
-            pix = page.get_pixmap(clip=fitz_rect, matrix=fitz.Matrix(4, 4))
-            name = f"{page_index}_{index}.png"
-            pix.save(os.path.join(output_dir, name))
-            rect_images.append(name)
-            # # 在页面上绘制红色矩形
-            big_fitz_rect = fitz.Rect(
-                fitz_rect.x0 - 1, fitz_rect.y0 - 1, fitz_rect.x1 + 1, fitz_rect.y1 + 1
-            )
-            # 空心矩形
-            page.draw_rect(big_fitz_rect, color=(1, 0, 0), width=1)
-            # 画矩形区域(实心)
-            # page.draw_rect(big_fitz_rect, color=(1, 0, 0), fill=(1, 0, 0))
-            # 在矩形内的左上角写上矩形的索引name，添加一些偏移量
-            text_x = fitz_rect.x0 + 2
-            text_y = fitz_rect.y0 + 10
-            text_rect = fitz.Rect(text_x, text_y - 9, text_x + 80, text_y + 2)
-            # 绘制白色背景矩形
-            page.draw_rect(text_rect, color=(1, 1, 1), fill=(1, 1, 1))
-            # 插入带有白色背景的文字
-            page.insert_text((text_x, text_y), name, fontsize=10, color=(1, 0, 0))
-
-        # page_image_with_rects = page.get_pixmap(matrix=fitz.Matrix(3, 3))
-        # page_image = os.path.join(output_dir, f'{page_index}.png')
-        # page_image_with_rects.save(page_image)
-        # image_infos.append((page_image, rect_images))
-        image_infos.append(rect_images)
-
-    LogUtils.log_info(f"PDF extract  {len(image_infos)} images, saved to {output_dir}")
-    pdf_document.close()
-    return output_dir, image_infos
+    return parse_pdfs_to_images([pdf_path], max_workers, pages_per_task)[0]
 
 
 if __name__ == "__main__":
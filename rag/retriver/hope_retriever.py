@@ -1,35 +1,94 @@
+import asyncio
 from typing import List
 
-from llama_index.core import VectorStoreIndex
-from llama_index.core.retrievers import QueryFusionRetriever
-from llama_index.core.retrievers.fusion_retriever import FUSION_MODES
+from llama_index.core import Settings, VectorStoreIndex
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.retrievers.fusion_retriever import QUERY_GEN_PROMPT
 from llama_index.core.schema import NodeWithScore, QueryBundle
 from llama_index.core.vector_stores.types import (
     BasePydanticVectorStore,
     MetadataFilters,
 )
 from schema.rag_config import RagFrontendConfig
+from utils.log_utils import LogUtils
+
+# RRF的常数,原论文里k=60效果最好
+RRF_K = 60.0
+
+
+def reciprocal_rank_fusion(
+    results: List[List[NodeWithScore]], k: float = RRF_K
+) -> List[NodeWithScore]:
+    """多个查询的检索结果按排名融合,和 QueryFusionRetriever 的RRF一致"""
+    fused_scores = {}
+    hash_to_node = {}
+    for nodes in results:
+        for rank, node_with_score in enumerate(
+            sorted(nodes, key=lambda x: x.score or 0.0, reverse=True)
+        ):
+            node_hash = node_with_score.node.hash
+            hash_to_node[node_hash] = node_with_score
+            fused_scores[node_hash] = fused_scores.get(node_hash, 0.0) + 1.0 / (
+                rank + k
+            )
+
+    fused_nodes = []
+    for node_hash, score in sorted(
+        fused_scores.items(), key=lambda x: x[1], reverse=True
+    ):
+        node_with_score = hash_to_node[node_hash]
+        node_with_score.score = score
+        fused_nodes.append(node_with_score)
+    return fused_nodes
+
+
+def _parse_queries(text: str, original_query: str, count: int) -> List[str]:
+    """大模型每行一个查询,去掉和原始查询重复的"""
+    queries = []
+    for line in text.split("\n"):
+        line = line.strip()
+        if line and line != original_query and line not in queries:
+            queries.append(line)
+    return queries[:count]
 
 
 class HopeRetriever:
-    def __init__(self, vector_store: BasePydanticVectorStore) -> None:
-        vector_store_index = VectorStoreIndex.from_vector_store(
+    """多路查询融合检索
+    大模型生成相似的查询,生成的查询一次批量计算向量,向量库检索同时进行,最后RRF融合
+    原始查询不需要等待生成,和大模型同时检索
+    """
+
+    def __init__(
+        self,
+        vector_store: BasePydanticVectorStore,
+        embed_model: BaseEmbedding = None,
+    ) -> None:
+        # 不同租户可能使用不同的向量模型,为空时使用全局的 Settings.embed_model
+        self.vector_store_index = VectorStoreIndex.from_vector_store(
             vector_store=vector_store,
+            embed_model=embed_model,
         )
-        # similarity_top_k=6 是每个query最原始的返回个数
-        self.base_retriever = vector_store_index.as_retriever(similarity_top_k=6)
-
-        self.fusion_retriever = QueryFusionRetriever(
-            retrievers=[
-                self.base_retriever,
-            ],
-            mode=FUSION_MODES.RECIPROCAL_RANK,  # RRF
-            num_queries=3,  # 生成 query数 ,包含了原始查询
-            use_async=False,  # 协程查询
-            similarity_top_k=6,  # RRF排序后保留的个数,跟原始的个数保持一致
-            # query_gen_prompt="...",  # 可以自定义 query 生成的 prompt 模板,比如中英文混合的query
+        self.embed_model = self.vector_store_index._embed_model
+        # query_gen_prompt 可以自定义,比如中英文混合的query
+        self.query_gen_prompt = QUERY_GEN_PROMPT
+
+    @staticmethod
+    def _get_params(rag_config: RagFrontendConfig = None):
+        # similarity_top_k=6 是每个query最原始的返回个数, RRF排序后保留的个数跟原始的个数保持一致
+        # num_queries=3 生成 query数 ,包含了原始查询
+        if rag_config:
+            return rag_config.rag_retrieve_count, rag_config.rag_fusion_count
+        return 6, 3
+
+    def _get_vector_retriever(self, similarity_top_k: int, filters: MetadataFilters):
+        """每次请求单独创建,并发的请求不会互相修改检索参数和过滤条件"""
+        return self.vector_store_index.as_retriever(
+            similarity_top_k=similarity_top_k, filters=filters
         )
 
+    def _get_query_gen_prompt(self, query: str, num_queries: int) -> str:
+        return self.query_gen_prompt.format(num_queries=num_queries - 1, query=query)
+
     def retrieve(
         self,
         query: str,
@@ -39,33 +98,80 @@ class HopeRetriever:
         # filters = MetadataFilters(
         #     filters=[ExactMatchFilter(key="file_name", value="uber_2021.pdf")]
         # )
-        if rag_config:
-            self.base_retriever._similarity_top_k = rag_config.rag_retrieve_count
-            self.fusion_retriever.similarity_top_k = rag_config.rag_retrieve_count
-            self.fusion_retriever.num_queries = rag_config.rag_fusion_count
-
-        if filters:
-            self.base_retriever._filters = filters
-            self.fusion_retriever._retrievers = [self.base_retriever]
-
-        return self.fusion_retriever.retrieve(QueryBundle(query_str=query))
-
-    # async def _multi_retrieve(
-    #         self, queries: List[str]
-    # ) -> Dict[str, List[NodeWithScore]]:
-    #     LogUtils.log_info(f"multi_retrieve: {queries}")
-    #     tasks = []
-    #     for query in queries:
-    #         tasks.append(self.query_engine.aretrieve(QueryBundle(query_str=query)))
-    #
-    #     task_results = await asyncio.gather(*tasks)
-    #
-    #     results = {}
-    #     for query, query_result in zip(queries, task_results):
-    #         LogUtils.log_info(f"query: {query}, result: {query_result}")
-    #         results[query] = query_result
-    #
-    #     return results
-    #
-    # def multi_retrieve(self, queries: List[str]):
-    #     return asyncio.run(self._multi_retrieve(queries))
+        similarity_top_k, num_queries = self._get_params(rag_config)
+        vector_retriever = self._get_vector_retriever(similarity_top_k, filters)
+
+        queries = [query]
+        if num_queries > 1:
+            response = Settings.llm.complete(
+                self._get_query_gen_prompt(query, num_queries)
+            )
+            queries += _parse_queries(response.text, query, num_queries - 1)
+        LogUtils.log_info(f"fusion queries: {queries}")
+
+        embeddings = get_query_embedding_batch(self.embed_model, queries)
+        results = [
+            vector_retriever.retrieve(QueryBundle(query_str=item, embedding=embedding))
+            for item, embedding in zip(queries, embeddings)
+        ]
+        return reciprocal_rank_fusion(results)[:similarity_top_k]
+
+    async def aretrieve(
+        self,
+        query: str,
+        rag_config: RagFrontendConfig = None,
+        filters: MetadataFilters = None,
+    ) -> List[NodeWithScore]:
+        similarity_top_k, num_queries = self._get_params(rag_config)
+        vector_retriever = self._get_vector_retriever(similarity_top_k, filters)
+
+        async def search(queries: List[str]) -> List[List[NodeWithScore]]:
+            if not queries:
+                return []
+            embeddings = await aget_query_embedding_batch(self.embed_model, queries)
+            return await asyncio.gather(
+                *[
+                    vector_retriever.aretrieve(
+                        QueryBundle(query_str=item, embedding=embedding)
+                    )
+                    for item, embedding in zip(queries, embeddings)
+                ]
+            )
+
+        if num_queries <= 1:
+            results = await search([query])
+            return reciprocal_rank_fusion(results)[:similarity_top_k]
+
+        async def search_generated() -> List[List[NodeWithScore]]:
+            response = await Settings.llm.acomplete(
+                self._get_query_gen_prompt(query, num_queries)
+            )
+            queries = _parse_queries(response.text, query, num_queries - 1)
+            LogUtils.log_info(f"fusion queries: {[query] + queries}")
+            return await search(queries)
+
+        original_results, generated_results = await asyncio.gather(
+            search([query]), search_generated()
+        )
+        return reciprocal_rank_fusion(original_results + generated_results)[
+            :similarity_top_k
+        ]
+
+
+def get_query_embedding_batch(
+    embed_model: BaseEmbedding, queries: List[str]
+) -> List[List[float]]:
+    """支持批量的向量模型一次请求计算所有查询的向量"""
+    if hasattr(embed_model, "get_query_embedding_batch"):
+        return embed_model.get_query_embedding_batch(queries)
+    return [embed_model.get_query_embedding(query) for query in queries]
+
+
+async def aget_query_embedding_batch(
+    embed_model: BaseEmbedding, queries: List[str]
+) -> List[List[float]]:
+    if hasattr(embed_model, "aget_query_embedding_batch"):
+        return await embed_model.aget_query_embedding_batch(queries)
+    return await asyncio.gather(
+        *[embed_model.aget_query_embedding(query) for query in queries]
+    )
@@ -13,7 +13,16 @@ class ChatRequestData(BaseModel):
     model_type: Optional[str] = Field(default=None, description="模型类型")
     model_name: Optional[str] = Field(default=None, description="模型名称")
     image_urls: Optional[List[str]] = Field(default=None, description="图片地址")
+    rag_tenant: Optional[str] = Field(default=None, description="知识库租户,为空时使用默认租户")
     rag_file_ids: Optional[List[str]] = Field(default=None, description="文件id")
     rag_rerank_count: Optional[int] = Field(default=3, description="重排序后的文本数量")
     rag_retrieve_count: Optional[int] = Field(default=6, description="检索的文本数量")
     rag_fusion_count: Optional[int] = Field(default=3, description="类似语义的查询数量")
+    follow_questions_enabled: bool = Field(default=True, description="是否生成引导问题")
+    follow_questions_timeout: float = Field(default=10.0, description="生成引导问题的超时时间(秒)")
+    follow_questions_json: bool = Field(
+        default=False,
+        description="引导问题按json帧 {chat_follow_questions: ...} 发送,默认和旧版客户端一样发送原始文本",
+    )
+    semantic_cache_enabled: bool = Field(default=False, description="是否使用语义缓存")
+    hedge_enabled: bool = Field(default=False, description="首字太慢时是否同时请求备用模型")
@@ -7,6 +7,7 @@ class CommandSchema(BaseModel):
     chat_stream_serve_start: str
     chat_stream_serve_done: str
     chat_stream_client_stop: str
+    chat_follow_questions: str
     rag_parse_question_start: str
     rag_parse_question_done: str
     rag_retrieve_chunk_start: str
@@ -23,6 +24,7 @@ def get_command_schema():
         chat_stream_serve_start=CHAT_STREAM_SERVE_START,
         chat_stream_serve_done=CHAT_STREAM_SERVE_DONE,
         chat_stream_client_stop=CHAT_STREAM_CLIENT_STOP,
+        chat_follow_questions=CHAT_FOLLOW_QUESTIONS,
         rag_parse_question_start=RAG_PARSE_QUESTION_START,
         rag_parse_question_done=RAG_PARSE_QUESTION_DONE,
         rag_retrieve_chunk_start=RAG_RETRIEVE_CHUNK_START,
@@ -0,0 +1,26 @@
+import os
+import sys
+
+# langfuse 需要这几个环境变量,指向本机不存在的地址,不会访问外网
+os.environ.setdefault("LANGFUSE_SECRET_KEY", "sk-lf-test")
+os.environ.setdefault("LANGFUSE_PUBLIC_KEY", "pk-lf-test")
+os.environ.setdefault("LANGFUSE_HOST", "http://127.0.0.1:9")
+
+# 有些模块导入时就创建模型的客户端,测试不会真的请求provider
+for _provider in (
+    "OPENAI", "AGI", "GROQ", "ZHIPU", "DASHSCOPE", "DEEPSEEK",
+    "BAICHUAN", "KIMI", "LINGYI", "SILICONFLOW",
+):
+    os.environ.setdefault(f"{_provider}_API_KEY", "sk-test")
+    os.environ.setdefault(f"{_provider}_BASE_URL", "http://127.0.0.1:9/v1")
+os.environ.setdefault("ZHIPUAI_API_KEY", "sk-test")
+
+# 模块按仓库根目录导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llama_index.core import MockEmbedding, Settings  # noqa: E402
+from llama_index.core.llms import MockLLM  # noqa: E402
+
+# 有些模块导入时读取Settings.llm,没有设置时llama-index会去连接OpenAI
+Settings.llm = MockLLM()
+Settings.embed_model = MockEmbedding(embed_dim=8)
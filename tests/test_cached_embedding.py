@@ -0,0 +1,104 @@
+import asyncio
+from typing import List
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+
+from rag.embedding.cached_embedding import CachedEmbedding, QueryEmbeddingCache
+
+
+class RecordingEmbedding(BaseEmbedding):
+    """向量的值就是查询的编号,float16也能精确表示"""
+
+    calls: List[List[str]] = []
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "RecordingEmbedding"
+
+    @staticmethod
+    def _embed(query: str) -> List[float]:
+        return [float(query.strip()[1:]), 1.0]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        self.calls.append([query])
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def get_query_embedding_batch(self, queries: List[str]) -> List[List[float]]:
+        self.calls.append(list(queries))
+        return [self._embed(query) for query in queries]
+
+    async def aget_query_embedding_batch(self, queries: List[str]) -> List[List[float]]:
+        return self.get_query_embedding_batch(queries)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed(text)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+def _create(max_size=100):
+    inner = RecordingEmbedding(model_name="recording")
+    inner.calls = []
+    cache = QueryEmbeddingCache(
+        {"max_size": max_size, "redis_enabled": False, "redis_db": 0, "redis_ttl": 0}
+    )
+    return inner, CachedEmbedding(inner, cache)
+
+
+def _expected(queries):
+    return [RecordingEmbedding._embed(query) for query in queries]
+
+
+def test_batch_partial_miss_keeps_order():
+    inner, embedding = _create()
+    embedding.get_query_embedding("q2")
+    embedding.get_query_embedding("q4")
+    inner.calls = []
+
+    queries = ["q1", "q2", "q3", "q4", "q5"]
+    assert embedding.get_query_embedding_batch(queries) == _expected(queries)
+    # 只有未命中的查询交给原模型,一次批量请求
+    assert inner.calls == [["q1", "q3", "q5"]]
+
+    inner.calls = []
+    assert embedding.get_query_embedding_batch(queries) == _expected(queries)
+    assert inner.calls == []
+
+
+def test_async_batch_partial_miss_keeps_order():
+    inner, embedding = _create()
+
+    async def run():
+        await embedding.aget_query_embedding("q3")
+        inner.calls = []
+        queries = ["q1", "q2", "q3", "q4"]
+        assert await embedding.aget_query_embedding_batch(queries) == _expected(queries)
+        assert inner.calls == [["q1", "q2", "q4"]]
+
+        inner.calls = []
+        assert await embedding.aget_query_embedding_batch(queries) == _expected(queries)
+        assert inner.calls == []
+
+    asyncio.run(run())
+
+
+def test_query_is_normalized():
+    inner, embedding = _create()
+    embedding.get_query_embedding("q1")
+    inner.calls = []
+    # 全角和多余的空白命中同一个缓存
+    assert embedding.get_query_embedding("  ｑ1 ") == [1.0, 1.0]
+    assert inner.calls == []
+
+
+def test_memory_lru():
+    inner, embedding = _create(max_size=2)
+    for query in ["q1", "q2", "q1", "q3"]:
+        embedding.get_query_embedding(query)
+    inner.calls = []
+    embedding.get_query_embedding_batch(["q1", "q2", "q3"])
+    assert inner.calls == [["q2"]]
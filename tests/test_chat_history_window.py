@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+
+from benchmark.fake_components import InMemoryChatManager
+from controller import chat_history_window
+from controller.chat_history_window import (
+    IMAGE_TOKENS,
+    MESSAGE_OVERHEAD_TOKENS,
+    _split_window,
+    estimate_message_tokens,
+    schedule_history_summary,
+    update_history_summary,
+)
+
+
+def _entries(*messages):
+    return [
+        ({"role": role, "content": content}, float(index))
+        for index, (role, content) in enumerate(messages)
+    ]
+
+
+ENTRIES = _entries(
+    ("user", "第一个问题" * 10),
+    ("assistant", "第一个回答" * 10),
+    ("user", "第二个问题" * 10),
+    ("assistant", "第二个回答" * 10),
+)
+
+
+def _tokens(entries):
+    return sum(estimate_message_tokens(msg) for msg, _ in entries)
+
+
+def test_everything_fits():
+    assert _split_window(ENTRIES, _tokens(ENTRIES)) == 0
+
+
+def test_keeps_latest_turns_within_budget():
+    assert _split_window(ENTRIES, _tokens(ENTRIES[2:])) == 2
+    # 差一个token放不下第二轮的提问,窗口不能以回复开头
+    assert _split_window(ENTRIES, _tokens(ENTRIES[2:]) - 1) == 4
+
+
+def test_window_starts_with_user_message():
+    assert _split_window(ENTRIES, _tokens(ENTRIES[1:])) == 2
+
+
+@pytest.mark.parametrize("budget", [0, -10])
+def test_no_budget(budget):
+    assert _split_window(ENTRIES, budget) == len(ENTRIES)
+
+
+def test_empty_history():
+    assert _split_window([], 100) == 0
+
+
+def test_image_message_tokens():
+    msg = {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": ""},
+            {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}},
+        ],
+    }
+    assert estimate_message_tokens(msg) == IMAGE_TOKENS + MESSAGE_OVERHEAD_TOKENS
+
+
+@pytest.fixture
+def summary_env(monkeypatch):
+    manager = InMemoryChatManager()
+    batches = []
+
+    async def fake_ainvoke(chain, inputs, **kwargs):
+        batches.append(inputs["messages"].count("\n") + 1)
+        await asyncio.sleep(0)
+        return f"摘要{len(batches)}"
+
+    monkeypatch.setattr(chat_history_window, "chat_manager", manager)
+    monkeypatch.setattr(chat_history_window.llm_scheduler, "ainvoke", fake_ainvoke)
+    monkeypatch.setitem(chat_history_window._history_config, "window_max_messages", 4)
+    monkeypatch.setitem(chat_history_window._history_config, "summary_batch_messages", 3)
+    monkeypatch.setitem(chat_history_window._history_config, "summary_max_batches", 10)
+    return manager, batches
+
+
+async def _add_turns(manager, count):
+    for index in range(count):
+        await manager.add_chat_record(
+            "user",
+            1,
+            [
+                {"role": "user", "content": f"问题{index}"},
+                {"role": "assistant", "content": f"回答{index}"},
+            ],
+        )
+
+
+def test_folds_messages_beyond_window_in_batches(summary_env):
+    manager, batches = summary_env
+
+    async def run():
+        await _add_turns(manager, 5)
+        await update_history_summary("user", 1, "unknown-model")
+        return await manager.get_chat_summary("user", 1)
+
+    summary = asyncio.run(run())
+    entries = asyncio.run(manager.get_history_entries("user", 1))
+    # 窗口之外的6条消息按每批3条折叠,窗口内的消息没有超出预算,保留
+    assert batches == [3, 3]
+    assert summary.summary == "摘要2"
+    assert summary.summarized_until == entries[5][1]
+
+
+def test_progress_is_saved_after_each_batch(summary_env, monkeypatch):
+    manager, batches = summary_env
+    monkeypatch.setitem(chat_history_window._history_config, "summary_max_batches", 1)
+
+    async def run():
+        await _add_turns(manager, 5)
+        await update_history_summary("user", 1, "unknown-model")
+        first = await manager.get_chat_summary("user", 1)
+        await update_history_summary("user", 1, "unknown-model")
+        return first, await manager.get_chat_summary("user", 1)
+
+    first, second = asyncio.run(run())
+    entries = asyncio.run(manager.get_history_entries("user", 1))
+    assert first.summarized_until == entries[2][1]
+    assert second.summarized_until == entries[5][1]
+    assert batches == [3, 3]
+
+
+def test_summary_tasks_are_serialized_per_session(summary_env):
+    manager, batches = summary_env
+
+    async def run():
+        await _add_turns(manager, 5)
+        first = schedule_history_summary("user", 1, "unknown-model")
+        second = schedule_history_summary("user", 1, "unknown-model")
+        assert first is second
+        await first
+        assert not chat_history_window._summary_tasks
+
+    asyncio.run(run())
+    # 第二次请求在第一次完成之后重新检查,没有重复折叠同一批消息
+    assert batches == [3, 3]
@@ -0,0 +1,48 @@
+import os
+
+import fitz
+import pytest
+
+from rag.reader.pdf.extract_pdf_img import parse_pdfs_to_images, shutdown_pdf_pool
+
+
+@pytest.fixture
+def pdf_paths(tmp_path):
+    paths = []
+    for file_index in range(2):
+        path = str(tmp_path / f"doc{file_index}.pdf")
+        document = fitz.open()
+        for page_index in range(5):
+            page = document.new_page()
+            page.insert_text((50, 30), f"page {page_index}")
+            for rect_index in range(page_index % 3 + 1):
+                y = 100 + rect_index * 200
+                page.draw_rect(fitz.Rect(50, y, 150 + page_index * 20, y + 100))
+        document.save(path)
+        document.close()
+        paths.append(path)
+    yield paths
+    shutdown_pdf_pool()
+
+
+def _read_images(results):
+    return {
+        (os.path.basename(output_dir), name): open(
+            os.path.join(output_dir, name), "rb"
+        ).read()
+        for output_dir, page_images in results
+        for images in page_images
+        for name in images
+    }
+
+
+def test_parallel_matches_serial(pdf_paths):
+    serial = parse_pdfs_to_images(pdf_paths, max_workers=1, pages_per_task=2)
+    serial_images = _read_images(serial)
+    assert len(serial_images) == 2 * (1 + 2 + 3 + 1 + 2)
+
+    # 进程池在两次解析之间复用
+    for _ in range(2):
+        parallel = parse_pdfs_to_images(pdf_paths, max_workers=2, pages_per_task=2)
+        assert parallel == serial
+        assert _read_images(parallel) == serial_images
@@ -0,0 +1,50 @@
+import copy
+
+import pytest
+from llama_index.core.retrievers.fusion_retriever import QueryFusionRetriever
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from rag.retriver.hope_retriever import RRF_K, _parse_queries, reciprocal_rank_fusion
+
+
+def _nodes(*items):
+    return [NodeWithScore(node=TextNode(text=text), score=score) for text, score in items]
+
+
+RESULTS = [
+    _nodes(("a", 0.9), ("b", 0.8), ("c", 0.7)),
+    _nodes(("c", 0.95), ("d", 0.5)),
+    # 分数没有排序,按分数重新排名
+    _nodes(("d", 0.1), ("b", 0.6), ("e", None)),
+]
+
+
+def test_rrf_scores():
+    fused = reciprocal_rank_fusion(copy.deepcopy(RESULTS))
+    scores = {node.node.text: node.score for node in fused}
+    assert scores["b"] == pytest.approx(1 / (1 + RRF_K) + 1 / RRF_K)
+    assert scores["c"] == pytest.approx(1 / (2 + RRF_K) + 1 / RRF_K)
+    assert scores["e"] == pytest.approx(1 / (2 + RRF_K))
+    assert [node.score for node in fused] == sorted(scores.values(), reverse=True)
+    assert [node.node.text for node in fused][:2] == ["b", "c"]
+
+
+def test_rrf_matches_query_fusion_retriever():
+    fused = reciprocal_rank_fusion(copy.deepcopy(RESULTS))
+    expected = QueryFusionRetriever._reciprocal_rerank_fusion(
+        None, {("q", i): nodes for i, nodes in enumerate(copy.deepcopy(RESULTS))}
+    )
+    assert [(n.node.text, n.score) for n in fused] == [
+        (n.node.text, n.score) for n in expected
+    ]
+
+
+def test_rrf_empty():
+    assert reciprocal_rank_fusion([]) == []
+    assert reciprocal_rank_fusion([[], []]) == []
+
+
+def test_parse_queries():
+    text = "\n 查询一 \n原始问题\n\n查询一\n查询二\n查询三\n"
+    assert _parse_queries(text, "原始问题", 2) == ["查询一", "查询二"]
+    assert _parse_queries("", "原始问题", 3) == []
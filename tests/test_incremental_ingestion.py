@@ -0,0 +1,181 @@
+import os
+import time
+
+import fitz
+import pytest
+from llama_index.readers.file import PyMuPDFReader
+
+from dao.knowledge_dao import KnowledgeModel
+from rag.managers.chunk_manager import ChunkManager
+from rag.managers.reader_manager import ReaderManager
+from rag.rag_base_manager import RagBaseManager
+from rag.rag_utils import get_file_id
+from rag.reader.image_reader import ImagePathReader
+
+
+class FakeKnowledgeDao:
+    def __init__(self):
+        self.knowledges = {}
+
+    def get_all_knowledges_by_user_name(self, user_name):
+        return [k for k in self.knowledges.values() if k.user_name == user_name]
+
+    def add_new_knowledge(self, user_name, file_id, file_path, file_name, file_size,
+                          file_title=None, chunk_size=None, chunk_overlap=None,
+                          content_hash=None, mtime=None):
+        now = int(time.time())
+        self.knowledges[file_id] = KnowledgeModel(
+            id=file_id, user_name=user_name, file_id=file_id, file_path=file_path,
+            file_name=file_name, file_size=file_size, chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap, file_title=file_title or file_name,
+            content_hash=content_hash, mtime=mtime, updated_at=now, created_at=now,
+        )
+
+    def update_file_state_by_file_id(self, file_id, content_hash, file_size, mtime,
+                                     user_name=None):
+        knowledge = self.knowledges[file_id]
+        knowledge.content_hash = content_hash
+        knowledge.file_size = file_size
+        knowledge.mtime = mtime
+
+    def delete_knowledge_by_file_id(self, file_id, user_name=None):
+        return self.knowledges.pop(file_id, None)
+
+
+class FakeVectorStore:
+    def __init__(self):
+        self.nodes = {}
+
+    def load_nodes(self, nodes):
+        for node in nodes:
+            self.nodes.setdefault(node.metadata["file_id"], []).append(node)
+
+    def delete_file_nodes(self, file_id):
+        self.nodes.pop(file_id, None)
+
+
+class FakeCaptioner:
+    def caption_documents(self, documents):
+        for document in documents:
+            if getattr(document, "image_path", None) and not document.text:
+                document.set_content(f"caption of {os.path.basename(document.image_path)}")
+
+
+def _file_id(file_path):
+    return get_file_id(str(file_path), "test")
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setattr(
+        "rag.rag_base_manager.invalidate_collection", lambda collection: None
+    )
+    reader_manager = ReaderManager.__new__(ReaderManager)
+    reader_manager.file_extractor = {
+        ".pdf": PyMuPDFReader(),
+        ".png": ImagePathReader(),
+    }
+    reader_manager.image_captioner = FakeCaptioner()
+    reader_manager.pdf_config = {"workers": 1, "pages_per_task": 4}
+
+    manager = RagBaseManager.__new__(RagBaseManager)
+    manager.user_name = "test"
+    manager.db_collection_name = "test_collection"
+    manager.knowledge_dao = FakeKnowledgeDao()
+    manager.reader_manager = reader_manager
+    manager.chunk_manager = ChunkManager()
+    manager.vector_store_manager = FakeVectorStore()
+    return manager
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def _write_pdf(path, rects):
+    document = fitz.open()
+    page = document.new_page()
+    page.insert_text((50, 30), "pdf text")
+    for rect in rects:
+        page.draw_rect(fitz.Rect(*rect), color=(0, 0, 0), width=1)
+    document.save(path)
+    document.close()
+
+
+def test_diff_files(manager, tmp_path):
+    for name in ("same.txt", "touched.txt", "changed.txt", "deleted.txt"):
+        _write(str(tmp_path / name), name)
+    _write(str(tmp_path / "sub" / "kept.txt"), "kept")
+    _write(str(tmp_path / "sub" / "gone.txt"), "gone")
+    manager.auto_load_file_dir(str(tmp_path))
+    manager.auto_load_file_list(
+        [str(tmp_path / "sub" / "kept.txt"), str(tmp_path / "sub" / "gone.txt")]
+    )
+
+    os.utime(tmp_path / "touched.txt", ns=(1, 1))
+    _write(str(tmp_path / "changed.txt"), "changed content")
+    os.remove(tmp_path / "deleted.txt")
+    os.remove(tmp_path / "sub" / "gone.txt")
+    _write(str(tmp_path / "new.txt"), "new")
+
+    report = manager.auto_load_file_dir(str(tmp_path))
+    names = lambda paths: sorted(os.path.relpath(p, tmp_path) for p in paths)
+    assert names(report.added) == ["new.txt"]
+    assert names(report.changed) == ["changed.txt"]
+    # 子目录里按文件列表入库的文件,只有被删除了才算删除
+    assert names(report.removed) == ["deleted.txt", os.path.join("sub", "gone.txt")]
+    assert names(report.unchanged) == ["same.txt", "touched.txt"]
+    # touch过的文件更新了记录的修改时间,下次不再计算哈希
+    assert manager.knowledge_dao.knowledges[_file_id(tmp_path / "touched.txt")].mtime == 1
+
+    report = manager.auto_load_file_dir(str(tmp_path), force=True)
+    assert names(report.changed) == ["changed.txt", "new.txt", "same.txt", "touched.txt"]
+
+
+def test_changed_pdf_indexes_only_new_regions(manager, tmp_path):
+    pdf_path = str(tmp_path / "doc.pdf")
+    output_dir = str(tmp_path / "doc.hopeflow_regions")
+    # 和PDF同名的用户目录不会被删除
+    _write(str(tmp_path / "doc" / "notes.txt"), "user notes")
+    _write_pdf(pdf_path, [(50, 100, 150, 200), (300, 400, 400, 500)])
+    manager.auto_load_file_dir(str(tmp_path))
+    assert sorted(os.listdir(output_dir)) == ["0_0.png", "0_1.png"]
+
+    _write_pdf(pdf_path, [(50, 100, 150, 200)])
+    report = manager.auto_load_file_dir(str(tmp_path))
+    assert report.changed == [pdf_path]
+    assert os.listdir(output_dir) == ["0_0.png"]
+
+    image_paths = [
+        os.path.basename(node.metadata["file_path"])
+        for node in manager.vector_store_manager.nodes[_file_id(pdf_path)]
+        if node.metadata.get("image_type") == "pdf_image"
+    ]
+    assert image_paths == ["0_0.png"]
+
+    os.remove(pdf_path)
+    report = manager.auto_load_file_dir(str(tmp_path))
+    assert report.removed == [pdf_path]
+    assert not os.path.exists(output_dir)
+    assert _file_id(pdf_path) not in manager.vector_store_manager.nodes
+    assert os.listdir(tmp_path / "doc") == ["notes.txt"]
+
+
+def test_manual_load_reads_legacy_output_dir(manager, tmp_path):
+    pdf_path = str(tmp_path / "doc.pdf")
+    _write_pdf(pdf_path, [(50, 100, 150, 200)])
+    # 之前的版本手动提取,清洗之后保存在同名目录下
+    legacy_dir = tmp_path / "doc"
+    legacy_dir.mkdir()
+    fitz.open(pdf_path)[0].get_pixmap().save(str(legacy_dir / "0_0.png"))
+
+    manager.manual_load_file_list([pdf_path])
+    image_paths = [
+        node.metadata["file_path"]
+        for node in manager.vector_store_manager.nodes[_file_id(pdf_path)]
+        if node.metadata.get("image_type") == "pdf_image"
+    ]
+    assert image_paths == [str(legacy_dir / "0_0.png")]
+    assert os.listdir(legacy_dir) == ["0_0.png"]
@@ -0,0 +1,109 @@
+import os
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import sessionmaker
+
+import dao.knowledge_dao as knowledge_dao_module
+from dao.knowledge_dao import KnowledgeDao
+from rag.rag_utils import DEFAULT_RAG_TENANT, get_file_id
+
+# 之前的版本创建的表,file_id和file_path全局唯一
+LEGACY_TABLE = """
+CREATE TABLE knowledge (
+    id VARCHAR NOT NULL,
+    user_name VARCHAR NOT NULL,
+    file_id VARCHAR NOT NULL,
+    file_path TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    file_size BIGINT,
+    chunk_size INTEGER,
+    chunk_overlap INTEGER,
+    file_title TEXT NOT NULL,
+    updated_at BIGINT,
+    created_at BIGINT,
+    PRIMARY KEY (id),
+    UNIQUE (file_id),
+    UNIQUE (file_path)
+)
+"""
+
+
+@pytest.fixture
+def engine(monkeypatch, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'hope.db'}")
+    session_factory = sessionmaker(bind=engine, expire_on_commit=False)
+
+    @contextmanager
+    def get_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    monkeypatch.setattr(knowledge_dao_module, "engine", engine)
+    monkeypatch.setattr(knowledge_dao_module, "get_db", get_db)
+    yield engine
+    engine.dispose()
+
+
+def _add(dao, user_name, file_path, file_size=1):
+    return dao.add_new_knowledge(
+        user_name=user_name,
+        file_id=get_file_id(file_path, user_name),
+        file_path=file_path,
+        file_name=os.path.basename(file_path),
+        file_size=file_size,
+        chunk_size=512,
+        chunk_overlap=64,
+    )
+
+
+def test_same_file_is_kept_per_tenant(engine):
+    dao = KnowledgeDao()
+    _add(dao, "alice", "/data/shared.pdf")
+    _add(dao, "bob", "/data/shared.pdf")
+    # 再次入库只更新自己的记录
+    _add(dao, "alice", "/data/shared.pdf", file_size=2)
+
+    alice = dao.get_all_knowledges_by_user_name("alice")
+    bob = dao.get_all_knowledges_by_user_name("bob")
+    assert [k.file_size for k in alice] == [2]
+    assert [k.file_size for k in bob] == [1]
+    assert alice[0].file_id != bob[0].file_id
+
+    dao.delete_knowledge_by_file_id(alice[0].file_id, user_name="alice")
+    assert dao.get_all_knowledges_by_user_name("alice") == []
+    assert len(dao.get_all_knowledges_by_user_name("bob")) == 1
+
+
+def test_default_tenant_keeps_path_file_id():
+    file_path = os.path.abspath("shared.pdf")
+    assert get_file_id(file_path) == get_file_id(file_path, DEFAULT_RAG_TENANT)
+    assert get_file_id(file_path) != get_file_id(file_path, "alice")
+
+
+def test_migrates_global_unique_constraints(engine):
+    with engine.begin() as connection:
+        connection.execute(text(LEGACY_TABLE))
+        connection.execute(
+            text(
+                "INSERT INTO knowledge VALUES ('1', 'alice', 'old-id',"
+                " '/data/shared.pdf', 'shared.pdf', 1, 512, 64, 'title', 0, 0)"
+            )
+        )
+
+    dao = KnowledgeDao()
+    unique_columns = sorted(
+        constraint["column_names"]
+        for constraint in inspect(engine).get_unique_constraints("knowledge")
+    )
+    assert unique_columns == [["user_name", "file_id"], ["user_name", "file_path"]]
+
+    # 旧的记录保留,另一个租户可以入库同一个文件
+    [alice] = dao.get_all_knowledges_by_user_name("alice")
+    assert (alice.file_id, alice.file_title) == ("old-id", "title")
+    _add(dao, "bob", "/data/shared.pdf")
+    assert len(dao.get_all_knowledges()) == 2
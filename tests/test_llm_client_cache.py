@@ -0,0 +1,40 @@
+import asyncio
+
+import httpx
+
+from models.factory.llm_client_cache import LoopLocalAsyncClient
+
+
+def _client():
+    return LoopLocalAsyncClient(
+        transport=httpx.MockTransport(lambda request: httpx.Response(200, text="ok"))
+    )
+
+
+def test_each_event_loop_uses_its_own_pool():
+    client = _client()
+
+    async def request():
+        response = await client.get("http://provider.test/v1/models")
+        return response.text, client._get_loop_client()
+
+    # 导入时创建的客户端在先后两个事件循环里都可以使用
+    first_text, first_pool = asyncio.run(request())
+    second_text, second_pool = asyncio.run(request())
+    assert first_text == second_text == "ok"
+    assert first_pool is not second_pool
+
+
+def test_same_loop_reuses_pool_and_reopens_after_close():
+    client = _client()
+
+    async def run():
+        first = client._get_loop_client()
+        assert client._get_loop_client() is first
+        await client.aclose()
+        assert first.is_closed
+        response = await client.get("http://provider.test/v1/models")
+        assert client._get_loop_client() is not first
+        return response.status_code
+
+    assert asyncio.run(run()) == 200
@@ -0,0 +1,70 @@
+import asyncio
+
+from models.factory.llm_hedge import HedgedStream
+from models.factory.llm_scheduler import LLMPriority
+
+PRIMARY = ("primary", "p")
+FALLBACK = ("fallback", "f")
+
+
+class Chunk:
+    def __init__(self, content):
+        self.content = content
+
+
+def _hedged(primary, fallback, deadline=0.05):
+    stream = HedgedStream(
+        None, "inputs", PRIMARY, FALLBACK, "group", deadline, LLMPriority.INTERACTIVE
+    )
+    stream._open = lambda target, llm=None: primary() if target == PRIMARY else fallback()
+    return stream
+
+
+async def _collect(stream):
+    return [chunk.content async for chunk in stream._hedged_stream()]
+
+
+def test_empty_first_chunk_does_not_win():
+    async def primary():
+        # 连接之后马上返回只有role的空chunk
+        yield Chunk("")
+        await asyncio.sleep(1)
+        yield Chunk("slow")
+
+    async def fallback():
+        yield Chunk("")
+        yield Chunk("fast")
+        yield Chunk("!")
+
+    stream = _hedged(primary, fallback)
+    assert asyncio.run(_collect(stream)) == ["", "fast", "!"]
+    assert (stream.provider, stream.model) == FALLBACK
+
+
+def test_primary_within_deadline_is_not_hedged():
+    opened = []
+
+    async def primary():
+        yield Chunk("")
+        yield Chunk("a")
+        yield Chunk("b")
+
+    async def fallback():
+        opened.append(True)
+        yield Chunk("x")
+
+    stream = _hedged(primary, fallback)
+    assert asyncio.run(_collect(stream)) == ["", "a", "b"]
+    assert (stream.provider, stream.model) == PRIMARY
+    assert not opened
+
+
+def test_stream_ending_without_content_is_replayed():
+    async def primary():
+        yield Chunk("")
+
+    async def fallback():
+        yield Chunk("x")
+
+    stream = _hedged(primary, fallback, deadline=1)
+    assert asyncio.run(_collect(stream)) == [""]
@@ -0,0 +1,170 @@
+import asyncio
+
+import pytest
+
+import models.factory.llm_scheduler as llm_scheduler_module
+from models.factory.llm_scheduler import LLMPriority, TokenBucket, _PriorityLimiter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(llm_scheduler_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_token_bucket_burst_then_rate(clock):
+    bucket = TokenBucket(requests_per_minute=60, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    # 令牌用完之后按每秒1个排队
+    assert bucket.reserve() == pytest.approx(1.0)
+    assert bucket.reserve() == pytest.approx(2.0)
+
+
+def test_token_bucket_refill_is_capped_by_burst(clock):
+    bucket = TokenBucket(requests_per_minute=60, burst=2)
+    bucket.reserve()
+    bucket.reserve()
+    clock[0] += 100
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(1.0)
+
+
+def test_token_bucket_cool_down(clock):
+    bucket = TokenBucket(requests_per_minute=60, burst=5)
+    bucket.cool_down(10)
+    # 冷却结束之后从空桶开始按rate放行
+    assert bucket.reserve() == pytest.approx(11.0)
+    assert bucket.reserve() == pytest.approx(12.0)
+
+    unlimited = TokenBucket(requests_per_minute=0, burst=1)
+    assert unlimited.reserve() == 0
+    unlimited.cool_down(3)
+    assert unlimited.reserve() == pytest.approx(3.0)
+
+
+def test_priority_limiter_order():
+    async def run():
+        limiter = _PriorityLimiter(1)
+        await limiter.acquire(LLMPriority.INTERACTIVE)
+        order = []
+
+        async def worker(name, priority):
+            await limiter.acquire(priority)
+            order.append(name)
+            limiter.release()
+
+        tasks = []
+        for name, priority in [
+            ("ingestion", LLMPriority.INGESTION),
+            ("background", LLMPriority.BACKGROUND),
+            ("interactive-1", LLMPriority.INTERACTIVE),
+            ("interactive-2", LLMPriority.INTERACTIVE),
+        ]:
+            tasks.append(asyncio.create_task(worker(name, priority)))
+            await asyncio.sleep(0)
+
+        limiter.release()
+        await asyncio.gather(*tasks)
+        assert order == ["interactive-1", "interactive-2", "background", "ingestion"]
+        assert limiter._in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_priority_limiter_cancelled_waiter_passes_slot_on():
+    async def run():
+        limiter = _PriorityLimiter(1)
+        await limiter.acquire(LLMPriority.INTERACTIVE)
+        cancelled = asyncio.create_task(limiter.acquire(LLMPriority.INTERACTIVE))
+        waiting = asyncio.create_task(limiter.acquire(LLMPriority.BACKGROUND))
+        await asyncio.sleep(0)
+
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        limiter.release()
+        await asyncio.wait_for(waiting, 1)
+        assert limiter._in_flight == 1
+        limiter.release()
+        assert limiter._in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_priority_limiter_granted_then_cancelled_passes_slot_on():
+    async def run():
+        limiter = _PriorityLimiter(1)
+        await limiter.acquire(LLMPriority.INTERACTIVE)
+        granted = asyncio.create_task(limiter.acquire(LLMPriority.INTERACTIVE))
+        waiting = asyncio.create_task(limiter.acquire(LLMPriority.BACKGROUND))
+        await asyncio.sleep(0)
+
+        # 名额已经交给granted,它还没有恢复执行就被取消
+        limiter.release()
+        granted.cancel()
+        await asyncio.gather(granted, return_exceptions=True)
+        await asyncio.wait_for(waiting, 1)
+        assert limiter._in_flight == 1
+
+    asyncio.run(run())
+
+
+def test_provider_label_of_scheduled_models():
+    from llama_index.core.llms import MockLLM
+
+    from models.llm.llamaindex.scheduled_llm import ScheduledLlamaLLM
+    from models.model_type import LLMType
+    from utils.metrics import get_llm_provider_label
+
+    chat_model = llm_scheduler_module.llm_scheduler.bind(object(), LLMType.GROQ)
+    assert get_llm_provider_label(chat_model) == "groq"
+    assert get_llm_provider_label(ScheduledLlamaLLM(MockLLM(), LLMType.ZHIPU)) == "zhipu"
+    # 请求里的 model_type 字符串
+    chat_model = llm_scheduler_module.llm_scheduler.bind(object(), "deepseek")
+    assert get_llm_provider_label(chat_model) == "deepseek"
+    assert get_llm_provider_label(MockLLM()) == "mockllm"
+
+
+class _Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+
+class _StatusError(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.response = _Response(status_code)
+
+
+class RateLimitError(Exception):
+    pass
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (_StatusError("slow down", 429), True),
+        (RateLimitError("quota"), True),
+        (Exception("Rate limit reached for model"), True),
+        (Exception("429 Too Many Requests"), True),
+        # 没有限流信息,只是内容里有429
+        (Exception("context has 4290 tokens, request id req_429"), False),
+        (_StatusError("bad request, 429 tokens over the limit", 400), False),
+        (ValueError("invalid"), False),
+    ],
+)
+def test_is_rate_limit_error(error, expected):
+    assert llm_scheduler_module.is_rate_limit_error(error) is expected
+
+
+def test_is_rate_limit_error_checks_cause():
+    try:
+        try:
+            raise _StatusError("slow down", 429)
+        except _StatusError as e:
+            raise RuntimeError("llm call failed") from e
+    except RuntimeError as e:
+        assert llm_scheduler_module.is_rate_limit_error(e)
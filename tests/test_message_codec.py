@@ -0,0 +1,72 @@
+import base64
+import json
+
+import pytest
+
+import dao.message_codec as message_codec
+from dao.message_codec import (
+    FORMAT_MSGPACK,
+    FORMAT_ZSTD_DICT_V1,
+    MAGIC,
+    decode_message,
+    encode_message,
+)
+
+IMAGE_URL = "data:image/png;base64," + base64.b64encode(bytes(range(256)) * 4).decode()
+
+MESSAGES = [
+    {"role": "user", "content": "你好,请介绍下你自己"},
+    {
+        "role": "assistant",
+        "content": "以下是一个例子:\n\n```python\nprint(1)\n```" * 20,
+        "model_name": "deepseek-chat",
+    },
+    {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": "这张图片描述了什么"},
+            {"type": "image_url", "image_url": {"url": IMAGE_URL}},
+            # 不规范的base64原样保存
+            {"type": "image_url", "image_url": {"url": "data:image/png;base64,abc"}},
+            {"type": "image_url", "image_url": {"url": "https://example.com/a.png"}},
+        ],
+    },
+    {"role": "assistant", "content": "", "usage": {"tokens": 3, "cost": 0.5, "ok": None}},
+]
+
+
+@pytest.mark.parametrize("msg", MESSAGES)
+def test_round_trip(msg):
+    raw = encode_message(msg)
+    assert raw.startswith(MAGIC)
+    assert raw[len(MAGIC)] in (FORMAT_MSGPACK, FORMAT_ZSTD_DICT_V1)
+    assert decode_message(raw) == msg
+
+
+def test_data_url_is_stored_as_binary():
+    msg = MESSAGES[2]
+    assert len(encode_message(msg)) < len(json.dumps(msg))
+
+
+def test_incompressible_message_is_not_compressed():
+    raw = encode_message({"c": "x"})
+    assert raw[len(MAGIC)] == FORMAT_MSGPACK
+    assert decode_message(raw) == {"c": "x"}
+
+
+def test_legacy_json_fallback():
+    msg = MESSAGES[0]
+    assert decode_message(json.dumps(msg)) == msg
+    assert decode_message(json.dumps(msg).encode("utf-8")) == msg
+
+
+def test_json_codec_config(monkeypatch):
+    monkeypatch.setitem(message_codec._redis_config, "chat_message_codec", "json")
+    raw = encode_message(MESSAGES[1])
+    assert json.loads(raw) == MESSAGES[1]
+    assert decode_message(raw) == MESSAGES[1]
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        decode_message(MAGIC + bytes([99]) + b"payload")
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+import rag.rag_manager_registry as registry_module
+from rag.rag_manager_registry import RagManagerRegistry
+
+
+class FakeManager:
+    def __init__(self, tenant, shared=None, embedding_manager=None):
+        self.tenant = tenant
+        self.closed = False
+
+    def get_collection_name(self):
+        return f"collection_{self.tenant}"
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(registry_module, "RagBaseManager", FakeManager)
+    registry = RagManagerRegistry(
+        {
+            "idle_ttl": 60,
+            "max_tenants": 1,
+            "evict_interval": 60,
+            "warm_up_on_startup": False,
+        },
+        {"type": "fake", "name": "fake"},
+    )
+    monkeypatch.setattr(registry, "get_shared", lambda: None)
+    monkeypatch.setattr(registry, "get_embedding_manager", lambda *args: None)
+    return registry
+
+
+def test_overflow_skips_manager_in_use(registry):
+    with registry.use_manager("a") as manager_a:
+        manager_b = registry.get_manager("b")
+        # a正在使用,超过max_tenants时不回收,b之后有空位时再回收
+        assert not manager_a.closed
+        assert not manager_b.closed
+        assert [t["tenant"] for t in registry.readiness()["tenants"]] == ["a", "b"]
+
+    registry.get_manager("c")
+    assert manager_a.closed
+    assert manager_b.closed
+    assert [t["tenant"] for t in registry.readiness()["tenants"]] == ["c"]
+
+
+def test_evict_idle_skips_manager_in_use(registry):
+    registry.idle_ttl = -1
+    with registry.use_manager("a") as manager:
+        assert registry.evict_idle() == 0
+        assert not manager.closed
+    assert registry.evict_idle() == 1
+    assert manager.closed
+
+
+def test_shutdown_defers_close_until_released(registry):
+    async def run():
+        async with registry.ause_manager("a") as manager:
+            async with registry.ause_manager("a") as same_manager:
+                assert same_manager is manager
+                await registry.aclose()
+            # 还有一个请求在使用
+            assert not manager.closed
+        assert manager.closed
+        # 已经移出注册表,再次使用时重新创建
+        assert registry.get_manager("a") is not manager
+
+    asyncio.run(run())
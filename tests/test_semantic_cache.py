@@ -0,0 +1,124 @@
+import asyncio
+
+import numpy as np
+import pytest
+from llama_index.core import MockEmbedding
+
+import utils.semantic_cache as semantic_cache_module
+from utils.semantic_cache import SemanticCache, SemanticCacheKey, build_cache_key
+
+
+def _key(vector, namespace="ns", collection=None, query="q"):
+    vector = np.asarray(vector, dtype=np.float32)
+    return SemanticCacheKey(
+        namespace=namespace,
+        query=query,
+        embedding=vector / np.linalg.norm(vector),
+        collection=collection,
+    )
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(semantic_cache_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_similarity_threshold():
+    cache = SemanticCache(max_size=10, ttl=60, similarity_threshold=0.9)
+    cache.add(_key([1, 0]), "answer")
+    assert cache.lookup(_key([1, 0.1])).answer == "answer"
+    # 余弦相似度0.707,低于阈值
+    assert cache.lookup(_key([1, 1])) is None
+    # 不同命名空间不共用
+    assert cache.lookup(_key([1, 0], namespace="other")) is None
+
+
+def test_best_match_wins():
+    cache = SemanticCache(max_size=10, ttl=60, similarity_threshold=0.5)
+    cache.add(_key([1, 0]), "x")
+    cache.add(_key([0, 1]), "y")
+    assert cache.lookup(_key([0.2, 1])).answer == "y"
+
+
+def test_empty_answer_is_not_cached():
+    cache = SemanticCache(max_size=10, ttl=60, similarity_threshold=0.9)
+    cache.add(_key([1, 0]), "")
+    assert cache.lookup(_key([1, 0])) is None
+
+
+def test_ttl(clock):
+    cache = SemanticCache(max_size=10, ttl=60, similarity_threshold=0.9)
+    cache.add(_key([1, 0]), "answer")
+    clock[0] += 59
+    assert cache.lookup(_key([1, 0])) is not None
+    clock[0] += 1
+    assert cache.lookup(_key([1, 0])) is None
+    assert not cache._entries
+    assert not cache._namespace_ids
+
+
+def test_lru_eviction():
+    cache = SemanticCache(max_size=2, ttl=60, similarity_threshold=0.99)
+    cache.add(_key([1, 0, 0]), "a")
+    cache.add(_key([0, 1, 0]), "b")
+    # 命中之后a变成最近使用,淘汰b
+    assert cache.lookup(_key([1, 0, 0])).answer == "a"
+    cache.add(_key([0, 0, 1]), "c")
+    assert cache.lookup(_key([1, 0, 0])).answer == "a"
+    assert cache.lookup(_key([0, 1, 0])) is None
+    assert cache.lookup(_key([0, 0, 1])).answer == "c"
+
+
+def test_invalidate_collection():
+    cache = SemanticCache(max_size=10, ttl=60, similarity_threshold=0.9)
+    cache.add(_key([1, 0], namespace="a", collection="c1"), "a")
+    cache.add(_key([1, 0], namespace="b", collection="c2"), "b")
+    cache.add(_key([1, 0], namespace="chat"), "chat")
+    assert cache.invalidate_collection("c1") == 1
+    assert cache.lookup(_key([1, 0], namespace="a")) is None
+    assert cache.lookup(_key([1, 0], namespace="b")).answer == "b"
+    assert cache.lookup(_key([1, 0], namespace="chat")).answer == "chat"
+
+
+class FakeCollectionVersions:
+    def __init__(self):
+        self.versions = {}
+        self.available = True
+
+    def bump(self, collection):
+        self.versions[collection] = self.versions.get(collection, 0) + 1
+        return self.versions[collection]
+
+    async def aget(self, collection):
+        if not self.available:
+            return None
+        return self.versions.get(collection, 0)
+
+
+def test_invalidate_collection_bumps_version(monkeypatch):
+    versions = FakeCollectionVersions()
+    cache = SemanticCache(max_size=10, ttl=60, similarity_threshold=0.9)
+    monkeypatch.setattr(semantic_cache_module, "collection_versions", versions)
+    monkeypatch.setattr(semantic_cache_module, "semantic_cache", cache)
+    embed_model = MockEmbedding(embed_dim=4)
+
+    async def key():
+        return await build_cache_key(
+            "问题", collection="c1", embed_model=embed_model, endpoint="rag"
+        )
+
+    old_key = asyncio.run(key())
+    cache.add(old_key, "answer")
+    semantic_cache_module.invalidate_collection("c1")
+    assert versions.versions == {"c1": 1}
+    assert not cache._entries
+
+    # 其他进程缓存的旧版本回答,命名空间不同,不会再命中
+    new_key = asyncio.run(key())
+    assert new_key.namespace != old_key.namespace
+
+    # 读取不到版本号时不使用缓存
+    versions.available = False
+    assert asyncio.run(key()) is None
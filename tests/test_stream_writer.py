@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+import pytest
+
+from starlette.websockets import WebSocketState
+
+from utils.stream_writer import StreamClosedError, WebsocketStreamWriter
+
+
+class FakeWebsocket:
+    def __init__(self, send_delay: float = 0.0):
+        self.send_delay = send_delay
+        self.frames = []
+        self.client = "test-client"
+        self.application_state = WebSocketState.CONNECTED
+        self.close_codes = []
+
+    async def send_text(self, text):
+        if self.send_delay:
+            await asyncio.sleep(self.send_delay)
+        self.frames.append(text)
+
+    async def close(self, code=1000):
+        self.close_codes.append(code)
+        self.application_state = WebSocketState.DISCONNECTED
+
+
+class DisconnectedWebsocket(FakeWebsocket):
+    async def send_text(self, text):
+        raise RuntimeError("websocket is closed")
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_coalesce_until_max_bytes():
+    async def main():
+        websocket = FakeWebsocket()
+        writer = WebsocketStreamWriter(websocket, max_bytes=6, flush_interval=10)
+        for token in ["ab", "cd", "ef", "g"]:
+            await writer.write(token)
+        assert websocket.frames == ["abcdef"]
+        await writer.flush()
+        assert websocket.frames == ["abcdef", "g"]
+
+    run(main())
+
+
+def test_max_bytes_counts_utf8_bytes():
+    async def main():
+        websocket = FakeWebsocket()
+        writer = WebsocketStreamWriter(websocket, max_bytes=6, flush_interval=10)
+        await writer.write("你")
+        assert websocket.frames == []
+        await writer.write("好")
+        assert websocket.frames == ["你好"]
+
+    run(main())
+
+
+def test_timer_flushes_trailing_tokens():
+    async def main():
+        websocket = FakeWebsocket()
+        writer = WebsocketStreamWriter(websocket, max_bytes=1024, flush_interval=0.01)
+        await writer.write("a")
+        await writer.write("b")
+        assert websocket.frames == []
+        await asyncio.sleep(0.05)
+        assert websocket.frames == ["ab"]
+
+    run(main())
+
+
+def test_write_checks_age_when_loop_is_blocked():
+    async def main():
+        websocket = FakeWebsocket()
+        writer = WebsocketStreamWriter(websocket, max_bytes=1024, flush_interval=0.01)
+        await writer.write("a")
+        # 同步的模型流占着事件循环,定时任务没有机会执行
+        time.sleep(0.02)
+        await writer.write("b")
+        assert websocket.frames == ["ab"]
+
+    run(main())
+
+
+@pytest.mark.parametrize("flush_interval", [0, -1])
+def test_disabled_coalescing_sends_every_token(flush_interval):
+    async def main():
+        websocket = FakeWebsocket()
+        writer = WebsocketStreamWriter(websocket, flush_interval=flush_interval)
+        for token in ["a", "", "b"]:
+            await writer.write(token)
+        assert websocket.frames == ["a", "b"]
+
+    run(main())
+
+
+def test_send_timeout_closes_slow_consumer():
+    async def main():
+        websocket = FakeWebsocket(send_delay=1)
+        writer = WebsocketStreamWriter(websocket, flush_interval=0, send_timeout=0.01)
+        with pytest.raises(StreamClosedError):
+            await writer.write("a")
+        assert writer.closed
+        assert websocket.close_codes == [1013]
+        # 之后的写入直接失败,上游的模型流停止
+        with pytest.raises(StreamClosedError):
+            await writer.write("b")
+        assert websocket.frames == []
+
+    run(main())
+
+
+def test_disconnect_error_from_timer_is_raised_on_next_write():
+    async def main():
+        websocket = DisconnectedWebsocket()
+        writer = WebsocketStreamWriter(websocket, max_bytes=1024, flush_interval=0.01)
+        await writer.write("a")
+        await asyncio.sleep(0.05)
+        assert writer.closed
+        with pytest.raises(StreamClosedError):
+            await writer.write("b")
+        # 客户端自己断开的不需要再关闭
+        assert websocket.close_codes == []
+
+    run(main())
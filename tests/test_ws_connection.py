@@ -0,0 +1,54 @@
+import asyncio
+
+from starlette.websockets import WebSocketDisconnect
+
+from utils.ws_connection import WebsocketConnection
+
+
+class FakeWebsocket:
+    def __init__(self):
+        self.incoming = asyncio.Queue()
+
+    async def receive_text(self):
+        message = await self.incoming.get()
+        if message is None:
+            raise WebSocketDisconnect()
+        return message
+
+
+def test_new_request_cancels_previous_turn_tasks():
+    async def run():
+        websocket = FakeWebsocket()
+        connection = WebsocketConnection(websocket, "test")
+        connection.start()
+
+        websocket.incoming.put_nowait("first")
+        assert await connection.receive_request() == "first"
+
+        # 上一轮结束之后还在生成的引导问题
+        follow_questions = asyncio.create_task(asyncio.sleep(10))
+        connection.add_turn_task(follow_questions)
+
+        websocket.incoming.put_nowait("second")
+        assert await connection.receive_request() == "second"
+        await asyncio.gather(follow_questions, return_exceptions=True)
+        assert follow_questions.cancelled()
+
+        websocket.incoming.put_nowait(None)
+        assert await connection.receive_request() is None
+        await connection.close()
+
+    asyncio.run(run())
+
+
+def test_close_cancels_turn_tasks():
+    async def run():
+        connection = WebsocketConnection(FakeWebsocket(), "test")
+        connection.start()
+        task = asyncio.create_task(asyncio.sleep(10))
+        connection.add_turn_task(task)
+        await connection.close()
+        await asyncio.gather(task, return_exceptions=True)
+        assert task.cancelled()
+
+    asyncio.run(run())
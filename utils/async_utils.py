@@ -0,0 +1,81 @@
+import asyncio
+import threading
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Iterable
+
+from utils.log_utils import LogUtils
+from utils.metrics import get_llm_provider_label, record_llm_cancelled
+from utils.token_utils import estimate_tokens
+
+_ITER_DONE = object()
+
+
+async def aiter_in_executor(iterable: Iterable) -> AsyncIterator:
+    """把同步迭代器适配成异步迭代器
+    每次 next 都放到线程池里执行,慢的 provider 不会阻塞事件循环
+    提前退出时关闭同步迭代器,provider的http流跟着关闭
+    """
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterable)
+    # 取消等待并不会停止线程里正在执行的next,关闭要等它执行完
+    lock = threading.Lock()
+
+    def next_item():
+        with lock:
+            return next(iterator, _ITER_DONE)
+
+    def close_iterator():
+        with lock:
+            iterator.close()
+
+    finished = False
+    try:
+        while True:
+            # StopIteration 不能穿过 Future,用哨兵值表示结束
+            item = await loop.run_in_executor(None, next_item)
+            if item is _ITER_DONE:
+                finished = True
+                break
+            yield item
+    finally:
+        if not finished and hasattr(iterator, "close"):
+            # 不等待关闭完成,取消的时候不阻塞调用方
+            loop.run_in_executor(None, close_iterator)
+
+
+def astream_llm(llm: Any, inputs: Any, **kwargs) -> AsyncIterator:
+    """流式调用大模型
+    优先使用原生的 astream,没有的话用线程池适配同步的 stream
+    """
+    if hasattr(llm, "astream"):
+        return llm.astream(inputs, **kwargs)
+    return aiter_in_executor(llm.stream(inputs, **kwargs))
+
+
+async def astream_llm_content(llm: Any, inputs: Any, endpoint: str, **kwargs):
+    """流式输出文本内容
+    调用方没有读完就退出时(客户端断开,任务取消)关闭provider的流,记录节省的token
+    调用方需要用 aclosing 包起来,保证退出时立即关闭
+    """
+    text = ""
+    completed = False
+    async with aclosing(astream_llm(llm, inputs, **kwargs)) as response:
+        try:
+            async for chunk in response:
+                text += chunk.content
+                yield chunk.content
+            completed = True
+        finally:
+            if not completed:
+                # 经过调度器包装的模型按实际的provider和模型记录
+                provider = get_llm_provider_label(llm)
+                llm = getattr(llm, "inner", llm)
+                model = getattr(llm, "model_name", None) or getattr(llm, "model", None)
+                saved = record_llm_cancelled(
+                    endpoint,
+                    provider,
+                    str(model or ""),
+                    estimate_tokens(text),
+                    "closed",
+                )
+                LogUtils.log_info(f"{endpoint} stream closed early, about {saved} tokens saved")
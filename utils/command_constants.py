@@ -1,6 +1,7 @@
 CHAT_STREAM_SERVE_START = "[chat_stream_serve_start]"
 CHAT_STREAM_SERVE_DONE = "[chat_stream_serve_done]"
 CHAT_STREAM_CLIENT_STOP = "[chat_stream_client_stop]"
+CHAT_FOLLOW_QUESTIONS = "chat_follow_questions"
 
 RAG_PARSE_QUESTION_START = "[rag_parse_question_start]"
 RAG_PARSE_QUESTION_DONE = "[rag_parse_question_done]"
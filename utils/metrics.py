@@ -0,0 +1,201 @@
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# 模型和RAG阶段的耗时从几十毫秒到几十秒
+_STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+# 存储访问一般是毫秒级
+_STORAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+_TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 120, 200, 400)
+
+RAG_STAGE_SECONDS = Histogram(
+    "hopeflow_rag_stage_seconds",
+    "RAG各阶段的耗时",
+    ["stage", "collection"],
+    buckets=_STAGE_BUCKETS,
+)
+
+LLM_FIRST_TOKEN_SECONDS = Histogram(
+    "hopeflow_llm_first_token_seconds",
+    "从开始请求模型到收到第一个token的时间",
+    ["endpoint", "provider", "model"],
+    buckets=_STAGE_BUCKETS,
+)
+
+LLM_TOKENS_PER_SECOND = Histogram(
+    "hopeflow_llm_tokens_per_second",
+    "首个token之后的输出速度",
+    ["endpoint", "provider", "model"],
+    buckets=_TOKENS_PER_SECOND_BUCKETS,
+)
+
+LLM_OUTPUT_TOKENS = Counter(
+    "hopeflow_llm_output_tokens_total",
+    "模型输出的token数(估算)",
+    ["endpoint", "provider", "model"],
+)
+
+LLM_STREAMS_CANCELLED = Counter(
+    "hopeflow_llm_streams_cancelled_total",
+    "客户端停止,断开或者读取失败时提前关闭的模型流",
+    ["endpoint", "reason"],
+)
+
+LLM_OUTPUT_TOKENS_SAVED = Counter(
+    "hopeflow_llm_output_tokens_saved_total",
+    "提前关闭模型流节省的输出token数(按完整回答的平均长度估算)",
+    ["endpoint", "provider", "model"],
+)
+
+WEBSOCKET_SESSIONS = Gauge(
+    "hopeflow_websocket_sessions_active",
+    "当前打开的websocket连接数",
+    ["endpoint"],
+)
+
+WEBSOCKET_SESSIONS_TOTAL = Counter(
+    "hopeflow_websocket_sessions_opened_total",
+    "累计打开的websocket连接数",
+    ["endpoint"],
+)
+
+STREAM_WRITER_EVENTS = Counter(
+    "hopeflow_stream_writer_events_total",
+    "流式发送的慢发送,丢弃的慢客户端和断开的客户端",
+    ["event"],
+)
+
+LLM_SCHEDULER_QUEUE_DEPTH = Gauge(
+    "hopeflow_llm_scheduler_queue_depth",
+    "等待调用名额的大模型请求数",
+    ["provider", "priority"],
+)
+
+LLM_SCHEDULER_WAIT_SECONDS = Histogram(
+    "hopeflow_llm_scheduler_wait_seconds",
+    "大模型请求排队和限流等待的时间",
+    ["provider", "priority"],
+    buckets=_STAGE_BUCKETS,
+)
+
+LLM_RATE_LIMITED = Counter(
+    "hopeflow_llm_rate_limited_total",
+    "provider返回429的次数",
+    ["provider", "model"],
+)
+
+LLM_HEDGE_REQUESTS = Counter(
+    "hopeflow_llm_hedge_requests_total",
+    "对冲请求的结果: not_hedged, primary_won, fallback_won, failed",
+    ["group", "outcome"],
+)
+
+EMBEDDING_CACHE_REQUESTS = Counter(
+    "hopeflow_embedding_cache_requests_total",
+    "向量缓存的命中情况, tier: memory, redis, document; result: hit, miss",
+    ["tier", "result"],
+)
+
+STORAGE_SECONDS = Histogram(
+    "hopeflow_storage_seconds",
+    "redis, milvus, sql 的访问耗时",
+    ["backend", "operation"],
+    buckets=_STORAGE_BUCKETS,
+)
+
+
+@contextmanager
+def observe_seconds(histogram: Histogram, **labels):
+    """统计代码块的耗时,出异常也会记录"""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - start_time)
+
+
+def track_storage(backend: str, operation: str = None):
+    """统计存储访问耗时的装饰器,同步和异步函数都可以用,operation默认是函数名"""
+
+    def decorator(func):
+        labels = {"backend": backend, "operation": operation or func.__name__}
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with observe_seconds(STORAGE_SECONDS, **labels):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with observe_seconds(STORAGE_SECONDS, **labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# 完整回答的平均token数,估算提前关闭节省的token, (endpoint, provider, model) -> 平均值
+_ANSWER_TOKENS_DECAY = 0.1
+_answer_tokens_avg: dict[tuple[str, str, str], float] = {}
+_answer_tokens_lock = threading.Lock()
+
+
+def get_llm_provider_label(llm: Any) -> str:
+    """经过调度器包装的模型按实际的provider记录,其他模型按类名"""
+    return getattr(llm, "provider_name", None) or type(llm).__name__.lower()
+
+
+def record_llm_stream(
+    endpoint: str,
+    provider: str,
+    model: str,
+    first_token_seconds: float,
+    tokens: int,
+    stream_seconds: float,
+    completed: bool = True,
+):
+    """记录一次流式输出,stream_seconds是首个token之后的输出时间
+    completed为False表示中途停止的回答,不计入完整回答的平均长度
+    """
+    labels = {"endpoint": endpoint, "provider": provider or "", "model": model or ""}
+    LLM_FIRST_TOKEN_SECONDS.labels(**labels).observe(first_token_seconds)
+    LLM_OUTPUT_TOKENS.labels(**labels).inc(tokens)
+    if stream_seconds > 0:
+        LLM_TOKENS_PER_SECOND.labels(**labels).observe(tokens / stream_seconds)
+
+    if completed:
+        key = (labels["endpoint"], labels["provider"], labels["model"])
+        with _answer_tokens_lock:
+            average = _answer_tokens_avg.get(key)
+            _answer_tokens_avg[key] = (
+                tokens
+                if average is None
+                else average + _ANSWER_TOKENS_DECAY * (tokens - average)
+            )
+
+
+def record_llm_cancelled(
+    endpoint: str, provider: str, model: str, partial_tokens: int, reason: str
+) -> int:
+    """记录提前关闭的模型流,返回估算节省的输出token数
+    没有这个模型的完整回答时无法估算,记为0
+    """
+    labels = {"endpoint": endpoint, "provider": provider or "", "model": model or ""}
+    LLM_STREAMS_CANCELLED.labels(endpoint=endpoint, reason=reason).inc()
+    with _answer_tokens_lock:
+        average = _answer_tokens_avg.get(
+            (labels["endpoint"], labels["provider"], labels["model"])
+        )
+    saved = max(0, int(average - partial_tokens)) if average is not None else 0
+    LLM_OUTPUT_TOKENS_SAVED.labels(**labels).inc(saved)
+    return saved
@@ -28,6 +28,11 @@ def get_mutil_modal_model(model_name: str):
     return LLMFactory.get_llm(modal_item[1], modal_item[0])
 
 
+def get_mutil_modal_config_item():
+    """配置的多模态模型, (model_name, LLMType, ...)"""
+    return _get_mutil_modal_item(RagConfiguration().get_multi_modal_config())
+
+
 def get_mutil_modal_config_model():
     _config_modal_name = RagConfiguration().get_multi_modal_config()
     return get_mutil_modal_model(_config_modal_name)
\ No newline at end of file
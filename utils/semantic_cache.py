@@ -0,0 +1,268 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+from llama_index.core import Settings
+
+from config.base_config import BaseConfiguration
+from utils.log_utils import LogUtils
+
+_semantic_cache_config = BaseConfiguration().get_semantic_cache_config()
+
+_VERSION_KEY_PREFIX = "semantic_cache:version:"
+
+
+@dataclass
+class SemanticCacheKey:
+    """一次请求的缓存键: 命名空间 + 问题的向量"""
+
+    namespace: str
+    query: str
+    embedding: np.ndarray
+    # RAG的知识库集合,入库时按集合失效
+    collection: Optional[str] = None
+
+
+@dataclass
+class SemanticCacheEntry:
+    key: SemanticCacheKey
+    answer: str
+    created_at: float
+    # 回放时需要的其他数据,比如RAG的引用片段
+    payload: Optional[str] = None
+
+
+def build_cache_namespace(**kwargs) -> str:
+    """模型,过滤条件,检索参数等都相同的请求才共用缓存"""
+    raw = json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def get_embed_model_name(embed_model=None) -> str:
+    embed_model = embed_model or Settings.embed_model
+    return f"{type(embed_model).__name__}:{getattr(embed_model, 'model_name', '')}"
+
+
+async def build_cache_key(
+    query: str,
+    collection: Optional[str] = None,
+    embed_model=None,
+    **namespace_kwargs,
+) -> Optional[SemanticCacheKey]:
+    """RAG传入租户的向量模型,和知识库检索用的是同一个模型,为空时使用全局的 Settings.embed_model
+    RAG的命名空间包含集合的版本号,入库之后版本号变化,之前的回答不会再命中
+    读取不到版本号时返回None,这次请求不使用缓存
+    """
+    collection_version = None
+    if collection is not None:
+        collection_version = await collection_versions.aget(collection)
+        if collection_version is None:
+            return None
+
+    embed_model = embed_model or Settings.embed_model
+    embedding = await embed_model.aget_query_embedding(query)
+    namespace = build_cache_namespace(
+        embed_model=get_embed_model_name(embed_model),
+        collection=collection,
+        collection_version=collection_version,
+        **namespace_kwargs,
+    )
+    return SemanticCacheKey(
+        namespace=namespace,
+        query=query,
+        embedding=_normalize(embedding),
+        collection=collection,
+    )
+
+
+_chat_embed_model = None
+_chat_embed_lock = threading.Lock()
+
+
+def is_semantic_cache_enabled() -> bool:
+    """配置里关闭时,请求里的 semantic_cache_enabled 不起作用"""
+    return _semantic_cache_config["enabled"]
+
+
+def get_chat_embed_model():
+    """普通聊天的缓存单独配置向量模型,第一次使用时加载,不依赖知识库的管理器
+    会访问向量模型的服务,在协程里通过 asyncio.to_thread 调用
+    """
+    global _chat_embed_model
+    if _chat_embed_model is None:
+        with _chat_embed_lock:
+            if _chat_embed_model is None:
+                from rag.managers.embedding_manager import EmbeddingManager
+
+                config = _semantic_cache_config["chat_embedding"]
+                _chat_embed_model = EmbeddingManager(
+                    config["type"], config["name"]
+                ).get_model()
+    return _chat_embed_model
+
+
+def _normalize(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class CollectionVersions:
+    """知识库集合的版本号,存在redis里
+    入库脚本和API服务通常不在同一个进程,进程内的失效通知不到API服务,
+    入库时增加版本号,API服务查缓存时读取,版本号不同的回答自然不会命中
+    """
+
+    def __init__(self, redis_db: int):
+        self.redis_db = redis_db
+        self._redis = None
+        self._aredis = None
+
+    def _get_redis(self):
+        if self._redis is None:
+            from dao.redis_dao import create_sync_redis_client
+
+            self._redis = create_sync_redis_client(self.redis_db)
+        return self._redis
+
+    def _get_aredis(self):
+        if self._aredis is None:
+            import redis.asyncio as redis
+
+            from dao.redis_dao import create_redis_connection_pool
+
+            self._aredis = redis.Redis(
+                connection_pool=create_redis_connection_pool(db=self.redis_db)
+            )
+        return self._aredis
+
+    def bump(self, collection: str) -> Optional[int]:
+        """入库是同步执行的,使用同步的客户端"""
+        try:
+            return self._get_redis().incr(_VERSION_KEY_PREFIX + collection)
+        except Exception as e:
+            LogUtils.log_error(
+                f"semantic cache bump version of {collection} error, "
+                f"other processes may serve stale answers until ttl: {e}"
+            )
+            return None
+
+    async def aget(self, collection: str) -> Optional[int]:
+        """没有入库过的集合版本号是0, redis访问失败返回None"""
+        try:
+            raw = await self._get_aredis().get(_VERSION_KEY_PREFIX + collection)
+        except Exception as e:
+            LogUtils.log_error(f"semantic cache get version of {collection} error: {e}")
+            return None
+        return 0 if raw is None else int(raw)
+
+    async def aclose(self):
+        if self._aredis is not None:
+            await self._aredis.aclose()
+            await self._aredis.connection_pool.disconnect()
+            self._aredis = None
+        if self._redis is not None:
+            self._redis.close()
+            self._redis = None
+
+
+class SemanticCache:
+    """进程内的语义缓存
+    同一个命名空间内,问题向量的余弦相似度超过阈值就直接返回之前的回答
+    超过ttl的条目失效,数量超过max_size时淘汰最久没命中的
+    """
+
+    def __init__(self, max_size: int, ttl: float, similarity_threshold: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._entries: OrderedDict[int, SemanticCacheEntry] = OrderedDict()
+        self._namespace_ids: dict[str, set[int]] = {}
+
+    def lookup(self, key: SemanticCacheKey) -> Optional[SemanticCacheEntry]:
+        now = time.monotonic()
+        with self._lock:
+            entry_ids = []
+            for entry_id in list(self._namespace_ids.get(key.namespace, ())):
+                if now - self._entries[entry_id].created_at >= self.ttl:
+                    self._remove(entry_id)
+                else:
+                    entry_ids.append(entry_id)
+            if not entry_ids:
+                return None
+
+            matrix = np.stack([self._entries[i].key.embedding for i in entry_ids])
+            scores = matrix @ key.embedding
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity_threshold:
+                return None
+
+            entry_id = entry_ids[best]
+            self._entries.move_to_end(entry_id)
+            entry = self._entries[entry_id]
+
+        LogUtils.log_info(
+            f"semantic cache hit: {key.query} -> {entry.key.query}, score={scores[best]:.4f}"
+        )
+        return entry
+
+    def add(self, key: SemanticCacheKey, answer: str, payload: Optional[str] = None):
+        if not answer:
+            return
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = SemanticCacheEntry(
+                key=key, answer=answer, created_at=time.monotonic(), payload=payload
+            )
+            self._namespace_ids.setdefault(key.namespace, set()).add(entry_id)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_collection(self, collection: str) -> int:
+        """知识库有新的文档入库,这个集合相关的回答都可能过时"""
+        with self._lock:
+            entry_ids = [
+                entry_id
+                for entry_id, entry in self._entries.items()
+                if entry.key.collection == collection
+            ]
+            for entry_id in entry_ids:
+                self._remove(entry_id)
+        LogUtils.log_info(f"semantic cache invalidate {collection}: {len(entry_ids)}")
+        return len(entry_ids)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._namespace_ids.clear()
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        namespace_ids = self._namespace_ids[entry.key.namespace]
+        namespace_ids.discard(entry_id)
+        if not namespace_ids:
+            del self._namespace_ids[entry.key.namespace]
+
+
+collection_versions = CollectionVersions(_semantic_cache_config["redis_db"])
+
+semantic_cache = SemanticCache(
+    max_size=_semantic_cache_config["max_size"],
+    ttl=_semantic_cache_config["ttl"],
+    similarity_threshold=_semantic_cache_config["similarity_threshold"],
+)
+
+
+def invalidate_collection(collection: str):
+    """知识库有变化: 增加redis里的版本号,所有进程生效; 本进程的条目直接删除"""
+    collection_versions.bump(collection)
+    semantic_cache.invalidate_collection(collection)
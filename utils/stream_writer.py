@@ -0,0 +1,144 @@
+import asyncio
+import time
+from typing import Optional
+
+from starlette.websockets import WebSocket, WebSocketState
+
+from config.base_config import BaseConfiguration
+from utils.log_utils import LogUtils
+from utils.metrics import STREAM_WRITER_EVENTS
+
+_stream_writer_config = BaseConfiguration().get_stream_writer_config()
+
+
+class StreamClosedError(Exception):
+    """客户端已经断开,或者读取太慢被服务端断开,上游的模型流应该停止"""
+
+
+class WebsocketStreamWriter:
+    """合并token之后再发送,减少websocket的帧数
+    缓冲区超过max_bytes,或者最早的未发送token超过flush_interval秒时发送
+    flush_interval <= 0 时每个token单独发送,和原来的行为一致
+
+    发送是在写入里直接等待的,客户端读得慢时发送会阻塞,模型流也就跟着暂停,
+    每个连接缓冲的内容不会超过max_bytes, 一帧超过send_timeout秒还没发出去就断开这个客户端
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        max_bytes: int = 256,
+        flush_interval: float = 0.02,
+        send_timeout: float = 10.0,
+        slow_send_threshold: float = 0.2,
+    ):
+        self.websocket = websocket
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.send_timeout = send_timeout
+        self.slow_send_threshold = slow_send_threshold
+
+        self._buffer: list[str] = []
+        self._buffer_bytes = 0
+        self._first_write_time = 0.0
+        self._flush_task: Optional[asyncio.Task] = None
+        self._send_lock = asyncio.Lock()
+        # 发送失败之后的异常,后续的写入都直接抛出
+        self._error: Optional[StreamClosedError] = None
+
+    @property
+    def closed(self) -> bool:
+        return self._error is not None
+
+    async def write(self, text: str):
+        if self._error is not None:
+            raise self._error
+        if not text:
+            return
+
+        if not self._buffer:
+            self._first_write_time = time.monotonic()
+        self._buffer.append(text)
+        self._buffer_bytes += len(text.encode("utf-8"))
+
+        # 同步的模型流可能一直占着事件循环,定时任务没机会执行,写入时也检查一次时间
+        if (
+            self.flush_interval <= 0
+            or self._buffer_bytes >= self.max_bytes
+            or time.monotonic() - self._first_write_time >= self.flush_interval
+        ):
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def flush(self):
+        """发送缓冲区里的所有内容,结束信号之前必须调用"""
+        if self._flush_task is not None:
+            # 只会取消还在等待的定时任务,已经开始发送的任务会先把_flush_task置空
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._send_buffer()
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        try:
+            await self._send_buffer()
+        except StreamClosedError:
+            # 异常已经记录在_error里,下次写入时抛出
+            pass
+
+    async def _send_buffer(self):
+        async with self._send_lock:
+            if self._error is not None:
+                raise self._error
+            if not self._buffer:
+                return
+            text = "".join(self._buffer)
+            self._buffer.clear()
+            self._buffer_bytes = 0
+
+            start_time = time.monotonic()
+            try:
+                await asyncio.wait_for(
+                    self.websocket.send_text(text), timeout=self.send_timeout
+                )
+            except asyncio.TimeoutError:
+                STREAM_WRITER_EVENTS.labels(event="dropped_consumer").inc()
+                self._error = StreamClosedError(
+                    f"client too slow, send blocked over {self.send_timeout} seconds"
+                )
+                LogUtils.log_info(f"drop slow consumer: {self.websocket.client}")
+                await self._close_websocket()
+                raise self._error
+            except Exception as e:
+                STREAM_WRITER_EVENTS.labels(event="disconnected_consumer").inc()
+                self._error = StreamClosedError(f"client disconnected: {e}")
+                raise self._error from e
+
+            if time.monotonic() - start_time >= self.slow_send_threshold:
+                STREAM_WRITER_EVENTS.labels(event="slow_send").inc()
+
+    async def _close_websocket(self):
+        if self.websocket.application_state == WebSocketState.DISCONNECTED:
+            return
+        try:
+            # 1013: 服务端过载,客户端稍后重试
+            await self.websocket.close(code=1013)
+        except Exception as e:
+            LogUtils.log_error(f"close slow consumer error: {e}")
+
+
+def get_stream_writer(websocket: WebSocket, endpoint: str) -> WebsocketStreamWriter:
+    """按接口读取 base_settings.toml 中的合并配置,没有配置的项使用default"""
+    config = {
+        **_stream_writer_config["default"],
+        **_stream_writer_config.get(endpoint, {}),
+    }
+    return WebsocketStreamWriter(
+        websocket,
+        max_bytes=config["max_bytes"],
+        flush_interval=config["flush_interval_ms"] / 1000,
+        send_timeout=config["send_timeout"],
+        slow_send_threshold=config["slow_send_ms"] / 1000,
+    )
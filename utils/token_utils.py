@@ -0,0 +1,6 @@
+def estimate_tokens(text: str) -> int:
+    """估算token数,不依赖具体模型的tokenizer
+    中文大约一个字一个token,其他字符大约四个一个token
+    """
+    cjk_count = sum(1 for char in text if "一" <= char <= "鿿")
+    return cjk_count + (len(text) - cjk_count + 3) // 4
@@ -0,0 +1,102 @@
+import asyncio
+from typing import Optional
+
+from starlette.websockets import WebSocket
+
+from utils.command_constants import CHAT_STREAM_CLIENT_STOP
+from utils.log_utils import LogUtils
+from utils.metrics import WEBSOCKET_SESSIONS, WEBSOCKET_SESSIONS_TOTAL
+
+# 回答结束的原因
+STREAM_FINISHED = "finished"
+STREAM_STOPPED = "stopped"
+STREAM_DISCONNECTED = "disconnected"
+
+
+class WebsocketConnection:
+    """每个连接一个读取任务,停止指令设置stop_event,其他消息作为新的请求排队
+    流式输出时等待事件,不需要定时轮询receive,空闲的连接没有额外开销
+    """
+
+    def __init__(self, websocket: WebSocket, endpoint: str):
+        self.websocket = websocket
+        self.endpoint = endpoint
+        self.stop_event = asyncio.Event()
+        self.disconnected = asyncio.Event()
+        self._requests: asyncio.Queue[Optional[str]] = asyncio.Queue()
+        self._reader_task: Optional[asyncio.Task] = None
+        # 上一轮回答结束之后还在后台执行的发送任务,比如引导问题
+        self._turn_tasks: set[asyncio.Task] = set()
+
+    def start(self):
+        WEBSOCKET_SESSIONS.labels(endpoint=self.endpoint).inc()
+        WEBSOCKET_SESSIONS_TOTAL.labels(endpoint=self.endpoint).inc()
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+    def add_turn_task(self, task: asyncio.Task):
+        """新的请求到达时取消,上一轮的内容不会混进下一轮回答的帧里"""
+        self._turn_tasks.add(task)
+        task.add_done_callback(self._turn_tasks.discard)
+
+    def _cancel_turn_tasks(self):
+        for task in list(self._turn_tasks):
+            task.cancel()
+
+    async def close(self):
+        self._cancel_turn_tasks()
+        if self._reader_task is not None:
+            WEBSOCKET_SESSIONS.labels(endpoint=self.endpoint).dec()
+            self._reader_task.cancel()
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+            self._reader_task = None
+
+    async def _read_loop(self):
+        try:
+            while True:
+                request_msg = await self.websocket.receive_text()
+                if CHAT_STREAM_CLIENT_STOP in request_msg:
+                    LogUtils.log_info("receive stop command")
+                    self.stop_event.set()
+                else:
+                    self._cancel_turn_tasks()
+                    self._requests.put_nowait(request_msg)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # WebSocketDisconnect,或者断开之后再读取的RuntimeError
+            LogUtils.log_info(f"Client disconnected: {e}")
+        finally:
+            self.disconnected.set()
+            # 唤醒等待请求的协程
+            self._requests.put_nowait(None)
+
+    async def receive_request(self) -> Optional[str]:
+        """等待下一个请求,连接断开时返回None
+        之前残留的停止指令只对当时的回答有效,新请求开始时清掉
+        """
+        request_msg = await self._requests.get()
+        self.stop_event.clear()
+        return request_msg
+
+    async def wait_streaming(self, send_task: asyncio.Task) -> str:
+        """等待回答发送完成,收到停止指令或者连接断开时立即取消发送任务"""
+        stop_wait = asyncio.create_task(self.stop_event.wait())
+        disconnect_wait = asyncio.create_task(self.disconnected.wait())
+        try:
+            done, _ = await asyncio.wait(
+                {send_task, stop_wait, disconnect_wait},
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        finally:
+            stop_wait.cancel()
+            disconnect_wait.cancel()
+
+        if send_task in done:
+            return STREAM_FINISHED
+
+        send_task.cancel()  # 取消发送任务
+        await asyncio.gather(send_task, return_exceptions=True)  # 等待任务被取消
+        if stop_wait in done:
+            return STREAM_STOPPED
+        LogUtils.log_info("Client disconnected")
+        return STREAM_DISCONNECTED